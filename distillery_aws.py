@@ -1,136 +1,154 @@
 import boto3
-from watchtower import CloudWatchLogHandler
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from distillery_logs import LogShipper, CloudWatchLogSink, FileLogSink, LOG_CORE_FIELDS
 from typing import List, Tuple
 import os
+import sys
 import logging
-import inspect
 import time
+import threading
 from io import BytesIO
-import json
-import time
 import socket
-import copy
-import datetime
-import pytz
 
 APP_NAME = os.getenv('APP_NAME')
 AWS_REGION_NAME = os.getenv('AWS_REGION_NAME')
 AWS_LOG_GROUP = os.getenv('AWS_LOG_GROUP')
 AWS_LOG_STREAM_NAME = os.getenv('AWS_LOG_STREAM_NAME')
+LOG_SINK = os.getenv('LOG_SINK', 'cloudwatch') # 'cloudwatch', or 'file' to write JSON lines to LOG_FILE_PATH (offline runs and benchmarks)
+LOG_FILE_PATH = os.getenv('LOG_FILE_PATH', 'distillery_logs.jsonl')
+HOSTNAME = socket.gethostname()
+LOG_LEVELS = {'INFO': logging.INFO, 'WARNING': logging.WARNING, 'ERROR': logging.ERROR}
 AWS_S3_BUCKET_NAME = os.getenv('AWS_S3_BUCKET_NAME')
 AWS_S3_ACCESS_KEY = os.getenv('AWS_S3_ACCESS_KEY')
 AWS_S3_SECRET_KEY = os.getenv('AWS_S3_SECRET_KEY')
-
-class JSONFormatter(logging.Formatter):
-    def format(self, record):
-        log_record = record.__dict__.copy()
-        # Check if 'msg' is already in JSON format
-        try:
-            log_dict = json.loads(log_record['msg'])
-        except Exception as e:
-            log_dict = copy.deepcopy(log_record['msg'])
-        log_dict['level'] = record.levelname
-        # return the JSON string
-        return json.dumps(log_dict)
+AWS_S3_ENDPOINT_URL = os.getenv('AWS_S3_ENDPOINT_URL') # S3-compatible endpoint to use instead of AWS, e.g. MinIO or the benchmark's local stand-in; addressed path-style
+AWS_S3_MAX_POOL_CONNECTIONS = int(os.getenv('AWS_S3_MAX_POOL_CONNECTIONS', 50)) # Size of the connection pool shared by every S3 call of this worker; keep it above AWS_S3_MAX_PARALLEL_FILES * AWS_S3_MAX_CONCURRENCY
+AWS_S3_MULTIPART_THRESHOLD_MB = int(os.getenv('AWS_S3_MULTIPART_THRESHOLD_MB', 64)) # Files above this size are transferred with multipart requests
+AWS_S3_MULTIPART_CHUNKSIZE_MB = int(os.getenv('AWS_S3_MULTIPART_CHUNKSIZE_MB', 32)) # Size of each part of a multipart transfer
+AWS_S3_MAX_CONCURRENCY = int(os.getenv('AWS_S3_MAX_CONCURRENCY', 10)) # Threads used to transfer the parts of a single multipart file
+AWS_S3_MAX_PARALLEL_FILES = int(os.getenv('AWS_S3_MAX_PARALLEL_FILES', 4)) # Files transferred at the same time by the batch methods
 
 class AWSConnector:
     _instance = None
+    _init_lock = threading.Lock() # The ComfyUI boot, the model prefetch and the first request may all ask for the connector at once; only one builds it
 
     def __new__(cls):
         try:
-            if not cls._instance:
-                cls._instance = super().__new__(cls)
-                cls._instance.region_name = AWS_REGION_NAME
-                cls._instance.log_group = AWS_LOG_GROUP
-                cls._instance.log_stream_name = AWS_LOG_STREAM_NAME
-                cls._instance.setup_logging()
+            if cls._instance is None:
+                with cls._init_lock:
+                    if cls._instance is None:
+                        instance = super().__new__(cls)
+                        instance.region_name = AWS_REGION_NAME
+                        instance.log_group = AWS_LOG_GROUP
+                        instance.log_stream_name = AWS_LOG_STREAM_NAME
+                        instance.setup_logging()
+                        instance.setup_s3()
+                        cls._instance = instance # Published only once fully set up
             return cls._instance
         except Exception as e:
             raise
     
     def setup_logging(self, level=logging.INFO): 
         try:
-            app_logger = logging.getLogger(APP_NAME)
-            if not app_logger.hasHandlers():  # Check if handlers are already added
-                app_logger.setLevel(level)
-                # Setup CloudWatch log handler
+            self.log_level = level
+            if LOG_SINK == 'file':
+                sink = FileLogSink(LOG_FILE_PATH)
+            else:
                 session = boto3.Session(region_name=self.region_name)
                 cloudwatch_client = session.client('logs')
-                cw_handler = CloudWatchLogHandler(boto3_client=cloudwatch_client, log_group=self.log_group, stream_name=self.log_stream_name)
-                json_formatter = JSONFormatter()
-                cw_handler.setFormatter(json_formatter)
-                app_logger.addHandler(cw_handler)
-                app_logger.propagate = False
+                sink = CloudWatchLogSink(cloudwatch_client, self.log_group, self.log_stream_name)
+            self.log_shipper = LogShipper(sink)
+        except Exception as e:
+            raise
+
+    def setup_s3(self): # One long-lived client for the whole worker; boto3 clients are thread-safe, so the pool and TLS sessions are reused across requests
+        try:
+            s3_config = Config(region_name=AWS_REGION_NAME, max_pool_connections=AWS_S3_MAX_POOL_CONNECTIONS, retries={'max_attempts': 5, 'mode': 'adaptive'}, tcp_keepalive=True, s3={'addressing_style': 'path'} if AWS_S3_ENDPOINT_URL else None)
+            self.s3 = boto3.client('s3', aws_access_key_id=AWS_S3_ACCESS_KEY, aws_secret_access_key=AWS_S3_SECRET_KEY, endpoint_url=AWS_S3_ENDPOINT_URL, config=s3_config)
+            self.transfer_config = TransferConfig(multipart_threshold=AWS_S3_MULTIPART_THRESHOLD_MB * 1024**2, multipart_chunksize=AWS_S3_MULTIPART_CHUNKSIZE_MB * 1024**2, max_concurrency=AWS_S3_MAX_CONCURRENCY, use_threads=True)
         except Exception as e:
             raise
 
-    def print_log(self, request_id, context, message, level='INFO'): 
+    def run_concurrently(self, function, items): # Runs function over items with bounded parallelism; results keep the order of items and the first failure is raised
         try:
-            app_logger = logging.getLogger(APP_NAME)
-            caller_frame = inspect.currentframe().f_back
-            script_name = os.path.basename(caller_frame.f_globals["__file__"])
-            line_number = caller_frame.f_lineno
-            function_name = caller_frame.f_code.co_name
-            hostname = socket.gethostname()
-            # Convert timestamp to EST
-            unixtime = time.time()
-            utc_time = datetime.datetime.utcfromtimestamp(unixtime)
-            est_time = utc_time.replace(tzinfo=pytz.utc).astimezone(pytz.timezone('US/Eastern'))
-            log_data = {
+            if len(items) <= 1:
+                return [function(item) for item in items]
+            with ThreadPoolExecutor(max_workers=min(AWS_S3_MAX_PARALLEL_FILES, len(items))) as executor:
+                return list(executor.map(function, items))
+        except Exception as e:
+            raise
+
+    def print_log(self, request_id, context, message, level='INFO', **fields): # Runs on the request path, so it only collects the fields and enqueues them; formatting and shipping happen on the LogShipper thread. fields are added to the record as structured data (e.g. timings); names of core fields get a 'field_' prefix instead of overwriting them
+        try:
+            if LOG_LEVELS.get(level, logging.INFO) < self.log_level:
+                return
+            caller_frame = sys._getframe(1)
+            self.log_shipper.submit({
+                "level": level,
                 "context": context,
-                "esttime": est_time.strftime("%Y-%m-%d %H:%M:%S"),  # EST timestamp
-                "unixtime": unixtime,  # Unix timestamp
+                "unixtime": time.time(),  # Unix timestamp; the EST timestamp is derived from it when the record is encoded
                 "request_id": request_id,
                 "message": message,
-                "script_name": script_name,
-                "function_name": function_name,
-                "line_number": line_number,
-                "hostname": f"{APP_NAME}-{hostname}"
-            }
-            message_to_print = json.dumps(log_data)
-            if level == 'INFO':
-                app_logger.info(message_to_print)
-            elif level == 'ERROR':
-                app_logger.error(message_to_print)
-            elif level == 'WARNING':
-                app_logger.warning(message_to_print)
+                "script_name": os.path.basename(caller_frame.f_code.co_filename),
+                "function_name": caller_frame.f_code.co_name,
+                "line_number": caller_frame.f_lineno,
+                "hostname": f"{APP_NAME}-{HOSTNAME}",
+                **{(f"field_{key}" if key in LOG_CORE_FIELDS else key): value for key, value in fields.items()}
+            })
         except Exception as e:
             raise
 
     def upload_fileobj(self, files: List[Tuple[BytesIO, str]]):
+        def upload_one(file):
+            file_obj, key = file
+            file_obj.seek(0)  # Ensure we're at the start of the file
+            self.s3.upload_fileobj(file_obj, AWS_S3_BUCKET_NAME, key, Config=self.transfer_config)
         try:
-            s3 = boto3.client('s3', aws_access_key_id=AWS_S3_ACCESS_KEY, aws_secret_access_key=AWS_S3_SECRET_KEY, region_name=AWS_REGION_NAME)
-            for file_obj, key in files:
-                file_obj.seek(0)  # Ensure we're at the start of the file
-                s3.upload_fileobj(file_obj, AWS_S3_BUCKET_NAME, key)
+            self.run_concurrently(upload_one, list(files))
         except Exception as e:
             raise
 
     def download_fileobj(self, keys: List[str]) -> List[BytesIO]:
+        def download_one(key):
+            file_obj = BytesIO()
+            self.s3.download_fileobj(AWS_S3_BUCKET_NAME, key, file_obj, Config=self.transfer_config)
+            file_obj.seek(0)  # Ensure we're at the start of the file
+            return file_obj
+        try:
+            return self.run_concurrently(download_one, list(keys))
+        except Exception as e:
+            raise
+
+    def get_etags(self, keys: List[str], missing_ok=False) -> List[str]: # HEAD requests only; cheap enough to validate cached copies on every request. With missing_ok, absent keys get None instead of raising
+        def head_one(key):
+            try:
+                return self.s3.head_object(Bucket=AWS_S3_BUCKET_NAME, Key=key)['ETag'].strip('"')
+            except ClientError as e:
+                if missing_ok and e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                    return None
+                raise
         try:
-            file_objs = []
-            s3 = boto3.client('s3', aws_access_key_id=AWS_S3_ACCESS_KEY, aws_secret_access_key=AWS_S3_SECRET_KEY, region_name=AWS_REGION_NAME)
-            for key in keys:
-                file_obj = BytesIO()
-                s3.download_fileobj(AWS_S3_BUCKET_NAME, key, file_obj)
-                file_obj.seek(0)  # Ensure we're at the start of the file
-                file_objs.append(file_obj)
-                return file_objs
+            return self.run_concurrently(head_one, list(keys))
         except Exception as e:
             raise
 
     def upload_files(self, files: List[Tuple[str, str]]):
+        def upload_one(file):
+            file_name, key = file
+            self.s3.upload_file(file_name, AWS_S3_BUCKET_NAME, key, Config=self.transfer_config)
         try:
-            s3 = boto3.client('s3', aws_access_key_id=AWS_S3_ACCESS_KEY, aws_secret_access_key=AWS_S3_SECRET_KEY, region_name=AWS_REGION_NAME)
-            for file_name, key in files:
-                s3.upload_file(file_name, AWS_S3_BUCKET_NAME, key)
+            self.run_concurrently(upload_one, list(files))
         except Exception as e:
             raise
 
-    def download_files(self, files: List[Tuple[str, str]]):
+    def download_files(self, files: List[Tuple[str, str]], callback=None): # callback(bytes_transferred) is called from the transfer threads as chunks arrive
+        def download_one(file):
+            key, file_name = file
+            self.s3.download_file(AWS_S3_BUCKET_NAME, key, file_name, Config=self.transfer_config, Callback=callback)
         try:
-            s3 = boto3.client('s3', aws_access_key_id=AWS_S3_ACCESS_KEY, aws_secret_access_key=AWS_S3_SECRET_KEY, region_name=AWS_REGION_NAME)
-            for key, file_name in files:
-                s3.download_file(AWS_S3_BUCKET_NAME, key, file_name)
+            self.run_concurrently(download_one, list(files))
         except Exception as e:
             raise
@@ -0,0 +1,374 @@
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import socket
+import shutil
+import resource
+import statistics
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from distillery_png import PngMetadata
+from distillery_provision import ModelProvisioner, PROVISIONING_STRATEGIES, PROVISIONING_CHUNK_SIZE
+from distillery_fakes import FakeComfyUI, FakeS3
+
+TEST_PAYLOAD = os.getenv('TEST_PAYLOAD', 'test_payload.json') # The workflow written as metadata, so the chunk has a realistic size
+
+class PngMetadataBenchmark:
+    @staticmethod
+    def make_png(size): # Gradient plus noise, compressed the way ComfyUI's SaveImage does (compress_level=4)
+        try:
+            gradient = Image.linear_gradient('L').resize((size, size))
+            noise = Image.effect_noise((size, size), 32)
+            image = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.Transpose.ROTATE_90)))
+            image_file = io.BytesIO()
+            image.save(image_file, format='PNG', compress_level=4)
+            return image_file.getvalue()
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def time_function(function, repetitions):
+        try:
+            timings = []
+            for _ in range(repetitions):
+                start_time = time.perf_counter()
+                function()
+                timings.append(time.perf_counter() - start_time)
+            return min(timings), sum(timings) / len(timings)
+        except Exception as e:
+            raise
+
+    @classmethod
+    def run(cls, sizes, repetitions):
+        try:
+            with open(TEST_PAYLOAD, 'r') as file:
+                image_metadata = json.dumps({'comfy_api': json.load(file)})
+            results = []
+            for size in sizes:
+                png_data = cls.make_png(size)
+                pil_min, pil_mean = cls.time_function(lambda: PngMetadata.encode_with_pil(Image.open(io.BytesIO(png_data)), 'prompt', image_metadata), repetitions)
+                chunk_min, chunk_mean = cls.time_function(lambda: PngMetadata.set_text(png_data, 'prompt', image_metadata), repetitions)
+                results.append({'size': size, 'png_bytes': len(png_data), 'pil_mean_s': round(pil_mean, 4), 'pil_min_s': round(pil_min, 4), 'chunk_mean_s': round(chunk_mean, 5), 'chunk_min_s': round(chunk_min, 5), 'speedup': round(pil_mean / chunk_mean, 1)})
+            return results
+        except Exception as e:
+            raise
+
+class ProvisioningBenchmark: # Time to first image is approximated as provisioning time plus one full sequential read, which is what loading a safetensors checkpoint costs ComfyUI
+    @staticmethod
+    def drop_page_cache(): # Needs root; without it, reads after the first strategy may be served from memory
+        try:
+            os.sync()
+            with open('/proc/sys/vm/drop_caches', 'w') as file:
+                file.write('3')
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def read_through(path):
+        try:
+            with open(path, 'rb') as file:
+                while file.read(PROVISIONING_CHUNK_SIZE):
+                    pass
+        except Exception as e:
+            raise
+
+    @classmethod
+    def run(cls, source_dir, destination_dir, size_mb, strategies):
+        try:
+            source_path = os.path.join(source_dir, 'distillery_benchmark_model.safetensors')
+            if not os.path.exists(source_path) or os.path.getsize(source_path) != size_mb * 2**20:
+                with open(source_path, 'wb') as file:
+                    for _ in range(size_mb):
+                        file.write(os.urandom(2**20))
+            results = []
+            for strategy in strategies:
+                destination_path = os.path.join(destination_dir, f"distillery_benchmark_{strategy}.safetensors")
+                cold_cache = cls.drop_page_cache()
+                start_time = time.perf_counter()
+                used_strategy = ModelProvisioner.provision(source_path, destination_path, strategy)
+                provisioned_time = time.perf_counter()
+                cls.read_through(destination_path)
+                loaded_time = time.perf_counter()
+                os.unlink(destination_path)
+                results.append({'strategy': strategy, 'used_strategy': used_strategy, 'size_mb': size_mb, 'cold_cache': cold_cache, 'provision_s': round(provisioned_time - start_time, 3), 'load_s': round(loaded_time - provisioned_time, 3), 'time_to_first_image_s': round(loaded_time - start_time, 3)})
+            return results
+        except Exception as e:
+            raise
+
+class EndToEndBenchmark: # Drives handler in this process against a fake ComfyUI (started by the worker itself, through API_COMMAND_LINE) and a local S3 stand-in; no GPU, AWS or runpod needed
+    @staticmethod
+    def free_port():
+        try:
+            with socket.socket() as probe:
+                probe.bind(('127.0.0.1', 0))
+                return probe.getsockname()[1]
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def wait_for_port(port, timeout=30):
+        try:
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                try:
+                    socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                    return
+                except OSError:
+                    time.sleep(0.1)
+            raise RuntimeError(f"Nothing listening on port {port} after {timeout} seconds")
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def process_peak_mb(pid): # VmHWM: resident set high-water mark of a running process
+        try:
+            with open(f"/proc/{pid}/status", 'r') as file:
+                for line in file:
+                    if line.startswith('VmHWM:'):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            return None
+
+    @staticmethod
+    def setup_environment(workspace, s3_port, args): # Must run before the worker modules are imported: they read their configuration at import time
+        try:
+            folders = {
+                'MODELS_FOLDER': f"{workspace}/ComfyUI/models",
+                'CUSTOM_NODES_FOLDER': f"{workspace}/ComfyUI/custom_nodes",
+                'INFERENCE_INPUT_FOLDER': f"{workspace}/ComfyUI/input",
+                'INFERENCE_OUTPUT_FOLDER': f"{workspace}/ComfyUI/output",
+                'NETWORK_STORAGE': f"{workspace}/runpod-volume",
+            }
+            for folder in ['models/checkpoints', 'models/loras', 'models/controlnet', 'custom_nodes/ComfyUI_IPAdapter_plus/models', 'input', 'output']:
+                os.makedirs(f"{workspace}/ComfyUI/{folder}", exist_ok=True)
+            for folder in ['checkpoints', 'loras', 'controlnet', 'ipadapter']:
+                os.makedirs(f"{folders['NETWORK_STORAGE']}/{folder}", exist_ok=True)
+            fake_comfy_command = f"{sys.executable} {os.path.abspath(__file__)} fake-comfy --sampling-seconds {args.sampling_seconds} --steps {args.steps} --image-size {args.image_size} --boot-seconds {args.boot_seconds} --crash-every {args.crash_every}"
+            os.environ.update(folders)
+            os.environ.update({
+                'APP_NAME': 'BENCHMARK',
+                'API_URL': '127.0.0.1',
+                'INITIAL_PORT': str(EndToEndBenchmark.free_port()),
+                'API_COMMAND_LINE': fake_comfy_command,
+                'TEST_PAYLOAD': os.path.abspath(TEST_PAYLOAD),
+                'AWS_REGION_NAME': 'us-east-1',
+                'AWS_S3_ENDPOINT_URL': f"http://127.0.0.1:{s3_port}",
+                'AWS_S3_BUCKET_NAME': 'distillery-benchmark',
+                'AWS_S3_ACCESS_KEY': 'benchmark',
+                'AWS_S3_SECRET_KEY': 'benchmark',
+                'AWS_REQUEST_CHECKSUM_CALCULATION': 'when_required',
+                'AWS_RESPONSE_CHECKSUM_VALIDATION': 'when_required',
+                'LOG_SINK': 'file',
+                'LOG_FILE_PATH': os.path.abspath(args.log_file),
+                'WORKER_TIMEOUT_FOR_INFERENCE': '600',
+                'WORKER_TIMEOUT_FOR_TRAINING': '3600',
+                'MINIMUM_GB_FREE_DISK_SPACE': '0',
+            })
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def build_payload(comfy_api, request_number, args): # Modeled on test_payload.json: a checkpoint from S3, an img2img input image and images_per_batch seeds
+        try:
+            seed = 1000 * (request_number % (args.distinct_requests or args.requests))
+            comfy_api = dict(comfy_api)
+            comfy_api['22'] = dict(comfy_api['22'], inputs=dict(comfy_api['22']['inputs'], noise_seed=seed)) # Real payloads carry the first seed both in template_inputs and in the workflow, at noise_seed_template_paths
+            comfy_api['10'] = dict(comfy_api['10'], inputs=dict(comfy_api['10']['inputs'], ckpt_name='distillery_benchmark_checkpoint.safetensors'))
+            comfy_api['401'] = {'inputs': {'image': 'distillery_benchmark_input.png', 'upload': 'image'}, 'class_type': 'LoadImage'}
+            return {'input': {
+                'request_id': f"benchmark-{request_number}",
+                'request_type': 'inference',
+                'payload_template_key': 'benchmark_txt2img',
+                'images_per_batch': args.images_per_batch,
+                'batch_strategy': args.batch_strategy,
+                'return_timings': True,
+                'result_cache': args.result_cache,
+                'template_inputs': {'NOISE_SEED': seed, 'MODEL_CHECKPOINT_FILENAME': 'distillery_benchmark_checkpoint.safetensors', 'IMG2IMG_IMAGE_FILENAME': 'distillery_benchmark_input.png'},
+                'noise_seed_template_paths': [['22', 'inputs', 'noise_seed']],
+                'comfy_api': comfy_api,
+            }}
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def percentile(values, share):
+        values = sorted(values)
+        return values[min(int(round(share * (len(values) - 1))), len(values) - 1)]
+
+    @classmethod
+    def summarize(cls, results, warm_seconds):
+        try:
+            warm_results = [result for result in results if not result['cold']]
+            stage_seconds = {}
+            for result in warm_results:
+                for stage, totals in result['stages'].items():
+                    stage_seconds.setdefault(stage, []).append(totals['seconds'])
+            latencies = [result['seconds'] for result in warm_results]
+            first_image_latencies = [result['first_image_seconds'] for result in warm_results if 'first_image_seconds' in result]
+            return {
+                'requests': len(results),
+                'errors': sum(1 for result in results if result['error']),
+                'result_cache_hits': sum(1 for result in results if result.get('result_cache') == 'hit'),
+                'cold_request_s': results[0]['seconds'] if results else None,
+                'warm_requests_per_s': round(len(warm_results) / warm_seconds, 3) if warm_seconds else None,
+                'warm_latency_p50_s': round(statistics.median(latencies), 3) if latencies else None,
+                'warm_latency_p99_s': round(cls.percentile(latencies, 0.99), 3) if latencies else None,
+                'warm_first_image_p50_s': round(statistics.median(first_image_latencies), 3) if first_image_latencies else None,
+                'warm_stages': {stage: {'p50_s': round(statistics.median(seconds), 4), 'p99_s': round(cls.percentile(seconds, 0.99), 4)} for stage, seconds in sorted(stage_seconds.items())},
+                'worker_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            }
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def compare(summary, baseline): # Relative change of every numeric figure against a previous summary
+        try:
+            deltas = {}
+            for key, value in summary.items():
+                if isinstance(value, (int, float)) and isinstance(baseline.get(key), (int, float)) and baseline[key]:
+                    deltas[key] = f"{(value - baseline[key]) / baseline[key]:+.1%}"
+            for stage, percentiles in summary['warm_stages'].items():
+                baseline_stage = baseline.get('warm_stages', {}).get(stage, {})
+                if baseline_stage.get('p50_s'):
+                    deltas[f"{stage}.p50_s"] = f"{(percentiles['p50_s'] - baseline_stage['p50_s']) / baseline_stage['p50_s']:+.1%}"
+            return deltas
+        except Exception as e:
+            raise
+
+    @classmethod
+    def run(cls, args):
+        workspace = tempfile.mkdtemp(prefix='distillery_benchmark_')
+        s3_port = cls.free_port()
+        s3_process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'fake-s3', '--port', str(s3_port)])
+        try:
+            cls.wait_for_port(s3_port)
+            cls.setup_environment(workspace, s3_port, args)
+            from distillery_aws import AWSConnector # Imported only now that the environment points at the stand-ins
+            aws_connector = AWSConnector()
+            aws_connector.s3.create_bucket(Bucket=os.environ['AWS_S3_BUCKET_NAME'])
+            checkpoint_path = f"{workspace}/distillery_benchmark_checkpoint.safetensors"
+            with open(checkpoint_path, 'wb') as file:
+                for _ in range(args.model_mb):
+                    file.write(os.urandom(2**20))
+            input_image_path = f"{workspace}/distillery_benchmark_input.png"
+            with open(input_image_path, 'wb') as file:
+                file.write(FakeComfyUI.make_png(512))
+            aws_connector.upload_files([(checkpoint_path, 'distillery_benchmark_checkpoint.safetensors'), (input_image_path, 'distillery_benchmark_input.png')])
+            if args.warm_volume: # As left behind by earlier workers: the checkpoint on network storage, and popular
+                shutil.copyfile(checkpoint_path, f"{os.environ['NETWORK_STORAGE']}/checkpoints/distillery_benchmark_checkpoint.safetensors")
+                with open(f"{os.environ['NETWORK_STORAGE']}/.distillery_model_popularity.json", 'w') as file:
+                    json.dump({'models': {'sd_model': {'distillery_benchmark_checkpoint.safetensors': {'score': 10, 'updated_at': time.time()}}}}, file)
+            os.unlink(checkpoint_path)
+            boot_start_time = time.perf_counter()
+            import distillery_worker # Starts booting the fake ComfyUI in the background, like the real worker does
+            from distillery_comfy import ComfyConnector
+            comfy_connector = ComfyConnector() # Waits for the background boot
+            boot_seconds = time.perf_counter() - boot_start_time
+            with open(TEST_PAYLOAD, 'r') as file:
+                comfy_api = json.load(file)
+            def run_request(request_number):
+                start_time = time.perf_counter()
+                first_image_seconds = None
+                if args.stream:
+                    for stream_event in distillery_worker.stream_handler(cls.build_payload(comfy_api, request_number, args)):
+                        if stream_event['type'] == 'image' and first_image_seconds is None:
+                            first_image_seconds = time.perf_counter() - start_time
+                        result = stream_event
+                else:
+                    result = distillery_worker.handler(cls.build_payload(comfy_api, request_number, args))
+                seconds = time.perf_counter() - start_time
+                error = not isinstance(result, dict) or not isinstance(result.get('output'), list)
+                record = {'request': request_number, 'cold': request_number == 0, 'seconds': round(seconds, 3), 'error': error, 'images': 0 if error else len(result['output']), 'stages': {} if error else result['timings']['stages']}
+                if args.result_cache:
+                    record['result_cache'] = result.get('result_cache')
+                if first_image_seconds is not None:
+                    record['first_image_seconds'] = round(first_image_seconds, 3)
+                print(json.dumps(record))
+                return record
+            results = [run_request(0)] # Cold: the model comes from S3
+            warm_start_time = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor: # As runpod does with MAX_CONCURRENT_REQUESTS, each request on its own thread
+                results += list(executor.map(run_request, range(1, args.requests)))
+            warm_seconds = time.perf_counter() - warm_start_time if args.requests > 1 else None
+            summary = cls.summarize(results, warm_seconds)
+            summary.update({'boot_s': round(boot_seconds, 3), 'log_file': os.environ['LOG_FILE_PATH'], 'settings': {key: value for key, value in vars(args).items() if key not in ('benchmark', 'output', 'baseline')}})
+            comfy_connector = ComfyConnector() # A crash may have replaced the process
+            summary['fake_comfy_peak_rss_mb'] = cls.process_peak_mb(comfy_connector._process.pid) if comfy_connector._process else None
+            comfy_connector.kill_api()
+            ComfyConnector.discard_standby()
+            aws_connector.log_shipper.flush()
+            return summary
+        finally:
+            s3_process.kill()
+            if not args.keep_workspace:
+                shutil.rmtree(workspace, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the Distillery worker")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    png_parser = subparsers.add_parser('png', help="PIL re-encode vs byte-level text chunk injection")
+    png_parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048])
+    png_parser.add_argument('--repetitions', type=int, default=5)
+    provision_parser = subparsers.add_parser('provision', help="Model provisioning strategies from network storage to the local models folder")
+    provision_parser.add_argument('--source-dir', default=os.getenv('NETWORK_STORAGE', '/runpod-volume'))
+    provision_parser.add_argument('--destination-dir', default=os.getenv('MODELS_FOLDER', '/workspace/ComfyUI/models'))
+    provision_parser.add_argument('--size-mb', type=int, default=2048)
+    provision_parser.add_argument('--strategies', nargs='+', default=PROVISIONING_STRATEGIES, choices=PROVISIONING_STRATEGIES)
+    e2e_parser = subparsers.add_parser('e2e', help="Requests through handler against a fake ComfyUI and a local S3 stand-in")
+    e2e_parser.add_argument('--requests', type=int, default=10, help="The first one is cold (model fetched from S3); throughput and percentiles cover the others")
+    e2e_parser.add_argument('--images-per-batch', type=int, default=4)
+    e2e_parser.add_argument('--batch-strategy', default='sequential')
+    e2e_parser.add_argument('--sampling-seconds', type=float, default=0.5, help="Simulated sampler time per prompt")
+    e2e_parser.add_argument('--steps', type=int, default=20)
+    e2e_parser.add_argument('--image-size', type=int, default=1024)
+    e2e_parser.add_argument('--model-mb', type=int, default=256)
+    e2e_parser.add_argument('--boot-seconds', type=float, default=0, help="Simulated ComfyUI import and custom node loading time")
+    e2e_parser.add_argument('--crash-every', type=int, default=0, help="Make the fake ComfyUI die during every n-th prompt, to measure recovery (e.g. with COMFY_HOT_STANDBY=true)")
+    e2e_parser.add_argument('--warm-volume', action='store_true', help="Start with the checkpoint on network storage and in the popularity table, so the boot prefetch can pick it up")
+    e2e_parser.add_argument('--result-cache', action='store_true', help="Opt the requests into the result cache")
+    e2e_parser.add_argument('--distinct-requests', type=int, default=0, help="Cycle through this many different seeds, so later requests repeat earlier ones (default: all different)")
+    e2e_parser.add_argument('--concurrency', type=int, default=1, help="Warm requests handled at the same time, sharing the fake ComfyUI")
+    e2e_parser.add_argument('--stream', action='store_true', help="Drive stream_handler instead of handler and report the time to the first uploaded image")
+    e2e_parser.add_argument('--output', help="Write the summary to this file, to use as a later --baseline")
+    e2e_parser.add_argument('--baseline', help="Summary of a previous run to compare against")
+    e2e_parser.add_argument('--log-file', default='distillery_benchmark_logs.jsonl', help="Where print_log records go, through the file log sink")
+    e2e_parser.add_argument('--keep-workspace', action='store_true')
+    fake_comfy_parser = subparsers.add_parser('fake-comfy', help="Serve the fake ComfyUI API (started by the worker through API_COMMAND_LINE)")
+    fake_comfy_parser.add_argument('--port', type=int, required=True)
+    fake_comfy_parser.add_argument('--sampling-seconds', type=float, default=0.5)
+    fake_comfy_parser.add_argument('--steps', type=int, default=20)
+    fake_comfy_parser.add_argument('--image-size', type=int, default=1024)
+    fake_comfy_parser.add_argument('--boot-seconds', type=float, default=0)
+    fake_comfy_parser.add_argument('--crash-every', type=int, default=0)
+    fake_comfy_parser.add_argument('--no-websocket-output', action='store_true', help="Pretend SaveImageWebsocket is not installed")
+    fake_s3_parser = subparsers.add_parser('fake-s3', help="Serve the in-memory S3 stand-in")
+    fake_s3_parser.add_argument('--port', type=int, required=True)
+    args = parser.parse_args()
+    if args.benchmark == 'png':
+        for result in PngMetadataBenchmark.run(args.sizes, args.repetitions):
+            print(json.dumps(result))
+    elif args.benchmark == 'provision':
+        for result in ProvisioningBenchmark.run(args.source_dir, args.destination_dir, args.size_mb, args.strategies):
+            print(json.dumps(result))
+    elif args.benchmark == 'e2e':
+        summary = EndToEndBenchmark.run(args)
+        print(json.dumps(summary))
+        if args.baseline:
+            with open(args.baseline, 'r') as file:
+                print(json.dumps({'change_vs_baseline': EndToEndBenchmark.compare(summary, json.load(file))}))
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(summary, file)
+    elif args.benchmark == 'fake-comfy':
+        FakeComfyUI(args.sampling_seconds, args.steps, args.image_size, websocket_output=not args.no_websocket_output, crash_every=args.crash_every).serve(args.port, boot_seconds=args.boot_seconds)
+    elif args.benchmark == 'fake-s3':
+        FakeS3().serve(args.port)
+
+if __name__ == '__main__':
+    main()
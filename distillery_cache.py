@@ -0,0 +1,464 @@
+import os
+import json
+import time
+import threading
+import shutil
+import hashlib
+import uuid
+import atexit
+from distillery_lease import NetworkStorageLease
+
+MODELS_FOLDER = os.getenv("MODELS_FOLDER") # Path to models folder in ComfyUI
+MODEL_CACHE_MANIFEST = os.getenv("MODEL_CACHE_MANIFEST", f"{MODELS_FOLDER}/.distillery_model_cache.json") # Persistent record of access time and size of every cached model
+MODEL_CACHE_MAX_GB = float(os.getenv("MODEL_CACHE_MAX_GB", 60)) # Byte budget (in GB) for models fetched by the worker; pre-installed models are never counted nor evicted
+NETWORK_STORAGE = os.getenv("NETWORK_STORAGE") # Path to network storage mount
+NETWORK_INDEX_RESCAN_SECONDS = int(os.getenv("NETWORK_INDEX_RESCAN_SECONDS", 300)) # Age after which a network storage folder is listed again; misses in between are confirmed with a single stat
+INFERENCE_INPUT_FOLDER = os.getenv("INFERENCE_INPUT_FOLDER") # Path to input folder in ComfyUI
+INPUT_CACHE_SUBFOLDER = 'distillery_cache' # Subfolder of INFERENCE_INPUT_FOLDER holding cached input images; workflows reference them as 'distillery_cache/<name>'
+INPUT_CACHE_FOLDER = f"{INFERENCE_INPUT_FOLDER}/{INPUT_CACHE_SUBFOLDER}"
+INPUT_CACHE_MAX_GB = float(os.getenv("INPUT_CACHE_MAX_GB", 5)) # Byte budget (in GB) for cached input images; 0 disables the input cache
+CACHE_MANIFEST_SAVE_SECONDS = int(os.getenv("CACHE_MANIFEST_SAVE_SECONDS", 30)) # Hits and new files are recorded in memory and written to the cache manifests at most this often; evictions are written right away
+RESULT_CACHE_FOLDER = os.getenv("RESULT_CACHE_FOLDER", f"{NETWORK_STORAGE}/distillery_result_cache") # One small JSON file per cached result, shared by every worker mounting the volume
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", 86400)) # Age after which a cached result is regenerated; keep it below the S3 lifecycle of the output images
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 100000)) # Oldest results beyond this are deleted; 0 disables the result cache
+RESULT_CACHE_PRUNE_EVERY = 100 # Stores between two prunes; listing the folder over the network filesystem is not free
+MODEL_POPULARITY_FILE = os.getenv("MODEL_POPULARITY_FILE", f"{NETWORK_STORAGE}/.distillery_model_popularity.json") # Request counts per model, shared by every worker mounting the volume
+MODEL_POPULARITY_HALF_LIFE_HOURS = float(os.getenv("MODEL_POPULARITY_HALF_LIFE_HOURS", 72)) # A use counts half as much after this long, so the table follows what is popular now
+MODEL_POPULARITY_FLUSH_SECONDS = int(os.getenv("MODEL_POPULARITY_FLUSH_SECONDS", 60)) # Uses are counted in memory and merged into the shared table at most this often
+MODEL_POPULARITY_MAX_ENTRIES = 2000 # Least popular models beyond this are dropped from the table
+MODEL_POPULARITY_LOCK_ATTEMPTS = 10 # Tries, MODEL_POPULARITY_LOCK_RETRY_SECONDS apart, to take the table's lock before leaving the flush to the next request
+MODEL_POPULARITY_LOCK_RETRY_SECONDS = 0.2
+
+class FileCache: # LRU bookkeeping shared by the caches below: a persistent manifest of size and last access per file, per-category hit/miss counters and pins
+    manifest_path = None
+    max_gb = 0
+    _init_lock = threading.Lock() # Shared by the subclasses; each still gets its own _instance
+
+    def __new__(cls):
+        try:
+            if cls._instance is None:
+                with cls._init_lock:
+                    if cls._instance is None:
+                        instance = super().__new__(cls)
+                        instance.lock = threading.RLock()
+                        instance.max_bytes = int(cls.max_gb * 2**30)
+                        instance.pins = {} # file path => number of in-flight requests using it
+                        instance.dirty = False # In-memory entries or stats not written to the manifest yet
+                        instance.last_save = time.time()
+                        instance.load_manifest()
+                        atexit.register(instance.flush_manifest, force=True)
+                        cls._instance = instance # Published only once fully set up, since the boot and prefetch threads use the caches too
+            return cls._instance
+        except Exception as e:
+            raise
+
+    def load_manifest(self):
+        try:
+            self.entries = {} # file path => {'category', 'size', 'last_access'}
+            self.stats = {} # category => {'hits', 'misses'}
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, 'r') as file:
+                    manifest = json.load(file)
+                self.entries = {path: entry for path, entry in manifest.get('entries', {}).items() if os.path.exists(path)} # Drop entries whose file disappeared while the worker was down
+                self.stats = manifest.get('stats', {})
+        except (ValueError, OSError) as e:
+            print(f"DISTILLERYPRINT: Cache manifest at {self.manifest_path} is unreadable, starting from scratch. Exception: {e}")
+            self.entries = {}
+            self.stats = {}
+
+    def save_manifest(self):
+        try:
+            with self.lock:
+                os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+                temporary_path = f"{self.manifest_path}.tmp"
+                with open(temporary_path, 'w') as file:
+                    json.dump({'entries': self.entries, 'stats': self.stats}, file)
+                os.replace(temporary_path, self.manifest_path) # Atomic, so a crash never leaves a truncated manifest behind
+                self.dirty = False
+                self.last_save = time.time()
+        except Exception as e:
+            raise
+
+    def flush_manifest(self, force=False): # Writes pending changes if CACHE_MANIFEST_SAVE_SECONDS passed since the last write; a crash loses at most that much access history
+        try:
+            with self.lock:
+                if self.dirty and (force or time.time() - self.last_save >= CACHE_MANIFEST_SAVE_SECONDS):
+                    self.save_manifest()
+        except Exception as e:
+            raise
+
+    def record_hit(self, category, file_path):
+        try:
+            with self.lock:
+                self.stats.setdefault(category, {'hits': 0, 'misses': 0})['hits'] += 1
+                if file_path in self.entries:
+                    self.entries[file_path]['last_access'] = time.time()
+                self.dirty = True
+                self.flush_manifest()
+        except Exception as e:
+            raise
+
+    def record_miss(self, category, file_path): # Called once the missing file has been fetched; from now on the file is managed (and evictable) by the cache
+        try:
+            with self.lock:
+                self.stats.setdefault(category, {'hits': 0, 'misses': 0})['misses'] += 1
+                self.track(category, file_path)
+        except Exception as e:
+            raise
+
+    def track(self, category, file_path): # Manages a file fetched ahead of any request (e.g. prefetched at boot) without counting a miss
+        try:
+            with self.lock:
+                self.entries[file_path] = {'category': category, 'size': os.lstat(file_path).st_size, 'last_access': time.time()} # lstat: a symlink into network storage costs no local disk
+                self.dirty = True
+                self.flush_manifest()
+        except Exception as e:
+            raise
+
+    def hit_rates(self):
+        try:
+            with self.lock:
+                return {category: round(counts['hits'] / max(counts['hits'] + counts['misses'], 1), 3) for category, counts in self.stats.items()}
+        except Exception as e:
+            raise
+
+    def pin(self, file_paths):
+        try:
+            with self.lock:
+                for file_path in file_paths:
+                    self.pins[file_path] = self.pins.get(file_path, 0) + 1
+        except Exception as e:
+            raise
+
+    def unpin(self, file_paths):
+        try:
+            with self.lock:
+                for file_path in file_paths:
+                    if self.pins.get(file_path, 0) <= 1:
+                        self.pins.pop(file_path, None)
+                    else:
+                        self.pins[file_path] -= 1
+        except Exception as e:
+            raise
+
+    def cached_bytes(self):
+        try:
+            with self.lock:
+                return sum(entry['size'] for entry in self.entries.values())
+        except Exception as e:
+            raise
+
+    def evict(self, minimum_free_bytes=0, disk_path=None): # Deletes least recently used, unpinned files until the byte budget is met and the disk holding disk_path (by default, the cache's own folder) has minimum_free_bytes free
+        try:
+            disk_path = disk_path or os.path.dirname(self.manifest_path)
+            evicted = []
+            with self.lock:
+                total_bytes = self.cached_bytes()
+                for file_path, entry in sorted(self.entries.items(), key=lambda item: item[1]['last_access']):
+                    if total_bytes <= self.max_bytes and shutil.disk_usage(disk_path).free >= minimum_free_bytes:
+                        break
+                    if self.pins.get(file_path):
+                        continue
+                    try:
+                        os.unlink(file_path)
+                    except FileNotFoundError:
+                        pass
+                    self.forget(file_path)
+                    total_bytes -= entry['size']
+                    evicted.append(file_path)
+                for file_path in evicted:
+                    del self.entries[file_path]
+                if evicted:
+                    self.save_manifest()
+                else:
+                    self.flush_manifest()
+            return evicted
+        except Exception as e:
+            raise
+
+    def forget(self, file_path): # Called for every evicted file, after it has been deleted
+        pass
+
+class ModelCache(FileCache): # Checkpoints, LoRAs, ControlNet and IPAdapter models fetched by get_models_from_storage; categories are model types
+    _instance = None
+    manifest_path = MODEL_CACHE_MANIFEST
+    max_gb = MODEL_CACHE_MAX_GB
+
+    def forget(self, file_path):
+        ModelIndex().discard(os.path.dirname(file_path), os.path.basename(file_path))
+
+class InputCache(FileCache): # Input images, content-addressed by S3 key and ETag so a re-uploaded key is never served stale
+    _instance = None
+    manifest_path = f"{INPUT_CACHE_FOLDER}/.manifest.json"
+    max_gb = INPUT_CACHE_MAX_GB
+
+    @staticmethod
+    def entry_name(s3_key, etag):
+        _, extension = os.path.splitext(s3_key)
+        return hashlib.sha256(f"{s3_key}\0{etag}".encode('utf-8')).hexdigest()[:32] + extension.lower()
+
+    def enabled(self):
+        return self.max_bytes > 0
+
+class ModelIndex: # In-memory listing of the local model folders and their network storage counterparts, so presence checks don't list directories per request
+    _instance = None
+    _init_lock = threading.Lock()
+
+    def __new__(cls):
+        try:
+            if cls._instance is None:
+                with cls._init_lock:
+                    if cls._instance is None:
+                        instance = super().__new__(cls)
+                        instance.lock = threading.RLock()
+                        instance.folders = {} # normalized folder path => {'files': set of file names, 'mtime': folder mtime_ns at scan, 'scanned_at': time of scan}
+                        instance.network_root = os.path.normpath(NETWORK_STORAGE) if NETWORK_STORAGE else None
+                        cls._instance = instance
+            return cls._instance
+        except Exception as e:
+            raise
+
+    def is_network_folder(self, folder):
+        return self.network_root is not None and (folder == self.network_root or folder.startswith(self.network_root + os.sep))
+
+    def scan(self, folder): # Full listing of one folder; folder must be normalized
+        try:
+            try:
+                mtime = os.stat(folder).st_mtime_ns
+                with os.scandir(folder) as entries:
+                    files = {entry.name for entry in entries if not entry.is_dir()}
+            except FileNotFoundError:
+                mtime, files = None, set()
+            with self.lock:
+                self.folders[folder] = {'files': files, 'mtime': mtime, 'scanned_at': time.time()}
+        except Exception as e:
+            raise
+
+    def build(self, folders): # Called once at startup, off the request path
+        try:
+            for folder in folders:
+                self.scan(os.path.normpath(folder))
+        except Exception as e:
+            raise
+
+    def refresh_if_stale(self, folder):
+        try:
+            with self.lock:
+                indexed_folder = self.folders.get(folder)
+            if indexed_folder is None:
+                return self.scan(folder)
+            if self.is_network_folder(folder): # Directory mtimes are unreliable over the network filesystem, so rescan periodically
+                if time.time() - indexed_folder['scanned_at'] > NETWORK_INDEX_RESCAN_SECONDS:
+                    self.scan(folder)
+            else: # Locally, a single stat tells whether any file was added or removed since the last scan
+                try:
+                    mtime = os.stat(folder).st_mtime_ns
+                except FileNotFoundError:
+                    mtime = None
+                if mtime != indexed_folder['mtime']:
+                    self.scan(folder)
+        except Exception as e:
+            raise
+
+    def contains(self, folder, file_name):
+        try:
+            folder = os.path.normpath(folder)
+            self.refresh_if_stale(folder)
+            with self.lock:
+                if file_name in self.folders[folder]['files']:
+                    return True
+            if self.is_network_folder(folder) and os.path.exists(os.path.join(folder, file_name)): # Another worker may have added it since the last rescan
+                self.add(folder, file_name)
+                return True
+            return False
+        except Exception as e:
+            raise
+
+    def add(self, folder, file_name): # Called by our own downloads and copies
+        try:
+            with self.lock:
+                self.folders.setdefault(os.path.normpath(folder), {'files': set(), 'mtime': None, 'scanned_at': 0})['files'].add(file_name)
+        except Exception as e:
+            raise
+
+    def discard(self, folder, file_name): # Called by our own evictions
+        try:
+            with self.lock:
+                indexed_folder = self.folders.get(os.path.normpath(folder))
+                if indexed_folder is not None:
+                    indexed_folder['files'].discard(file_name)
+        except Exception as e:
+            raise
+
+class ModelPopularity: # Exponentially decayed use counts per model, in one JSON file on the network volume; each worker merges its own counts in under a lock file
+    _instance = None
+    _init_lock = threading.Lock()
+
+    def __new__(cls):
+        try:
+            if cls._instance is None:
+                with cls._init_lock:
+                    if cls._instance is None:
+                        instance = super().__new__(cls)
+                        instance.lock = threading.Lock()
+                        instance.pending = {} # (model_type, model_filename) => uses not merged into the table yet
+                        instance.last_flush = 0
+                        cls._instance = instance
+            return cls._instance
+        except Exception as e:
+            raise
+
+    def enabled(self): # The table lives on the network volume; without one there is nothing to record into
+        return bool(NETWORK_STORAGE) and os.path.isdir(NETWORK_STORAGE)
+
+    @staticmethod
+    def decayed(score, updated_at, now):
+        return score * 0.5 ** ((now - updated_at) / (MODEL_POPULARITY_HALF_LIFE_HOURS * 3600))
+
+    def record(self, models): # models: (model_type, model_filename) pairs used by one request
+        try:
+            with self.lock:
+                for model in models:
+                    self.pending[model] = self.pending.get(model, 0) + 1
+        except Exception as e:
+            raise
+
+    def load(self): # {model_type: {model_filename: {'score', 'updated_at'}}}
+        try:
+            with open(MODEL_POPULARITY_FILE, 'r') as file:
+                return json.load(file).get('models', {})
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def flush(self, force=False): # Runs off the request path; when the lock is busy, the counts wait for the next flush
+        try:
+            with self.lock:
+                if not self.pending or (not force and time.time() - self.last_flush < MODEL_POPULARITY_FLUSH_SECONDS):
+                    return
+                pending, self.pending = self.pending, {}
+                self.last_flush = time.time()
+            lease = NetworkStorageLease(MODEL_POPULARITY_FILE)
+            for attempt in range(MODEL_POPULARITY_LOCK_ATTEMPTS):
+                if lease.try_acquire() or (lease.break_if_stale() and lease.try_acquire()):
+                    break
+                time.sleep(MODEL_POPULARITY_LOCK_RETRY_SECONDS)
+            else:
+                self.record([model for model, uses in pending.items() for _ in range(uses)])
+                return
+            try:
+                table = self.load()
+                now = time.time()
+                for (model_type, model_filename), uses in pending.items():
+                    entry = table.setdefault(model_type, {}).get(model_filename, {'score': 0, 'updated_at': now})
+                    table[model_type][model_filename] = {'score': self.decayed(entry['score'], entry['updated_at'], now) + uses, 'updated_at': now}
+                ranked = sorted(((self.decayed(entry['score'], entry['updated_at'], now), model_type, model_filename) for model_type, models in table.items() for model_filename, entry in models.items()), reverse=True)
+                for score, model_type, model_filename in ranked[MODEL_POPULARITY_MAX_ENTRIES:]:
+                    del table[model_type][model_filename]
+                temporary_path = f"{MODEL_POPULARITY_FILE}.{lease.owner}.tmp"
+                with open(temporary_path, 'w') as file:
+                    json.dump({'models': table}, file)
+                os.replace(temporary_path, MODEL_POPULARITY_FILE)
+            finally:
+                lease.release()
+        except Exception as e:
+            raise
+
+    def top(self, model_types, limit): # The limit most popular models of these types right now, as (model_type, model_filename, score), most popular first
+        try:
+            now = time.time()
+            ranked = sorted(((self.decayed(entry['score'], entry['updated_at'], now), model_type, model_filename) for model_type, models in self.load().items() if model_type in model_types for model_filename, entry in models.items()), reverse=True)
+            return [(model_type, model_filename, round(score, 2)) for score, model_type, model_filename in ranked[:limit]]
+        except Exception as e:
+            raise
+
+class ResultCache: # Output S3 keys of finished requests, by a hash of everything that determines the images; lets a retried or re-dispatched request skip the GPU
+    _instance = None
+    _init_lock = threading.Lock()
+
+    def __new__(cls):
+        try:
+            if cls._instance is None:
+                with cls._init_lock:
+                    if cls._instance is None:
+                        instance = super().__new__(cls)
+                        instance.lock = threading.Lock()
+                        instance.stores = 0
+                        cls._instance = instance
+            return cls._instance
+        except Exception as e:
+            raise
+
+    def enabled(self):
+        return RESULT_CACHE_MAX_ENTRIES > 0 and bool(NETWORK_STORAGE) and os.path.isdir(NETWORK_STORAGE)
+
+    @staticmethod
+    def request_key(parts): # parts: a JSON-serializable description of the request; keys are sorted so dict order doesn't matter
+        try:
+            return hashlib.sha256(json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')).hexdigest()
+        except Exception as e:
+            raise
+
+    def entry_path(self, key):
+        return os.path.join(RESULT_CACHE_FOLDER, f"{key}.json")
+
+    def get(self, key): # Returns the cached files, or None when there are none or they expired
+        try:
+            entry_path = self.entry_path(key)
+            try:
+                with open(entry_path, 'r') as file:
+                    entry = json.load(file)
+            except (FileNotFoundError, ValueError):
+                return None
+            if time.time() - entry.get('created_at', 0) > RESULT_CACHE_TTL_SECONDS:
+                self.discard(key)
+                return None
+            return entry['files']
+        except Exception as e:
+            raise
+
+    def put(self, key, files, request_id):
+        try:
+            os.makedirs(RESULT_CACHE_FOLDER, exist_ok=True)
+            entry_path = self.entry_path(key)
+            temporary_path = f"{entry_path}.{uuid.uuid4().hex[:8]}.tmp"
+            with open(temporary_path, 'w') as file:
+                json.dump({'files': files, 'created_at': time.time(), 'request_id': request_id}, file)
+            os.replace(temporary_path, entry_path) # Atomic, so another worker never reads half an entry
+            with self.lock:
+                self.stores += 1
+                prune = self.stores % RESULT_CACHE_PRUNE_EVERY == 1
+            if prune:
+                self.prune()
+        except Exception as e:
+            raise
+
+    def discard(self, key):
+        try:
+            os.unlink(self.entry_path(key))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            raise
+
+    def prune(self): # Deletes expired entries, then the oldest ones beyond RESULT_CACHE_MAX_ENTRIES; several workers pruning at once only race to delete the same files
+        try:
+            entries = []
+            with os.scandir(RESULT_CACHE_FOLDER) as scanned_entries:
+                for entry in scanned_entries:
+                    if entry.name.endswith('.json'):
+                        try:
+                            entries.append((entry.stat().st_mtime, entry.path))
+                        except FileNotFoundError:
+                            pass
+            entries.sort()
+            expired = [path for mtime, path in entries if time.time() - mtime > RESULT_CACHE_TTL_SECONDS]
+            surplus = [path for mtime, path in entries[len(expired):len(entries) - RESULT_CACHE_MAX_ENTRIES]] if len(entries) - len(expired) > RESULT_CACHE_MAX_ENTRIES else []
+            for path in expired + surplus:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            if expired or surplus:
+                print(f"DISTILLERYPRINT: Result cache pruned: {len(expired)} expired and {len(surplus)} oldest entries deleted.")
+        except Exception as e:
+            raise
@@ -2,6 +2,7 @@ import uuid
 import json
 import urllib.request
 import urllib.parse
+import urllib.error
 from PIL import Image
 from websocket import WebSocket # note: websocket-client (https://github.com/websocket-client/websocket-client)
 import io
@@ -12,48 +13,92 @@ import subprocess
 import tempfile
 from typing import List
 from distillery_aws import AWSConnector
+from distillery_cache import InputCache, INPUT_CACHE_FOLDER, INPUT_CACHE_SUBFOLDER
 import random
+import threading
+import queue
+from collections import OrderedDict
+import distillery_trace
 
 APP_NAME = os.getenv('APP_NAME') # Name of the application
 API_COMMAND_LINE = os.getenv('API_COMMAND_LINE') # Command line to start the API server, e.g. "python3 ComfyUI/main.py"; warning: do not add parameter --port as it will be passed later
 API_URL = os.getenv('API_URL')  # URL of the API server (warning: do not add the port number to the URL as it will be passed later)
 INITIAL_PORT = int(os.getenv('INITIAL_PORT')) # Initial port to use when starting the API server; may be changed if the port is already in use
 INSTANCE_IDENTIFIER = APP_NAME+'-'+str(uuid.uuid4()) # Unique identifier for this instance of the worker
-MAX_COMFY_START_ATTEMPTS = 20  # Set this to the maximum number of attempts you want
+COMFY_STARTUP_TIMEOUT = int(os.getenv('COMFY_STARTUP_TIMEOUT', 180)) # Seconds to wait for a freshly started API server to pass the readiness probe
+COMFY_PROBE_INTERVAL = 0.25 # Seconds between two readiness probes during startup
+COMFY_WARMUP = os.getenv('COMFY_WARMUP', 'true').lower() == 'true' # Run TEST_PAYLOAD once after startup so the first real request finds the checkpoint loaded
 MAX_SEED_INT=2147483647 # 2^31-1 to avoid overflow issues
+STREAM_IMAGES_OVER_WEBSOCKET = os.getenv('STREAM_IMAGES_OVER_WEBSOCKET', 'false').lower() == 'true' # Swap SaveImage for SaveImageWebsocket so images arrive as binary websocket frames and never touch ComfyUI/output
+COMFY_INPUT_STAGING = os.getenv('COMFY_INPUT_STAGING', 'filesystem') # 'filesystem' writes input images straight into INFERENCE_INPUT_FOLDER; 'http' posts them to /upload/image, for a ComfyUI that doesn't share our disk
+INFERENCE_INPUT_FOLDER = os.getenv("INFERENCE_INPUT_FOLDER") # Path to input folder in ComfyUI
+OUTPUT_NODE_CLASS = 'SaveImage'
+ROUTED_MESSAGE_TYPES = ('execution_start', 'execution_cached', 'executing', 'progress', 'executed', 'execution_success', 'execution_error', 'execution_interrupted') # Websocket messages about a prompt; the others (status, crystools stats...) are dropped
+COMFY_HOT_STANDBY = os.getenv('COMFY_HOT_STANDBY', 'false').lower() == 'true' # Keep a second, booted ComfyUI on another port; when the active one has to be killed, the standby takes over at once
+COMFY_STANDBY_WARMUP = os.getenv('COMFY_STANDBY_WARMUP', 'false').lower() == 'true' # Also run TEST_PAYLOAD on the standby, so it holds the test checkpoint too; costs a second copy of the model in VRAM
+UNCLAIMED_PROMPTS_KEPT = 64 # Prompts whose messages are held until their waiter registers; a prompt can start before queue_prompt even returned its id
+WEBSOCKET_OUTPUT_NODE_CLASS = 'SaveImageWebsocket' # ComfyUI/custom_nodes/websocket_image_save.py
 
 TEST_PAYLOAD = json.load(open(os.getenv('TEST_PAYLOAD'))) # The TEST_PAYLOAD is a JSON object that contains a prompt that will be used to test if the API server is running
 TEST_PAYLOAD["22"]["noise_seed"] = random.randint(0, MAX_SEED_INT) # Set a random noise seed for the test prompt
 
+class ComfyWorkflowError(RuntimeError): # ComfyUI rejected or failed to execute a prompt, but is itself fine
+    pass
+
+class ComfyConnectionError(RuntimeError): # Lost the connection to ComfyUI; the process may have crashed
+    pass
+
 class ComfyConnector:
     _instance = None
     _process = None
+    _init_lock = threading.Lock() # The worker boots ComfyUI in the background; a request arriving meanwhile waits for that boot instead of starting another one
+    _new_lock = threading.Lock() # Guards _instance itself; separate from _init_lock, which __init__ holds for the whole boot
+    _standby = None # ComfyStandby being booted or ready, with COMFY_HOT_STANDBY
+    _standby_lock = threading.Lock()
+    _reserved_ports = set() # Ports of processes that are starting and don't answer yet
 
     def __new__(cls, *args, **kwargs):
         try:
             if cls._instance is None:
-                cls._instance = super(ComfyConnector, cls).__new__(cls)
+                with cls._new_lock:
+                    if cls._instance is None: # Two callers (the background boot and a request, or two retries after cleanup) must get the same object, or each would start its own ComfyUI
+                        cls._instance = super(ComfyConnector, cls).__new__(cls)
             return cls._instance
         except Exception as e:
             raise
 
     def __init__(self):
         try:
-            if not hasattr(self, 'initialized'):
-                self.urlport = self.find_available_port()
-                self.server_address = f"http://{API_URL}:{self.urlport}"
-                self.client_id = INSTANCE_IDENTIFIER
-                self.ws_address = f"ws://{API_URL}:{self.urlport}/ws?clientId={self.client_id}"
-                self.ws = WebSocket()
-                self.start_api()
-                self.initialized = True
+            with self._init_lock:
+                if not hasattr(self, 'initialized'):
+                    self.promoted_standby = False
+                    if getattr(self, 'urlport', None) is None: # A previous failed boot keeps its port, so its process is reused rather than orphaned
+                        self.promoted_standby = self.promote_standby()
+                        if not self.promoted_standby:
+                            self.urlport = self.find_available_port()
+                    self.server_address = f"http://{API_URL}:{self.urlport}"
+                    self.client_id = INSTANCE_IDENTIFIER
+                    self.ws_address = f"ws://{API_URL}:{self.urlport}/ws?clientId={self.client_id}"
+                    self.ws = WebSocket()
+                    self.listener_lock = threading.Lock() # Guards the websocket connection and the listener thread
+                    self.listener_thread = None
+                    self.routing_lock = threading.Lock() # Guards the two tables below
+                    self.prompt_queues = {} # prompt_id => queue of the request waiting for it
+                    self.unclaimed_messages = OrderedDict() # prompt_id => messages received before its waiter registered
+                    self.start_api()
+                    self.initialized = True
+                    self.start_standby()
         except Exception as e:
             raise
 
-    def find_available_port(self): # If the initial port is already in use, this method finds an available port to start the API server on
+    @classmethod
+    def find_available_port(cls): # If the initial port is already in use, this method finds an available port to start the API server on
         try:
             port = INITIAL_PORT
             while True:
+                if port in cls._reserved_ports:
+                    port += 1
+                    continue
                 try:
                     response = requests.get(f'http://{API_URL}:{port}')
                     if response.status_code != 200:
@@ -65,44 +110,118 @@ class ComfyConnector:
         except Exception as e:
             raise
     
-    def start_api(self): # This method is used to start the API server
+    def start_api(self): # This method is used to start the API server; blocks until it passes the readiness probe and, optionally, a warm-up generation
         try:
-            if not self.is_api_running(): # Block execution until the API server is running
-                aws_connector = AWSConnector()
+            aws_connector = AWSConnector()
+            boot_start_time = time.time()
+            boot_timings = {} # Seconds since boot_start_time at which each phase finished
+            if not self.is_api_running():
                 api_command_line = API_COMMAND_LINE + f" --port {self.urlport}" # Add the port to the command line
                 if self._process is None or self._process.poll() is not None: # Check if the process is not running or has terminated for some reason
                     self._process = subprocess.Popen(api_command_line.split())
                     aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"ComfyUI startup began with PID: {self._process.pid} in port {self.urlport}", level='INFO')
-                    attempts = 0
-                    while not self.is_api_running(): # Block execution until the API server is running
-                        if attempts >= MAX_COMFY_START_ATTEMPTS:
-                            aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"API startup procedure failed after {attempts} attempts.", level='ERROR')
-                            raise RuntimeError(f"API startup procedure failed after {attempts} attempts.")
-                        time.sleep(0.75)  # Wait for 1 second before checking again
-                        attempts += 1 # Increment the number of attempts
-                    aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"ComfyUI startup successful after {attempts} attempts with PID: {self._process.pid} in port {self.urlport}", level='INFO')
-                    time.sleep(0.25)  # Wait for 0.25 seconds before returning
-        except Exception as e:
-            raise
-
-    def is_api_running(self): # This method is used to check if the API server is running
-        test_payload = TEST_PAYLOAD
-        try:
-            response = requests.get(self.server_address)
-            if response.status_code == 200: # Check if the API server tells us it's running by returning a 200 status code
-                self.ws.connect(self.ws_address)
-                test_image = self.generate_images(test_payload)
-                if test_image:  # this ensures that the API server is actually running and not just the web server
-                    return True
+                while not self.is_http_up(): # Python imports and custom node loading
+                    self.check_startup(boot_start_time)
+                boot_timings['http_up'] = round(time.time() - boot_start_time, 2)
+                while not self.is_api_running(): # Websocket handshake and prompt queue
+                    self.check_startup(boot_start_time)
+                boot_timings['api_ready'] = round(time.time() - boot_start_time, 2)
+            if COMFY_WARMUP and not self.promoted_standby: # A promoted standby takes requests at once; the first one loads its checkpoint
+                self.warm_up()
+                boot_timings['warm_up'] = round(time.time() - boot_start_time, 2)
+            aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"ComfyUI startup successful with PID: {self._process.pid if self._process else 'N/A'} in port {self.urlport}. Boot timings (seconds since start): {boot_timings}", level='INFO')
+        except Exception as e:
+            raise
+
+    def check_startup(self, boot_start_time): # Called between two probes while the API server boots; fails fast when the process died or the startup timed out
+        try:
+            if self._process is not None and self._process.poll() is not None:
+                raise RuntimeError(f"API process exited with code {self._process.returncode} during startup.")
+            if time.time() - boot_start_time > COMFY_STARTUP_TIMEOUT:
+                AWSConnector().print_log('N/A', INSTANCE_IDENTIFIER, f"API startup procedure failed after {COMFY_STARTUP_TIMEOUT} seconds.", level='ERROR')
+                raise RuntimeError(f"API startup procedure failed after {COMFY_STARTUP_TIMEOUT} seconds.")
+            time.sleep(COMFY_PROBE_INTERVAL)
+        except Exception as e:
+            raise
+
+    def promote_standby(self): # Adopts the standby's process and port; waits for it if it is still booting, which is never slower than starting another process
+        try:
+            with self._standby_lock:
+                standby, ComfyConnector._standby = ComfyConnector._standby, None
+            if standby is None:
+                return False
+            if not standby.wait_until_ready():
+                standby.discard()
+                return False
+            self._process, self.urlport = standby.process, standby.port
+            self._reserved_ports.discard(standby.port)
+            AWSConnector().print_log('N/A', INSTANCE_IDENTIFIER, f"Promoted standby ComfyUI with PID {standby.process.pid} in port {standby.port} to active.", level='INFO')
+            return True
+        except Exception as e:
+            raise
+
+    @classmethod
+    def start_standby(cls): # Boots a new standby in the background, unless one exists already
+        try:
+            if not COMFY_HOT_STANDBY:
+                return
+            with cls._standby_lock:
+                if cls._standby is None:
+                    cls._standby = ComfyStandby()
+                    threading.Thread(target=cls._standby.boot, daemon=True).start()
+        except Exception as e:
+            raise
+
+    @classmethod
+    def discard_standby(cls):
+        try:
+            with cls._standby_lock:
+                standby, cls._standby = cls._standby, None
+            if standby is not None:
+                standby.discard()
+        except Exception as e:
+            raise
+
+    def is_healthy(self): # Whether ComfyUI survived a failed request: our process is still running and the web server answers
+        try:
+            if self._process is not None and self._process.poll() is not None:
                 return False
+            return self.is_http_up()
+        except Exception as e:
+            return False
+
+    def is_http_up(self): # Liveness: the web server answers
+        try:
+            return requests.get(self.server_address, timeout=2).status_code == 200
         except Exception as e:
             return False
 
-    def kill_api(self): # This method is used to kill the API server
+    def is_api_running(self): # Readiness: web server, websocket handshake and prompt queue all answer; nothing is sampled
         try:
-            if self._process is not None and self._process.poll() is None:
+            if not self.is_http_up():
+                return False
+            if not self.ws.connected:
+                self.ws.connect(self.ws_address, timeout=2)
+                self.ws.settimeout(None) # The handshake timeout must not apply to recv while a prompt is sampling
+            queue = requests.get(f"{self.server_address}/queue", timeout=2).json()
+            return 'queue_running' in queue
+        except Exception as e:
+            return False
+
+    def warm_up(self): # A single test generation; loads the test checkpoint and compiles what ComfyUI compiles lazily
+        try:
+            test_images = self.generate_images(TEST_PAYLOAD)
+            if not test_images:
+                raise RuntimeError("Warm-up generation returned no images.")
+        except Exception as e:
+            raise
+
+    def kill_api(self): # This method is used to kill the API server; a process that already died (e.g. OOM) is cleaned up the same way, so the next ComfyConnector() starts afresh
+        try:
+            if self._process is not None:
                 aws_connector = AWSConnector()
-                self._process.kill()
+                if self._process.poll() is None:
+                    self._process.kill()
                 self._process = None
                 aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"API process killed.", level='INFO')
                 print("DISTILLERYPRINT: API process killed")
@@ -127,7 +246,9 @@ class ComfyConnector:
             self.server_address = None
             self.client_id = None
             # Reset the singleton instance
-            ComfyConnector._instance = None
+            with ComfyConnector._new_lock:
+                if ComfyConnector._instance is self:
+                    ComfyConnector._instance = None
             print("DISTILLERYPRINT: ComfyConnector instance cleaned up")
         except Exception as e:
             raise
@@ -154,41 +275,230 @@ class ComfyConnector:
             data = json.dumps(p).encode('utf-8')
             headers = {'Content-Type': 'application/json'}  # Set Content-Type header
             req = urllib.request.Request(f"{self.server_address}/prompt", data=data, headers=headers)
-            return json.loads(urllib.request.urlopen(req).read())
+            try:
+                return json.loads(urllib.request.urlopen(req).read())
+            except urllib.error.HTTPError as e:
+                if e.code == 400: # Validation failed, e.g. a missing model or a broken link; node_errors says which
+                    raise ComfyWorkflowError(f"ComfyUI rejected the prompt: {e.read().decode('utf-8', 'replace')}") from e
+                raise
         except Exception as e:
             raise
 
-    def generate_images(self, payload): # This method is used to generate images from a prompt and is the main method of this class
+    def ensure_listener(self): # Connects the websocket if needed and makes sure the single thread reading it is running
+        try:
+            with self.listener_lock:
+                if not self.ws.connected: # Check if the WebSocket is connected to the API server and reconnect if necessary
+                    print("DISTILLERYPRINT: WebSocket is not connected. Reconnecting...")
+                    self.ws.connect(self.ws_address)
+                if self.listener_thread is None or not self.listener_thread.is_alive():
+                    self.listener_thread = threading.Thread(target=self.listen, args=(self.ws,), daemon=True)
+                    self.listener_thread.start()
+        except Exception as e:
+            raise
+
+    def listen(self, ws): # Reads every websocket message and routes it, by prompt_id, to the request waiting for that prompt; runs until the connection closes
+        current_prompt_id, current_node = None, None
+        error = None
         try:
-            print(f"DISTILLERYPRINT: Generating images. Payload: {payload}")
-            if not self.ws.connected: # Check if the WebSocket is connected to the API server and reconnect if necessary
-                print("DISTILLERYPRINT: WebSocket is not connected. Reconnecting...")
-                self.ws.connect(self.ws_address)
-            prompt_id = self.queue_prompt(payload)['prompt_id']
             while True:
-                out = self.ws.recv() # Wait for a message from the API server
+                out = ws.recv() # Wait for a message from the API server
                 if isinstance(out, str): # Check if the message is a string
                     message = json.loads(out) # Parse the message as JSON
-                    if message['type'] == 'executing': # Check if the message is an 'executing' message
-                        data = message['data'] # Extract the data from the message
-                        if data['node'] is None and data['prompt_id'] == prompt_id:
-                            break
-            address = self.find_output_node(payload) # Find the SaveImage node; workflow MUST contain only one SaveImage node
-            history = self.get_history(prompt_id)[prompt_id]
-            filenames = eval(f"history['outputs']{address}")['images']  # Extract all images
-            images = []
-            for img_info in filenames:
-                filename = img_info['filename']
-                subfolder = img_info['subfolder']
-                folder_type = img_info['type']
-                image_data = self.get_image(filename, subfolder, folder_type)
-                image_file = io.BytesIO(image_data)
-                image = Image.open(image_file)
-                images.append(image)
-            return images
+                    if message.get('type') not in ROUTED_MESSAGE_TYPES:
+                        continue
+                    data = message.get('data', {}) # Extract the data from the message
+                    if message['type'] in ('execution_start', 'executing'):
+                        current_prompt_id = data.get('prompt_id', current_prompt_id)
+                        current_node = data.get('node') if message['type'] == 'executing' else None
+                    self.route(data.get('prompt_id', current_prompt_id), ('message', message, time.perf_counter())) # Older ComfyUI sends progress without prompt_id; it belongs to the prompt executing
+                elif current_prompt_id is not None: # ComfyUI executes one prompt at a time, so binary frames belong to the one executing
+                    self.route(current_prompt_id, ('binary', out[8:], (current_prompt_id, current_node))) # 4 bytes event type + 4 bytes image format, then the encoded image
+        except Exception as e:
+            error = e
+        finally:
+            with self.routing_lock:
+                for prompt_queue in set(self.prompt_queues.values()):
+                    prompt_queue.put(('closed', error, None))
+
+    def route(self, prompt_id, item):
+        try:
+            if prompt_id is None:
+                return
+            with self.routing_lock:
+                prompt_queue = self.prompt_queues.get(prompt_id)
+                if prompt_queue is not None:
+                    prompt_queue.put(item)
+                    return
+                self.unclaimed_messages.setdefault(prompt_id, []).append(item)
+                while len(self.unclaimed_messages) > UNCLAIMED_PROMPTS_KEPT:
+                    self.unclaimed_messages.popitem(last=False)
         except Exception as e:
             raise
 
+    def claim_prompts(self, prompt_ids, prompt_queue): # From now on, messages about these prompts go to prompt_queue, starting with those that arrived before
+        try:
+            with self.routing_lock:
+                for prompt_id in prompt_ids:
+                    self.prompt_queues[prompt_id] = prompt_queue
+                    for item in self.unclaimed_messages.pop(prompt_id, []):
+                        prompt_queue.put(item)
+                if self.listener_thread is None or not self.listener_thread.is_alive():
+                    prompt_queue.put(('closed', None, None))
+        except Exception as e:
+            raise
+
+    def release_prompts(self, prompt_ids):
+        try:
+            with self.routing_lock:
+                for prompt_id in prompt_ids:
+                    self.prompt_queues.pop(prompt_id, None)
+        except Exception as e:
+            raise
+
+    def wait_for_prompts(self, prompt_ids, stream_node_ids=None, queued_at=None): # Waits on the listener for a set of queued prompts; yields (prompt_id, streamed images) as soon as ComfyUI finishes each one, in completion order. queued_at: prompt_id => perf_counter() taken right before queue_prompt
+        prompt_queue = queue.Queue()
+        self.claim_prompts(prompt_ids, prompt_queue)
+        try:
+            pending_prompt_ids = set(prompt_ids)
+            stream_node_ids = stream_node_ids or {} # prompt_id => ids of its SaveImageWebsocket nodes
+            streamed_images = {prompt_id: [] for prompt_id in prompt_ids}
+            current_prompt_id = None
+            queued_at = queued_at or {} # The listener timestamps messages as they arrive, possibly before queue_prompt returned, so the queue time must be taken before queueing
+            started_at = {} # prompt_id => when ComfyUI started executing it
+            node_started_at, node_reports_progress = None, False
+            while pending_prompt_ids:
+                kind, content, detail = prompt_queue.get()
+                if kind == 'closed':
+                    raise ComfyConnectionError(f"ComfyUI websocket closed while waiting for prompts {sorted(pending_prompt_ids)}: {content}")
+                if kind == 'binary':
+                    prompt_id, node = detail
+                    if prompt_id in pending_prompt_ids and node in stream_node_ids.get(prompt_id, ()): # Binary frames are also used for sampler previews; only frames sent while an output node runs are images
+                        streamed_images[prompt_id].append(content)
+                    continue
+                message, now = content, detail
+                data = message.get('data', {}) # Extract the data from the message
+                prompt_id = data.get('prompt_id', current_prompt_id)
+                if message['type'] in ('execution_start', 'executing') and prompt_id in pending_prompt_ids and prompt_id not in started_at:
+                    started_at[prompt_id] = now
+                    if prompt_id in queued_at:
+                        distillery_trace.record('comfy_queue_wait', max(0.0, now - queued_at[prompt_id]))
+                if message['type'] == 'executing': # Check if the message is an 'executing' message
+                    if node_reports_progress and current_prompt_id in started_at: # The node that just finished sent step progress: it was a sampler
+                        distillery_trace.record('comfy_sampling', now - node_started_at)
+                    current_prompt_id = prompt_id
+                    node_started_at, node_reports_progress = now, False
+                    if data['node'] is None and prompt_id in pending_prompt_ids:
+                        distillery_trace.record('comfy_execution', now - started_at[prompt_id]) # Every node, including model loading and VAE decode
+                        pending_prompt_ids.discard(prompt_id)
+                        yield prompt_id, streamed_images.pop(prompt_id)
+                elif message['type'] == 'progress':
+                    node_reports_progress = True
+                    if prompt_id in pending_prompt_ids:
+                        distillery_trace.emit({'type': 'progress', 'prompt_id': prompt_id, 'node': data.get('node'), 'value': data.get('value'), 'max': data.get('max')})
+                elif message['type'] == 'execution_error' and prompt_id in pending_prompt_ids:
+                    raise ComfyWorkflowError(f"ComfyUI failed to execute prompt {prompt_id} on node {data.get('node_id')} ({data.get('node_type')}): {data.get('exception_message')}")
+        except Exception as e:
+            raise
+        finally:
+            self.release_prompts(prompt_ids)
+
+    def supports_websocket_output(self): # Asks ComfyUI once whether the SaveImageWebsocket node is installed
+        try:
+            if not hasattr(self, 'websocket_output_available'):
+                try:
+                    with urllib.request.urlopen(f"{self.server_address}/object_info/{WEBSOCKET_OUTPUT_NODE_CLASS}") as response:
+                        self.websocket_output_available = WEBSOCKET_OUTPUT_NODE_CLASS in json.loads(response.read())
+                except Exception as e:
+                    self.websocket_output_available = False
+            return self.websocket_output_available
+        except Exception as e:
+            raise
+
+    def prepare_output(self, payload, output_node_id=None): # Returns the payload to queue and the ids of the nodes that will stream their images over the websocket
+        try:
+            output_node_id = output_node_id or self.find_output_node(payload)
+            if STREAM_IMAGES_OVER_WEBSOCKET and output_node_id is not None and self.supports_websocket_output():
+                payload = dict(payload)
+                for node_id, node in payload.items():
+                    if isinstance(node, dict) and node.get('class_type') == OUTPUT_NODE_CLASS:
+                        payload[node_id] = {'inputs': {'images': node['inputs']['images']}, 'class_type': WEBSOCKET_OUTPUT_NODE_CLASS}
+            return payload, {node_id for node_id, node in payload.items() if isinstance(node, dict) and node.get('class_type') == WEBSOCKET_OUTPUT_NODE_CLASS}
+        except Exception as e:
+            raise
+
+    def retrieve_images(self, payload, prompt_id, decode=True, streamed_images=None, output_node_id=None): # Uses the images streamed over the websocket, or reads the SaveImage outputs of a finished prompt from the API server; output_node_id saves the search when the caller already knows it
+        try:
+            with distillery_trace.span('image_retrieval'):
+                if streamed_images:
+                    image_datas = streamed_images
+                else:
+                    node_id = output_node_id or self.find_output_node(payload) # Find the SaveImage node; workflow MUST contain only one SaveImage node
+                    history = self.get_history(prompt_id)[prompt_id]
+                    filenames = history['outputs'][node_id]['images']  # Extract all images
+                    image_datas = [self.get_image(img_info['filename'], img_info['subfolder'], img_info['type']) for img_info in filenames]
+                images = []
+                for image_data in image_datas:
+                    if not decode:
+                        images.append(image_data)
+                        continue
+                    image_file = io.BytesIO(image_data)
+                    image = Image.open(image_file)
+                    images.append(image)
+                return images
+        except Exception as e:
+            raise
+
+    def generate_images(self, payload, decode=True, output_node_id=None): # This method is used to generate images from a prompt and is the main method of this class; decode=False returns the raw bytes served by ComfyUI
+        try:
+            print(f"DISTILLERYPRINT: Generating images. Payload: {payload}")
+            self.ensure_listener()
+            payload, stream_node_ids = self.prepare_output(payload, output_node_id)
+            queued_at = time.perf_counter()
+            prompt_id = self.queue_prompt(payload)['prompt_id']
+            for _, streamed_images in self.wait_for_prompts([prompt_id], {prompt_id: stream_node_ids}, {prompt_id: queued_at}):
+                pass
+            if stream_node_ids and not streamed_images:
+                raise RuntimeError(f"Prompt {prompt_id} finished without streaming any image from nodes {stream_node_ids}")
+            return self.retrieve_images(payload, prompt_id, decode, streamed_images, output_node_id)
+        except Exception as e:
+            raise
+
+    def generate_images_queued(self, payloads, decode=True, output_node_id=None): # Submits every payload to the ComfyUI queue up front, so it never runs empty between them; yields (index, images) as each prompt completes
+        try:
+            print(f"DISTILLERYPRINT: Generating images for {len(payloads)} queued prompts.")
+            self.ensure_listener()
+            prompt_ids = []
+            try:
+                prepared_payloads, stream_node_ids, queued_at = [], {}, {}
+                for payload in payloads: # Connect first and then queue, so no completion message can be missed
+                    payload, payload_stream_node_ids = self.prepare_output(payload, output_node_id)
+                    prompt_queued_at = time.perf_counter()
+                    prompt_id = self.queue_prompt(payload)['prompt_id']
+                    queued_at[prompt_id] = prompt_queued_at
+                    prompt_ids.append(prompt_id)
+                    prepared_payloads.append(payload)
+                    stream_node_ids[prompt_id] = payload_stream_node_ids
+                prompt_indexes = {prompt_id: index for index, prompt_id in enumerate(prompt_ids)}
+                for prompt_id, streamed_images in self.wait_for_prompts(prompt_ids, stream_node_ids, queued_at):
+                    if stream_node_ids[prompt_id] and not streamed_images:
+                        raise RuntimeError(f"Prompt {prompt_id} finished without streaming any image from nodes {stream_node_ids[prompt_id]}")
+                    index = prompt_indexes[prompt_id]
+                    yield index, self.retrieve_images(prepared_payloads[index], prompt_id, decode, streamed_images, output_node_id)
+            except BaseException:
+                self.delete_queued_prompts(prompt_ids) # Don't leave sibling seeds sampling on the GPU for a batch that already failed
+                raise
+        except Exception as e:
+            raise
+
+    def delete_queued_prompts(self, prompt_ids): # Removes prompts that are still waiting in the ComfyUI queue; prompts already running are left alone
+        try:
+            data = json.dumps({"delete": list(prompt_ids)}).encode('utf-8')
+            headers = {'Content-Type': 'application/json'}  # Set Content-Type header
+            req = urllib.request.Request(f"{self.server_address}/queue", data=data, headers=headers)
+            urllib.request.urlopen(req).read()
+        except Exception as e:
+            print(f"DISTILLERYPRINT: Could not delete queued prompts {prompt_ids}. Exception: {e}")
+
     def upload_image(self, filepath, subfolder=None, folder_type=None, overwrite=False):
         try: 
             url = f"{self.server_address}/upload/image"
@@ -205,13 +515,13 @@ class ComfyConnector:
             raise
 
     @staticmethod
-    def find_output_node(json_object): # This method is used to find the node containing the SaveImage class in a prompt
+    def find_output_node(json_object, class_type=OUTPUT_NODE_CLASS): # This method is used to find the node containing the SaveImage class in a prompt
         try:
             for key, value in json_object.items():
                 if isinstance(value, dict):
-                    if value.get("class_type") == "SaveImage":
-                        return f"['{key}']"  # Return the key containing the SaveImage class
-                    result = ComfyConnector.find_output_node(value)
+                    if value.get("class_type") == class_type:
+                        return key  # Return the key containing the SaveImage class
+                    result = ComfyConnector.find_output_node(value, class_type)
                     if result:
                         return result
             return None
@@ -226,8 +536,69 @@ class ComfyConnector:
         except Exception as e:
             raise
 
+    def stage_inputs_from_s3(self, aws_connector, s3_keys: List[str]): # Makes the S3 objects available to ComfyUI as input images; returns {s3_key: image name to use in the workflow}
+        try:
+            s3_keys = list(dict.fromkeys(s3_keys)) # The same image may feed several inputs
+            if not s3_keys:
+                return {}
+            if COMFY_INPUT_STAGING == 'http':
+                return self.upload_from_s3_to_input(aws_connector, s3_keys)
+            input_cache = InputCache()
+            if input_cache.enabled():
+                return self.stage_inputs_from_cache(aws_connector, input_cache, s3_keys)
+            self.download_inputs(aws_connector, [(s3_key, os.path.join(INFERENCE_INPUT_FOLDER, os.path.basename(s3_key))) for s3_key in s3_keys])
+            return {s3_key: os.path.basename(s3_key) for s3_key in s3_keys}
+        except Exception as e:
+            raise
+
+    def stage_inputs_from_cache(self, aws_connector, input_cache, s3_keys): # Only keys whose (key, ETag) is not cached yet are downloaded; the returned names are pinned until the caller unpins them
+        try:
+            image_names = {}
+            missing_files = []
+            etags = aws_connector.get_etags(s3_keys)
+            for s3_key, etag in zip(s3_keys, etags):
+                entry_name = input_cache.entry_name(s3_key, etag)
+                file_path = os.path.join(INPUT_CACHE_FOLDER, entry_name)
+                input_cache.pin([file_path])
+                image_names[s3_key] = f"{INPUT_CACHE_SUBFOLDER}/{entry_name}"
+                if os.path.exists(file_path):
+                    input_cache.record_hit('input_image', file_path)
+                else:
+                    missing_files.append((s3_key, file_path))
+            try:
+                self.download_inputs(aws_connector, missing_files)
+                for s3_key, file_path in missing_files:
+                    input_cache.record_miss('input_image', file_path)
+            except Exception as e:
+                input_cache.unpin([os.path.join(INPUT_CACHE_FOLDER, os.path.basename(image_name)) for image_name in image_names.values()])
+                raise
+            print(f"DISTILLERYPRINT: Input images staged: {len(s3_keys) - len(missing_files)} from cache, {len(missing_files)} from S3. Input cache hit rate: {input_cache.hit_rates().get('input_image')}")
+            return image_names
+        except Exception as e:
+            raise
+
+    def download_inputs(self, aws_connector, files): # files: (s3_key, final path) pairs, downloaded concurrently
+        try:
+            if not files:
+                return
+            temporary_files = []
+            for s3_key, file_path in files:
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                temporary_files.append((s3_key, os.path.join(os.path.dirname(file_path), f".{uuid.uuid4().hex}.part"))) # Hidden and extension-less, so ComfyUI never lists a half-written image
+            try:
+                aws_connector.download_files(temporary_files) # Streamed to disk, all keys at once
+                for (s3_key, temporary_file_path), (_, file_path) in zip(temporary_files, files):
+                    os.replace(temporary_file_path, file_path) # Atomic: ComfyUI sees either the old file or the complete new one
+            finally:
+                for s3_key, temporary_file_path in temporary_files:
+                    if os.path.exists(temporary_file_path):
+                        os.unlink(temporary_file_path)
+        except Exception as e:
+            raise
+
     def upload_from_s3_to_input(self, aws_connector, s3_keys: List[str]):
         try:
+            image_names = {}
             file_objs = aws_connector.download_fileobj(s3_keys) # Download file objects from AWS S3
             for s3_key, file_obj in zip(s3_keys, file_objs): # Iterate through the downloaded file objects and corresponding S3 keys
                 temp_file_path = os.path.join(tempfile.gettempdir(), os.path.basename(s3_key)) # Create a temporary file with the same name as the S3 key
@@ -235,6 +606,77 @@ class ComfyConnector:
                     temp_file.write(file_obj.read())
                 response = self.upload_image(filepath=temp_file_path, folder_type='input') # Upload the temporary file to the Comfy API in the 'input' folder
                 os.unlink(temp_file_path) # Delete the temporary file
+                image_names[s3_key] = f"{response['subfolder']}/{response['name']}" if response.get('subfolder') else response['name'] # ComfyUI renames uploads that collide with a different existing file
+            return image_names
+        except Exception as e:
+            raise
+
+class ComfyStandby: # A second ComfyUI process, booted on another port ahead of time; ComfyConnector promotes it when the active process is killed
+    def __init__(self):
+        try:
+            self.process = None
+            self.port = None
+            self.server_address = None
+            self.ready = threading.Event()
+            self.finished = threading.Event() # Set once boot() returns, ready or not
+        except Exception as e:
+            raise
+
+    def boot(self): # Runs on a background thread
+        try:
+            try:
+                boot_start_time = time.time()
+                self.port = ComfyConnector.find_available_port()
+                ComfyConnector._reserved_ports.add(self.port)
+                self.server_address = f"http://{API_URL}:{self.port}"
+                self.process = subprocess.Popen((API_COMMAND_LINE + f" --port {self.port}").split())
+                while not self.is_api_running():
+                    if self.process.poll() is not None:
+                        raise RuntimeError(f"Standby process exited with code {self.process.returncode} during startup.")
+                    if time.time() - boot_start_time > COMFY_STARTUP_TIMEOUT:
+                        raise RuntimeError(f"Standby startup failed after {COMFY_STARTUP_TIMEOUT} seconds.")
+                    time.sleep(COMFY_PROBE_INTERVAL)
+                if COMFY_STANDBY_WARMUP:
+                    self.warm_up(boot_start_time)
+                self.ready.set()
+                AWSConnector().print_log('N/A', INSTANCE_IDENTIFIER, f"Standby ComfyUI ready with PID {self.process.pid} in port {self.port} after {time.time() - boot_start_time:.2f} seconds.", level='INFO')
+            except Exception as e:
+                AWSConnector().print_log('N/A', INSTANCE_IDENTIFIER, f"Standby ComfyUI failed to boot: {e}", level='WARNING')
+                self.discard()
+            finally:
+                self.finished.set()
         except Exception as e:
             raise
 
+    def is_api_running(self):
+        try:
+            return 'queue_running' in requests.get(f"{self.server_address}/queue", timeout=2).json()
+        except Exception as e:
+            return False
+
+    def warm_up(self, boot_start_time): # Without a websocket: queue TEST_PAYLOAD and poll its history
+        try:
+            data = json.dumps({"prompt": TEST_PAYLOAD, "client_id": f"{INSTANCE_IDENTIFIER}-standby"}).encode('utf-8')
+            req = urllib.request.Request(f"{self.server_address}/prompt", data=data, headers={'Content-Type': 'application/json'})
+            prompt_id = json.loads(urllib.request.urlopen(req).read())['prompt_id']
+            while prompt_id not in requests.get(f"{self.server_address}/history/{prompt_id}", timeout=2).json():
+                if time.time() - boot_start_time > COMFY_STARTUP_TIMEOUT:
+                    raise RuntimeError(f"Standby warm-up did not finish within {COMFY_STARTUP_TIMEOUT} seconds.")
+                time.sleep(COMFY_PROBE_INTERVAL)
+        except Exception as e:
+            raise
+
+    def wait_until_ready(self): # True when the standby can take over
+        try:
+            self.finished.wait(COMFY_STARTUP_TIMEOUT)
+            return self.ready.is_set() and self.process is not None and self.process.poll() is None
+        except Exception as e:
+            raise
+
+    def discard(self):
+        try:
+            if self.process is not None and self.process.poll() is None:
+                self.process.kill()
+            ComfyConnector._reserved_ports.discard(self.port)
+        except Exception as e:
+            raise
@@ -0,0 +1,375 @@
+import io
+import json
+import time
+import uuid
+import queue
+import base64
+import struct
+import hashlib
+import os
+import threading
+import email
+import email.policy
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+from PIL import Image
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+SAMPLER_NODE_CLASSES = ('KSampler', 'KSamplerAdvanced', 'SamplerCustom', 'SamplerCustomAdvanced') # Nodes that report step progress while they run
+LATENT_NODE_CLASSES = ('EmptyLatentImage',)
+
+class FakeComfyUI: # Stand-in for the ComfyUI API server: same HTTP routes and websocket messages, with a configurable sampling latency and image size instead of a GPU
+    def __init__(self, sampling_seconds=1.0, steps=20, image_size=1024, websocket_output=True, crash_every=0):
+        try:
+            self.sampling_seconds = sampling_seconds
+            self.crash_every = crash_every # Exit in the middle of every crash_every-th prompt, like a ComfyUI killed by the OOM killer
+            self.steps = steps
+            self.websocket_output = websocket_output
+            self.image_data = self.make_png(image_size)
+            self.prompts = queue.Queue()
+            self.pending_prompt_ids = []
+            self.running_prompt_id = None
+            self.deleted_prompt_ids = set()
+            self.history = {} # prompt_id => {'outputs': {node_id: {'images': [...]}}}
+            self.images = {} # (folder_type, subfolder, filename) => bytes
+            self.clients = {} # client_id => (socket, send lock)
+            self.lock = threading.Lock()
+            self.prompt_number = 0
+            threading.Thread(target=self.run_prompts, daemon=True).start()
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def make_png(size): # Noise compresses about as badly as a generated image, so the PNG has a realistic size
+        try:
+            noise = Image.effect_noise((size, size), 64)
+            image = Image.merge('RGB', (noise, noise.transpose(Image.Transpose.ROTATE_90), noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+            image_file = io.BytesIO()
+            image.save(image_file, format='PNG', compress_level=4)
+            return image_file.getvalue()
+        except Exception as e:
+            raise
+
+    def queue_prompt(self, prompt, client_id):
+        try:
+            prompt_id = str(uuid.uuid4())
+            with self.lock:
+                self.prompt_number += 1
+                number = self.prompt_number
+                self.pending_prompt_ids.append(prompt_id)
+            self.prompts.put((prompt_id, prompt, client_id))
+            return {'prompt_id': prompt_id, 'number': number, 'node_errors': {}}
+        except Exception as e:
+            raise
+
+    def send(self, client_id, payload, binary=False): # Messages for a client that is not connected are lost, as in ComfyUI
+        try:
+            with self.lock:
+                client = self.clients.get(client_id)
+            if client is None:
+                return
+            connection, send_lock = client
+            data = payload if binary else json.dumps(payload).encode('utf-8')
+            with send_lock:
+                try:
+                    connection.sendall(websocket_frame(data, opcode=0x2 if binary else 0x1))
+                except OSError:
+                    pass
+        except Exception as e:
+            raise
+
+    def run_prompts(self): # A single thread, like the one GPU ComfyUI executes on
+        while True:
+            prompt_id, prompt, client_id = self.prompts.get()
+            with self.lock:
+                self.pending_prompt_ids.remove(prompt_id)
+                if prompt_id in self.deleted_prompt_ids:
+                    continue
+                self.running_prompt_id = prompt_id
+            try:
+                self.execute(prompt_id, prompt, client_id)
+            finally:
+                with self.lock:
+                    self.running_prompt_id = None
+
+    def execute(self, prompt_id, prompt, client_id):
+        try:
+            self.send(client_id, {'type': 'execution_start', 'data': {'prompt_id': prompt_id}})
+            batch_size = next((node['inputs'].get('batch_size', 1) for node in prompt.values() if node.get('class_type') in LATENT_NODE_CLASSES), 1)
+            outputs = {}
+            for node_id, node in prompt.items():
+                self.send(client_id, {'type': 'executing', 'data': {'node': node_id, 'prompt_id': prompt_id}})
+                class_type = node.get('class_type')
+                if class_type in SAMPLER_NODE_CLASSES:
+                    if self.crash_every and self.prompt_number % self.crash_every == 0:
+                        os._exit(1)
+                    for step in range(self.steps):
+                        time.sleep(self.sampling_seconds / self.steps)
+                        self.send(client_id, {'type': 'progress', 'data': {'value': step + 1, 'max': self.steps, 'prompt_id': prompt_id, 'node': node_id}})
+                elif class_type == 'SaveImage':
+                    images = []
+                    for batch_index in range(batch_size):
+                        filename = f"{node['inputs'].get('filename_prefix', 'ComfyUI')}_{prompt_id[:8]}_{batch_index:05}_.png"
+                        with self.lock:
+                            self.images[('output', '', filename)] = self.image_data
+                        images.append({'filename': filename, 'subfolder': '', 'type': 'output'})
+                    outputs[node_id] = {'images': images}
+                elif class_type == 'SaveImageWebsocket':
+                    for batch_index in range(batch_size):
+                        self.send(client_id, struct.pack('>II', 1, 2) + self.image_data, binary=True) # Event type PREVIEW_IMAGE, format PNG
+            with self.lock:
+                self.history[prompt_id] = {'prompt': [0, prompt_id, prompt, {}, list(outputs)], 'outputs': outputs, 'status': {'status_str': 'success', 'completed': True}}
+            self.send(client_id, {'type': 'executing', 'data': {'node': None, 'prompt_id': prompt_id}})
+        except Exception as e:
+            raise
+
+    def queue_state(self):
+        try:
+            with self.lock:
+                return {'queue_running': [[0, self.running_prompt_id]] if self.running_prompt_id else [], 'queue_pending': [[0, prompt_id] for prompt_id in self.pending_prompt_ids]}
+        except Exception as e:
+            raise
+
+    def serve(self, port, host='127.0.0.1', boot_seconds=0):
+        try:
+            time.sleep(boot_seconds) # Python imports, custom nodes
+            fake_comfy = self
+            class Handler(FakeComfyUIRequestHandler):
+                comfy = fake_comfy
+            server = ThreadingHTTPServer((host, port), Handler)
+            server.daemon_threads = True
+            print(f"DISTILLERYPRINT: Fake ComfyUI listening on {host}:{port}")
+            server.serve_forever()
+        except Exception as e:
+            raise
+
+def websocket_frame(data, opcode=0x1): # Server frames are never masked
+    if len(data) < 126:
+        header = struct.pack('>BB', 0x80 | opcode, len(data))
+    elif len(data) < 2**16:
+        header = struct.pack('>BBH', 0x80 | opcode, 126, len(data))
+    else:
+        header = struct.pack('>BBQ', 0x80 | opcode, 127, len(data))
+    return header + data
+
+class JSONRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, and Expect: 100-continue is answered
+
+    def log_message(self, format, *args): # One line per request would drown the benchmark output
+        pass
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def respond(self, status, body=b'', content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+class FakeComfyUIRequestHandler(JSONRequestHandler):
+    comfy = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == '/':
+            return self.respond(200, b'<html>Fake ComfyUI</html>', 'text/html')
+        if url.path == '/ws':
+            return self.serve_websocket(query.get('clientId', ''))
+        if url.path == '/queue':
+            return self.respond(200, self.comfy.queue_state())
+        if url.path.startswith('/history/'):
+            prompt_id = url.path[len('/history/'):]
+            with self.comfy.lock:
+                history = self.comfy.history.get(prompt_id)
+            return self.respond(200, {prompt_id: history} if history else {})
+        if url.path == '/view':
+            with self.comfy.lock:
+                image_data = self.comfy.images.get((query.get('type', 'output'), query.get('subfolder', ''), query.get('filename')))
+            if image_data is None:
+                return self.respond(404, {'error': 'not found'})
+            return self.respond(200, image_data, 'image/png')
+        if url.path.startswith('/object_info/'):
+            class_type = url.path[len('/object_info/'):]
+            known = class_type != 'SaveImageWebsocket' or self.comfy.websocket_output
+            return self.respond(200, {class_type: {'input': {}, 'output': [], 'name': class_type}} if known else {})
+        return self.respond(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.read_body()
+        if url.path == '/prompt':
+            request = json.loads(body)
+            return self.respond(200, self.comfy.queue_prompt(request['prompt'], request.get('client_id')))
+        if url.path == '/queue':
+            request = json.loads(body)
+            with self.comfy.lock:
+                self.comfy.deleted_prompt_ids.update(request.get('delete', []))
+            return self.respond(200, {})
+        if url.path == '/upload/image':
+            form = email.message_from_bytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('utf-8') + body, policy=email.policy.HTTP)
+            fields, image_name, image_data = {}, None, None
+            for part in form.iter_parts():
+                if part.get_filename():
+                    image_name, image_data = part.get_filename(), part.get_payload(decode=True)
+                else:
+                    fields[part.get_param('name', header='content-disposition')] = part.get_payload(decode=True).decode('utf-8')
+            subfolder, folder_type = fields.get('subfolder', ''), fields.get('type', 'input')
+            with self.comfy.lock:
+                self.comfy.images[(folder_type, subfolder, image_name)] = image_data
+            return self.respond(200, {'name': image_name, 'subfolder': subfolder, 'type': folder_type})
+        return self.respond(404, {'error': 'not found'})
+
+    def serve_websocket(self, client_id): # Handshake, then hold the connection open; messages are pushed by the prompt thread
+        accept = base64.b64encode(hashlib.sha1((self.headers['Sec-WebSocket-Key'] + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+        send_lock = threading.Lock()
+        with self.comfy.lock:
+            self.comfy.clients[client_id] = (self.connection, send_lock)
+        self.comfy.send(client_id, {'type': 'status', 'data': {'status': {'exec_info': {'queue_remaining': len(self.comfy.pending_prompt_ids)}}, 'sid': client_id}})
+        try:
+            while True:
+                header = self.rfile.read(2)
+                if len(header) < 2:
+                    break
+                opcode, length = header[0] & 0x0F, header[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack('>H', self.rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack('>Q', self.rfile.read(8))[0]
+                mask = self.rfile.read(4) if header[1] & 0x80 else None
+                data = self.rfile.read(length)
+                if mask:
+                    data = bytes(byte ^ mask[index % 4] for index, byte in enumerate(data))
+                if opcode == 0x8: # Close
+                    with send_lock:
+                        self.connection.sendall(websocket_frame(data[:2], opcode=0x8))
+                    break
+                if opcode == 0x9: # Ping
+                    with send_lock:
+                        self.connection.sendall(websocket_frame(data, opcode=0xA))
+        except OSError:
+            pass
+        finally:
+            with self.comfy.lock:
+                if self.comfy.clients.get(client_id, (None,))[0] is self.connection:
+                    del self.comfy.clients[client_id]
+            self.close_connection = True
+
+class FakeS3: # In-memory, path-style S3 stand-in: the object and multipart calls boto3's transfer manager makes, without auth
+    def __init__(self):
+        try:
+            self.objects = {} # (bucket, key) => (bytes, etag, last modified)
+            self.uploads = {} # upload_id => {part number: bytes}
+            self.lock = threading.Lock()
+        except Exception as e:
+            raise
+
+    def serve(self, port, host='127.0.0.1'):
+        try:
+            fake_s3 = self
+            class Handler(FakeS3RequestHandler):
+                s3 = fake_s3
+            server = ThreadingHTTPServer((host, port), Handler)
+            server.daemon_threads = True
+            print(f"DISTILLERYPRINT: Fake S3 listening on {host}:{port}")
+            server.serve_forever()
+        except Exception as e:
+            raise
+
+class FakeS3RequestHandler(JSONRequestHandler):
+    s3 = None
+
+    def parse(self):
+        url = urlparse(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        return bucket, unquote(key), {name: values[0] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+
+    def read_object_body(self): # Newer botocore streams uploads as aws-chunked with a trailing checksum
+        body = self.read_body()
+        if 'aws-chunked' not in self.headers.get('Content-Encoding', '') and not self.headers.get('x-amz-content-sha256', '').startswith('STREAMING-'):
+            return body
+        data, position = [], 0
+        while True:
+            line_end = body.index(b'\r\n', position)
+            size = int(body[position:line_end].split(b';')[0], 16)
+            if size == 0:
+                return b''.join(data)
+            data.append(body[line_end + 2:line_end + 2 + size])
+            position = line_end + 2 + size + 2
+
+    def error(self, status, code):
+        return self.respond(status, f"<?xml version=\"1.0\" encoding=\"UTF-8\"?><Error><Code>{code}</Code><Message>{code}</Message></Error>".encode('utf-8'), 'application/xml')
+
+    def do_HEAD(self):
+        return self.do_GET()
+
+    def do_GET(self):
+        bucket, key, query = self.parse()
+        with self.s3.lock:
+            stored = self.s3.objects.get((bucket, key))
+        if stored is None:
+            return self.error(404, 'NoSuchKey')
+        data, etag, last_modified = stored
+        headers = {'ETag': etag, 'Last-Modified': formatdate(last_modified, usegmt=True), 'Accept-Ranges': 'bytes'}
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            start, _, end = range_header[len('bytes='):].partition('-')
+            start, end = int(start), min(int(end) if end else len(data) - 1, len(data) - 1)
+            headers['Content-Range'] = f"bytes {start}-{end}/{len(data)}"
+            return self.respond(206, data[start:end + 1], 'binary/octet-stream', headers)
+        return self.respond(200, data, 'binary/octet-stream', headers)
+
+    def do_PUT(self):
+        bucket, key, query = self.parse()
+        data = self.read_object_body()
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        with self.s3.lock:
+            if 'uploadId' in query:
+                if query['uploadId'] not in self.s3.uploads:
+                    return self.error(404, 'NoSuchUpload')
+                self.s3.uploads[query['uploadId']][int(query['partNumber'])] = data
+            else:
+                self.s3.objects[(bucket, key)] = (data, etag, time.time())
+        return self.respond(200, b'', 'application/xml', {'ETag': etag})
+
+    def do_POST(self):
+        bucket, key, query = self.parse()
+        self.read_body()
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            with self.s3.lock:
+                self.s3.uploads[upload_id] = {}
+            return self.respond(200, f"<?xml version=\"1.0\" encoding=\"UTF-8\"?><InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>".encode('utf-8'), 'application/xml')
+        if 'uploadId' in query:
+            with self.s3.lock:
+                parts = self.s3.uploads.pop(query['uploadId'], None)
+                if parts is None:
+                    return self.error(404, 'NoSuchUpload')
+                data = b''.join(parts[number] for number in sorted(parts))
+                etag = f'"{hashlib.md5(data).hexdigest()}-{len(parts)}"'
+                self.s3.objects[(bucket, key)] = (data, etag, time.time())
+            return self.respond(200, f"<?xml version=\"1.0\" encoding=\"UTF-8\"?><CompleteMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key><ETag>{etag}</ETag></CompleteMultipartUploadResult>".encode('utf-8'), 'application/xml')
+        return self.error(400, 'InvalidRequest')
+
+    def do_DELETE(self):
+        bucket, key, query = self.parse()
+        with self.s3.lock:
+            if 'uploadId' in query:
+                self.s3.uploads.pop(query['uploadId'], None)
+            else:
+                self.s3.objects.pop((bucket, key), None)
+        return self.respond(204)
@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+
+MODEL_LEASE_HEARTBEAT_SECONDS = int(os.getenv("MODEL_LEASE_HEARTBEAT_SECONDS", 10)) # How often the worker holding a lease refreshes its progress marker
+MODEL_LEASE_STALE_SECONDS = int(os.getenv("MODEL_LEASE_STALE_SECONDS", 90)) # A marker not refreshed for this long belongs to a dead worker and may be broken; assumes worker clocks agree within a few seconds
+MODEL_LEASE_WAIT_TIMEOUT = int(os.getenv("MODEL_LEASE_WAIT_TIMEOUT", 120)) # Longest a worker waits on another worker's download before fetching the model itself; keep it well under WORKER_TIMEOUT_FOR_INFERENCE
+MODEL_LEASE_WRITE_BACK_WAIT_SECONDS = int(os.getenv("MODEL_LEASE_WRITE_BACK_WAIT_SECONDS", 30)) # Longest a worker waits while the holder is queued for or copying onto network storage; the copy reports no progress, so past this it counts as stalled
+MODEL_LEASE_WRITE_BACK_STAGES = ('queued_for_network_storage', 'writing_to_network_storage') # The holder already has the model locally; waiters only wait for its copy onto the volume
+MODEL_LEASE_POLL_SECONDS = 1 # Seconds between two looks at the marker while waiting
+
+class NetworkStorageLease: # Single-flight lock on the shared volume: one worker populates target_path while the others wait on its progress marker
+    def __init__(self, target_path):
+        try:
+            self.target_path = target_path
+            self.lock_path = os.path.join(os.path.dirname(target_path), f".{os.path.basename(target_path)}.lock")
+            self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            self.acquired_at = None
+            self.progress = {}
+            self.stop_heartbeat = threading.Event()
+            self.heartbeat_thread = None
+        except Exception as e:
+            raise
+
+    def try_acquire(self): # O_EXCL creation is atomic on the volume, so exactly one worker wins
+        try:
+            try:
+                file_descriptor = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                return False
+            self.acquired_at = time.time()
+            with os.fdopen(file_descriptor, 'w') as file:
+                json.dump(self.marker(), file)
+            return True
+        except Exception as e:
+            raise
+
+    def marker(self):
+        return {'owner': self.owner, 'acquired_at': self.acquired_at, 'heartbeat': time.time(), **self.progress}
+
+    def write_marker(self):
+        try:
+            temporary_path = f"{self.lock_path}.{self.owner}"
+            with open(temporary_path, 'w') as file:
+                json.dump(self.marker(), file)
+            if self.read_marker().get('owner') != self.owner: # Our lease was broken as stale; don't resurrect it
+                os.unlink(temporary_path)
+                return
+            os.replace(temporary_path, self.lock_path)
+        except Exception as e:
+            raise
+
+    def read_marker(self):
+        try:
+            with open(self.lock_path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except ValueError: # Caught mid-write; the mtime still tells whether it is alive
+            return {'heartbeat': os.path.getmtime(self.lock_path)}
+
+    def start_heartbeat(self): # Refreshes the marker, with the latest set_progress values, until release
+        def heartbeat():
+            while not self.stop_heartbeat.wait(MODEL_LEASE_HEARTBEAT_SECONDS):
+                try:
+                    self.write_marker()
+                except Exception as e:
+                    print(f"DISTILLERYPRINT: Could not refresh lease {self.lock_path}. Exception: {e}")
+        try:
+            self.heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+            self.heartbeat_thread.start()
+        except Exception as e:
+            raise
+
+    def set_progress(self, **progress): # e.g. stage='downloading_from_s3', bytes=123; merged into the marker on the next heartbeat
+        self.progress = progress
+
+    def release(self):
+        try:
+            self.stop_heartbeat.set()
+            if self.read_marker().get('owner') == self.owner:
+                os.unlink(self.lock_path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            raise
+
+    def break_if_stale(self): # Renaming first means only one of several waiters breaks the lease
+        try:
+            marker = self.read_marker()
+            if not marker or time.time() - marker.get('heartbeat', 0) <= MODEL_LEASE_STALE_SECONDS:
+                return False
+            stale_path = f"{self.lock_path}.stale-{uuid.uuid4().hex[:8]}"
+            try:
+                os.rename(self.lock_path, stale_path)
+            except FileNotFoundError:
+                return False
+            os.unlink(stale_path)
+            print(f"DISTILLERYPRINT: Broke stale lease {self.lock_path} held by {marker.get('owner')}; last heartbeat {time.time() - marker.get('heartbeat', 0):.0f} seconds ago.")
+            return True
+        except Exception as e:
+            raise
+
+    def wait(self, timeout=MODEL_LEASE_WAIT_TIMEOUT): # Returns 'ready' when the file appeared, 'released' when the lease is free again without it, 'timeout' otherwise (including a write-back that stalled)
+        try:
+            deadline = time.time() + timeout
+            last_report = 0
+            write_back_seen_at = None
+            while time.time() < deadline:
+                if os.path.exists(self.target_path):
+                    return 'ready'
+                marker = self.read_marker()
+                if not marker:
+                    return 'ready' if os.path.exists(self.target_path) else 'released' # The holder renames the file into place before releasing
+                if self.break_if_stale():
+                    return 'released'
+                if marker.get('stage') in MODEL_LEASE_WRITE_BACK_STAGES:
+                    write_back_seen_at = write_back_seen_at or time.time()
+                    if time.time() - write_back_seen_at > MODEL_LEASE_WRITE_BACK_WAIT_SECONDS:
+                        print(f"DISTILLERYPRINT: {marker.get('owner')} has been in stage {marker.get('stage')} for over {MODEL_LEASE_WRITE_BACK_WAIT_SECONDS} seconds; no longer waiting for {self.target_path}.")
+                        return 'timeout'
+                if time.time() - last_report >= MODEL_LEASE_HEARTBEAT_SECONDS:
+                    print(f"DISTILLERYPRINT: Waiting for {marker.get('owner')} to populate {self.target_path}: {({key: value for key, value in marker.items() if key not in ('owner', 'acquired_at')})}")
+                    last_report = time.time()
+                time.sleep(MODEL_LEASE_POLL_SECONDS)
+            return 'timeout'
+        except Exception as e:
+            raise
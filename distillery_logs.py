@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import queue
+import random
+import hashlib
+import datetime
+import threading
+import atexit
+import pytz
+
+LOG_QUEUE_MAX_RECORDS = int(os.getenv('LOG_QUEUE_MAX_RECORDS', 10000)) # Records waiting to be shipped; beyond this, print_log drops instead of blocking inference
+LOG_QUEUE_PRESSURE_RATIO = 0.8 # Above this fill ratio, INFO records are sampled
+LOG_SAMPLE_RATE_UNDER_PRESSURE = float(os.getenv('LOG_SAMPLE_RATE_UNDER_PRESSURE', 0.1)) # Share of INFO records kept while the queue is under pressure; WARNING and ERROR are always kept
+LOG_BATCH_MAX_RECORDS = int(os.getenv('LOG_BATCH_MAX_RECORDS', 500)) # Records per shipment
+LOG_BATCH_MAX_SECONDS = float(os.getenv('LOG_BATCH_MAX_SECONDS', 2)) # Longest a record waits for its batch to fill up
+LOG_MAX_FIELD_BYTES = int(os.getenv('LOG_MAX_FIELD_BYTES', 16384)) # Longer messages (e.g. whole workflows) are cut to this size and tagged with their length and hash
+CLOUDWATCH_MAX_BATCH_BYTES = 1048576 - 65536 # PutLogEvents allows 1 MiB per call, counting 26 bytes of overhead per event; keep a margin
+CLOUDWATCH_EVENT_OVERHEAD_BYTES = 26
+CLOUDWATCH_MAX_EVENT_BYTES = 262144 - CLOUDWATCH_EVENT_OVERHEAD_BYTES - 1024 # A single event above 256 KiB fails the whole PutLogEvents call; keep a margin
+LOG_CORE_FIELDS = ('level', 'context', 'unixtime', 'esttime', 'request_id', 'message', 'script_name', 'function_name', 'line_number', 'hostname') # Set by print_log and encode; structured fields may not overwrite them
+EASTERN_TIMEZONE = pytz.timezone('US/Eastern')
+
+def truncate_field(value, max_bytes=LOG_MAX_FIELD_BYTES): # Keeps the head of an oversized string plus enough to recognize it: total length and content hash
+    try:
+        if not isinstance(value, str) or len(value) <= max_bytes:
+            return value
+        digest = hashlib.sha256(value.encode('utf-8', 'replace')).hexdigest()[:16]
+        return f"{value[:max_bytes]}... [truncated, {len(value)} chars, sha256 {digest}]"
+    except Exception as e:
+        raise
+
+class CloudWatchLogSink:
+    def __init__(self, cloudwatch_client, log_group, log_stream_name):
+        try:
+            self.client = cloudwatch_client
+            self.log_group = log_group
+            self.log_stream_name = log_stream_name
+            self.stream_ready = False
+        except Exception as e:
+            raise
+
+    def ensure_stream(self):
+        try:
+            if not self.stream_ready:
+                try:
+                    self.client.create_log_stream(logGroupName=self.log_group, logStreamName=self.log_stream_name)
+                except self.client.exceptions.ResourceAlreadyExistsException:
+                    pass
+                self.stream_ready = True
+        except Exception as e:
+            raise
+
+    def write(self, encoded_records): # encoded_records: (timestamp in ms, JSON string) pairs, in the order they were enqueued
+        try:
+            self.ensure_stream()
+            batch, batch_bytes = [], 0
+            for timestamp, message in sorted(encoded_records, key=lambda record: record[0]): # PutLogEvents rejects a batch that is not in chronological order; records from different threads may be enqueued a few ms out of order
+                event_bytes = len(message.encode('utf-8')) + CLOUDWATCH_EVENT_OVERHEAD_BYTES
+                if batch and batch_bytes + event_bytes > CLOUDWATCH_MAX_BATCH_BYTES:
+                    self.client.put_log_events(logGroupName=self.log_group, logStreamName=self.log_stream_name, logEvents=batch)
+                    batch, batch_bytes = [], 0
+                batch.append({'timestamp': timestamp, 'message': message})
+                batch_bytes += event_bytes
+            if batch:
+                self.client.put_log_events(logGroupName=self.log_group, logStreamName=self.log_stream_name, logEvents=batch)
+        except Exception as e:
+            raise
+
+class FileLogSink: # Local stand-in for CloudWatch: one JSON record per line, for offline runs and benchmarks
+    def __init__(self, path):
+        try:
+            self.path = path
+        except Exception as e:
+            raise
+
+    def write(self, encoded_records):
+        try:
+            with open(self.path, 'a') as file:
+                file.writelines(f"{message}\n" for timestamp, message in encoded_records)
+        except Exception as e:
+            raise
+
+class LogShipper: # print_log only enqueues a dict; this thread formats, encodes once, and ships in batches
+    def __init__(self, sink):
+        try:
+            self.sink = sink
+            self.records = queue.Queue(maxsize=LOG_QUEUE_MAX_RECORDS)
+            self.dropped_records = 0
+            self.sampled_out_records = 0
+            self.counters_lock = threading.Lock()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+        except Exception as e:
+            raise
+
+    def submit(self, record): # Never blocks: under pressure INFO records are sampled, and a full queue drops INFO or makes room for WARNING/ERROR
+        try:
+            important = record.get('level') in ('WARNING', 'ERROR')
+            if not important and self.records.qsize() >= LOG_QUEUE_MAX_RECORDS * LOG_QUEUE_PRESSURE_RATIO and random.random() >= LOG_SAMPLE_RATE_UNDER_PRESSURE:
+                with self.counters_lock:
+                    self.sampled_out_records += 1
+                return
+            try:
+                self.records.put_nowait(record)
+            except queue.Full:
+                with self.counters_lock:
+                    self.dropped_records += 1
+                if important:
+                    try:
+                        self.records.get_nowait() # The oldest record gives way
+                        self.records.task_done()
+                        self.records.put_nowait(record)
+                    except (queue.Empty, queue.Full):
+                        pass
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def encode(record): # The only place a record is serialized; every field is capped at LOG_MAX_FIELD_BYTES and the whole record at CLOUDWATCH_MAX_EVENT_BYTES
+        try:
+            for key, value in record.items():
+                if isinstance(value, str):
+                    record[key] = truncate_field(value)
+                elif isinstance(value, (dict, list, tuple)):
+                    encoded_value = json.dumps(value, default=str)
+                    if len(encoded_value) > LOG_MAX_FIELD_BYTES: # Structured fields (e.g. timings) stay structured unless they are too big, then they are kept as a truncated JSON string
+                        record[key] = truncate_field(encoded_value)
+            record['esttime'] = datetime.datetime.fromtimestamp(record['unixtime'], EASTERN_TIMEZONE).strftime("%Y-%m-%d %H:%M:%S") # EST timestamp
+            message = json.dumps(record, default=str)
+            message_bytes = len(message.encode('utf-8'))
+            if message_bytes > CLOUDWATCH_MAX_EVENT_BYTES: # Many fields near the cap, or multi-byte characters; keep the core fields only
+                core_record = {key: record[key] for key in LOG_CORE_FIELDS if key in record}
+                core_record['message'] = f"{truncate_field(record['message'], max_bytes=LOG_MAX_FIELD_BYTES // 4)} [record of {message_bytes} bytes cut to its core fields]"
+                message = json.dumps(core_record, default=str)
+            return int(record['unixtime'] * 1000), message
+        except Exception as e:
+            raise
+
+    def counters_record(self): # Reports how much was lost to back-pressure since the previous report
+        try:
+            with self.counters_lock:
+                dropped_records, sampled_out_records = self.dropped_records, self.sampled_out_records
+                self.dropped_records, self.sampled_out_records = 0, 0
+            if not dropped_records and not sampled_out_records:
+                return None
+            return {'level': 'WARNING', 'unixtime': time.time(), 'context': 'log_shipper', 'request_id': 'N/A', 'message': f"Log queue under pressure: {dropped_records} records dropped and {sampled_out_records} INFO records sampled out."}
+        except Exception as e:
+            raise
+
+    def run(self):
+        while True:
+            batch = [self.records.get()]
+            deadline = time.time() + LOG_BATCH_MAX_SECONDS
+            while len(batch) < LOG_BATCH_MAX_RECORDS:
+                try:
+                    batch.append(self.records.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            counters_record = self.counters_record()
+            if counters_record is not None:
+                batch.append(counters_record)
+            try:
+                self.sink.write([self.encode(record) for record in batch])
+            except Exception as e:
+                print(f"DISTILLERYPRINT: Failed to ship {len(batch)} log records. Exception: {e}") # Logging must never take the worker down
+            finally:
+                for _ in range(len(batch) - (counters_record is not None)):
+                    self.records.task_done()
+
+    def flush(self, timeout=5): # Waits, up to timeout seconds, for everything queued so far to be shipped
+        try:
+            deadline = time.time() + timeout
+            while self.records.unfinished_tasks and time.time() < deadline:
+                time.sleep(0.05)
+        except Exception as e:
+            raise
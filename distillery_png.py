@@ -0,0 +1,87 @@
+import struct
+import zlib
+import io
+from PIL import Image, PngImagePlugin
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+TEXT_CHUNK_TYPES = (b'tEXt', b'iTXt', b'zTXt')
+
+class PngMetadata:
+    @staticmethod
+    def is_png(data):
+        return isinstance(data, (bytes, bytearray)) and data[:8] == PNG_SIGNATURE
+
+    @staticmethod
+    def iter_chunks(data): # Yields (chunk_type, start, end) for every chunk; start/end delimit the whole chunk (length, type, data and CRC)
+        try:
+            position = len(PNG_SIGNATURE)
+            while position < len(data):
+                length, chunk_type = struct.unpack('>I4s', data[position:position + 8])
+                end = position + 12 + length
+                if end > len(data):
+                    raise ValueError(f"Truncated PNG chunk {chunk_type} at offset {position}")
+                yield chunk_type, position, end
+                position = end
+                if chunk_type == b'IEND':
+                    break
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def build_text_chunk(keyword, text):
+        try:
+            keyword_bytes = keyword.encode('latin-1')
+            try: # Same choice as PngInfo.add_text: tEXt when the text is latin-1, iTXt (uncompressed UTF-8) otherwise
+                chunk_type = b'tEXt'
+                chunk_data = keyword_bytes + b'\0' + text.encode('latin-1')
+            except UnicodeEncodeError:
+                chunk_type = b'iTXt'
+                chunk_data = keyword_bytes + b'\0\0\0\0\0' + text.encode('utf-8')
+            crc = zlib.crc32(chunk_type + chunk_data) & 0xffffffff
+            return struct.pack('>I', len(chunk_data)) + chunk_type + chunk_data + struct.pack('>I', crc)
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def set_text(data, keyword, text): # Inserts (or replaces) a text chunk straight into the PNG byte stream; pixels are neither decoded nor recompressed
+        try:
+            keyword_prefix = keyword.encode('latin-1') + b'\0'
+            output = [data[:len(PNG_SIGNATURE)]]
+            new_chunk = PngMetadata.build_text_chunk(keyword, text)
+            for chunk_type, start, end in PngMetadata.iter_chunks(data):
+                if chunk_type in TEXT_CHUNK_TYPES and data[start + 8:end - 4].startswith(keyword_prefix):
+                    continue # Drop any previous chunk with the same keyword
+                if chunk_type == b'IDAT' and new_chunk is not None:
+                    output.append(new_chunk) # Text chunks go before the image data, like PIL writes them
+                    new_chunk = None
+                output.append(data[start:end])
+            if new_chunk is not None:
+                raise ValueError("PNG has no IDAT chunk")
+            return b''.join(output)
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def encode_with_pil(image, keyword, text): # Fallback for PIL images and non-PNG outputs: full decode and PNG re-encode
+        try:
+            if not isinstance(image, Image.Image):
+                image = Image.open(io.BytesIO(image))
+            pnginfo = PngImagePlugin.PngInfo()
+            pnginfo.add_text(keyword, text)
+            image_file = io.BytesIO()
+            image.save(image_file, format='PNG', pnginfo=pnginfo)
+            return image_file.getvalue()
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def add_metadata(image, keyword, text): # Returns PNG bytes carrying the text chunk, using the byte-level path whenever the input already is a PNG
+        try:
+            if PngMetadata.is_png(image):
+                try:
+                    return PngMetadata.set_text(bytes(image), keyword, text)
+                except (ValueError, struct.error) as e:
+                    print(f"DISTILLERYPRINT: Malformed PNG stream, falling back to PIL re-encoding. Exception: {e}")
+            return PngMetadata.encode_with_pil(image, keyword, text)
+        except Exception as e:
+            raise
@@ -0,0 +1,111 @@
+import os
+import errno
+import fcntl
+import uuid
+import subprocess
+import time
+
+MODEL_PROVISIONING_DEFAULT = os.getenv("MODEL_PROVISIONING_DEFAULT", "copy") # How models on network storage are made available to ComfyUI: copy, symlink, reflink, copy_file_range or chunked
+MODEL_PROVISIONING = os.getenv("MODEL_PROVISIONING", "") # Per model type overrides, e.g. "sd_model=symlink,lora_model=copy_file_range"
+PROVISIONING_STRATEGIES = ['copy', 'symlink', 'reflink', 'copy_file_range', 'chunked']
+PROVISIONING_CHUNK_SIZE = 64 * 2**20 # Bytes per read/write (chunked) or per copy_file_range call
+PROVISIONING_PROGRESS_EVERY = 2**30 # The chunked copy reports its progress every this many bytes
+FICLONE = 0x40049409 # ioctl from linux/fs.h: share the source extents with the destination (btrfs, XFS with reflink=1, overlayfs on those)
+FALLBACK_ERRNOS = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EBADF) # The filesystem pair can't do it; try the next strategy
+
+class ModelProvisioner:
+    @staticmethod
+    def strategy_for(model_type):
+        try:
+            overrides = dict(item.split('=', 1) for item in MODEL_PROVISIONING.replace(' ', '').split(',') if '=' in item)
+            strategy = overrides.get(model_type, MODEL_PROVISIONING_DEFAULT)
+            if strategy not in PROVISIONING_STRATEGIES:
+                print(f"DISTILLERYPRINT: Unknown provisioning strategy '{strategy}' for {model_type}. Using 'copy'.")
+                return 'copy'
+            return strategy
+        except Exception as e:
+            raise
+
+    @classmethod
+    def provision(cls, source_path, destination_path, strategy='copy'): # Makes source_path available at destination_path; returns the strategy that was actually used
+        try:
+            temporary_path = os.path.join(os.path.dirname(destination_path), f".{uuid.uuid4().hex}.part") # Built aside and renamed, so ComfyUI never sees a partial model
+            try:
+                used_strategy = cls.provision_to(source_path, temporary_path, strategy)
+                os.replace(temporary_path, destination_path)
+                return used_strategy
+            finally:
+                if os.path.lexists(temporary_path):
+                    os.unlink(temporary_path)
+        except Exception as e:
+            raise
+
+    @classmethod
+    def provision_to(cls, source_path, destination_path, strategy):
+        try:
+            if strategy == 'symlink': # No bytes copied; ComfyUI reads straight from the volume and the page cache keeps what it loaded
+                os.symlink(source_path, destination_path)
+                return strategy
+            if strategy == 'copy':
+                subprocess.run(["cp", source_path, destination_path], check=True)
+                return strategy
+            if strategy == 'reflink':
+                try:
+                    cls.reflink(source_path, destination_path)
+                    return strategy
+                except OSError as e:
+                    if e.errno not in FALLBACK_ERRNOS:
+                        raise
+                    strategy = 'copy_file_range'
+            if strategy == 'copy_file_range':
+                try:
+                    cls.copy_file_range(source_path, destination_path)
+                    return strategy
+                except (OSError, AttributeError) as e: # AttributeError: Python < 3.8 or not Linux
+                    if isinstance(e, OSError) and e.errno not in FALLBACK_ERRNOS:
+                        raise
+            cls.chunked_copy(source_path, destination_path)
+            return 'chunked'
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def reflink(source_path, destination_path):
+        try:
+            with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+                fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        except Exception as e:
+            if os.path.exists(destination_path):
+                os.unlink(destination_path)
+            raise
+
+    @staticmethod
+    def copy_file_range(source_path, destination_path): # Copy inside the kernel; no round trip through user space
+        try:
+            with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+                while os.copy_file_range(source.fileno(), destination.fileno(), PROVISIONING_CHUNK_SIZE) > 0:
+                    pass
+        except Exception as e:
+            if os.path.exists(destination_path):
+                os.unlink(destination_path)
+            raise
+
+    @staticmethod
+    def chunked_copy(source_path, destination_path): # In-process copy that works on any filesystem pair and reports its progress
+        try:
+            total_bytes = os.path.getsize(source_path)
+            copied_bytes = 0
+            next_report = PROVISIONING_PROGRESS_EVERY
+            start_time = time.time()
+            with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+                while True:
+                    chunk = source.read(PROVISIONING_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    destination.write(chunk)
+                    copied_bytes += len(chunk)
+                    if copied_bytes >= next_report:
+                        print(f"DISTILLERYPRINT: Copying {os.path.basename(source_path)}: {copied_bytes / 2**30:.1f} of {total_bytes / 2**30:.1f} GB in {time.time() - start_time:.1f} seconds")
+                        next_report += PROVISIONING_PROGRESS_EVERY
+        except Exception as e:
+            raise
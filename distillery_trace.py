@@ -0,0 +1,86 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+CURRENT_TRACE = contextvars.ContextVar('distillery_trace', default=None) # The trace of the request being handled by this thread; executors must copy the context to inherit it
+
+class RequestTrace: # Wall-clock spans per stage of one request; stages that run several times (one per seed) or on several threads at once are summed
+    def __init__(self, request_id, workflow=None, listener=None):
+        try:
+            self.request_id = request_id
+            self.workflow = workflow
+            self.listener = listener # Called with every event emitted while the request runs, e.g. to stream them to the caller
+            self.start_time = time.time()
+            self.stages = {} # stage => {'seconds', 'count'}
+            self.annotations = {} # Facts about the request reported next to the timings, e.g. result_cache='hit'
+            self.lock = threading.Lock()
+        except Exception as e:
+            raise
+
+    def add(self, stage, seconds):
+        try:
+            with self.lock:
+                totals = self.stages.setdefault(stage, {'seconds': 0.0, 'count': 0})
+                totals['seconds'] += seconds
+                totals['count'] += 1
+        except Exception as e:
+            raise
+
+    @contextmanager
+    def span(self, stage): # Recorded even when the stage raises, so failed attempts still show where the time went
+        start_time = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(stage, time.perf_counter() - start_time)
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def summary(self): # Attached to the handler result and the logs; upload spans overlap sampling, so stages may add up to more than total_seconds
+        try:
+            with self.lock:
+                stages = {stage: {'seconds': round(totals['seconds'], 3), 'count': totals['count']} for stage, totals in self.stages.items()}
+                annotations = dict(self.annotations)
+            return {'workflow': self.workflow, 'total_seconds': round(self.elapsed(), 3), 'stages': stages, **annotations}
+        except Exception as e:
+            raise
+
+    def bind(self, function): # Wraps function so that, on whichever thread it runs, span(), record() and emit() report to this trace
+        def run(*args, **kwargs):
+            token = CURRENT_TRACE.set(self)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                CURRENT_TRACE.reset(token)
+        return run
+
+@contextmanager
+def span(stage): # Times a stage of the current request; a no-op outside of a traced request
+    trace = CURRENT_TRACE.get()
+    if trace is None:
+        yield None
+        return
+    with trace.span(stage):
+        yield trace
+
+def record(stage, seconds): # For durations measured elsewhere, e.g. from ComfyUI websocket events
+    trace = CURRENT_TRACE.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+def annotate(key, value): # Adds a fact to the summary of the current trace, if any
+    trace = CURRENT_TRACE.get()
+    if trace is not None:
+        with trace.lock:
+            trace.annotations[key] = value
+
+def emit(event): # Hands a progress event (a JSON-serializable dict) to the listener of the current trace, if any
+    trace = CURRENT_TRACE.get()
+    if trace is not None and trace.listener is not None:
+        trace.listener(dict(event, elapsed_seconds=round(trace.elapsed(), 3)))
+
+def in_current_context(function): # Wraps function so it reports to the caller's trace, e.g. when submitted to an executor thread
+    trace = CURRENT_TRACE.get()
+    return function if trace is None else trace.bind(function)
@@ -1,7 +1,10 @@
 import os
+import json
 import shutil
+import hashlib
 from distillery_visionmodels import VisionModelForCaptioning
 from distillery_aws import AWSConnector
+import distillery_trace
 import subprocess
 import shlex
 from PIL import Image
@@ -13,6 +16,62 @@ TEMP_FOLDER_NAME = 'temp_img'
 NETWORK_STORAGE = os.getenv("NETWORK_STORAGE") # Path to network storage mount
 MODELS_FOLDER = os.getenv("MODELS_FOLDER") # Path to models folder in ComfyUI
 BASE_MODEL = "Cosmopolitan_release_version.safetensors"
+TRAINING_RESOLUTION = "768,768"
+MIN_BUCKET_RESO = 256
+MAX_BUCKET_RESO = 2048
+BUCKET_RESO_STEPS = 64
+REG_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff')
+LATENT_CACHE_FOLDER = os.getenv("LATENT_CACHE_FOLDER", f"{WORKSPACE_FOLDER}/{BASE_TRAINING_FOLDER}/latent_cache") # Reg set latents kept across training jobs; one subfolder per base model and bucket settings
+
+def link_file(source_path, destination_path): # Hardlink, else symlink (e.g. across filesystems), else copy; returns which one was used
+    try:
+        try:
+            os.link(source_path, destination_path)
+            return 'hardlink'
+        except OSError:
+            pass
+        try:
+            os.symlink(os.path.abspath(source_path), destination_path)
+            return 'symlink'
+        except OSError:
+            pass
+        shutil.copy(source_path, destination_path)
+        return 'copy'
+    except Exception as e:
+        raise
+
+def latent_cache_key(): # Latents depend on the base model's VAE and on how images are bucketed; anything else in the command does not change them
+    try:
+        full_path_to_base_model = f"{MODELS_FOLDER}/checkpoints/{BASE_MODEL}"
+        model_stat = os.stat(full_path_to_base_model) if os.path.exists(full_path_to_base_model) else None
+        settings = {
+            'base_model': BASE_MODEL,
+            'base_model_size': model_stat.st_size if model_stat else None, # A different file under the same name must not reuse the old latents
+            'base_model_mtime': int(model_stat.st_mtime) if model_stat else None,
+            'resolution': TRAINING_RESOLUTION,
+            'min_bucket_reso': MIN_BUCKET_RESO,
+            'max_bucket_reso': MAX_BUCKET_RESO,
+            'bucket_reso_steps': BUCKET_RESO_STEPS,
+            'bucket_no_upscale': True,
+            'flip_aug': True,
+        }
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    except Exception as e:
+        raise
+
+def latent_cache_folder(subject_category): # Creates the folder for the current key and removes the ones left by earlier base models or settings
+    try:
+        key = latent_cache_key()
+        if os.path.isdir(LATENT_CACHE_FOLDER):
+            for folder_name in os.listdir(LATENT_CACHE_FOLDER):
+                if folder_name != key:
+                    print(f"DISTILLERYPRINT: Removing stale latent cache {folder_name}")
+                    shutil.rmtree(os.path.join(LATENT_CACHE_FOLDER, folder_name), ignore_errors=True)
+        cache_folder = os.path.join(LATENT_CACHE_FOLDER, key, subject_category)
+        os.makedirs(cache_folder, exist_ok=True)
+        return cache_folder
+    except Exception as e:
+        raise
 
 class TrainingSetup:
     @classmethod
@@ -77,21 +136,44 @@ class TrainingSetup:
             raise
 
     @classmethod
-    def step4_setup_regularization_images(cls, project_folder, subject_category, num_repetitions=1):
-        def copy_images(source_folder, destination_folder):
-            try:
-                if not os.path.exists(destination_folder):
-                    os.makedirs(destination_folder)
-                for file_name in os.listdir(source_folder):
-                    if file_name.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.npz')):
-                        shutil.copy(os.path.join(source_folder, file_name), destination_folder)
-            except Exception as e:
-                raise
+    def step4_setup_regularization_images(cls, project_folder, subject_category, num_repetitions=1): # Links the reg set and its cached latents into the project; kohya only encodes the images without a cached .npz
         try:
             source_folder = f"{WORKSPACE_FOLDER}/{BASE_TRAINING_FOLDER}/reg/{subject_category}"
             new_folder_path = f"{project_folder}/reg/{num_repetitions}_{subject_category}"
-            # Create new folder and copy images
-            copy_images(source_folder, new_folder_path)
+            os.makedirs(new_folder_path, exist_ok=True)
+            cache_folder = latent_cache_folder(subject_category)
+            link_methods, cached_latents = {}, 0
+            for file_name in os.listdir(source_folder):
+                if not file_name.lower().endswith(REG_IMAGE_EXTENSIONS): # .npz files next to the source images are not keyed to a base model, so they are left out
+                    continue
+                link_method = link_file(os.path.join(source_folder, file_name), os.path.join(new_folder_path, file_name))
+                link_methods[link_method] = link_methods.get(link_method, 0) + 1
+                latent_file_name = f"{os.path.splitext(file_name)[0]}.npz"
+                if os.path.exists(os.path.join(cache_folder, latent_file_name)):
+                    link_file(os.path.join(cache_folder, latent_file_name), os.path.join(new_folder_path, latent_file_name))
+                    cached_latents += 1
+            print(f"DISTILLERYPRINT: Reg set {subject_category} linked into the project ({link_methods}), {cached_latents} cached latents reused")
+            distillery_trace.annotate('reg_cached_latents', cached_latents)
+            return new_folder_path, cache_folder
+        except Exception as e:
+            raise
+
+    @classmethod
+    def store_regularization_latents(cls, reg_folder, cache_folder): # Moves the latents kohya wrote for the reg set into the cache before the project folder is deleted
+        try:
+            stored_latents = 0
+            for file_name in os.listdir(reg_folder):
+                if not file_name.endswith('.npz'):
+                    continue
+                latent_path = os.path.join(reg_folder, file_name)
+                cache_path = os.path.join(cache_folder, file_name)
+                if os.path.islink(latent_path) or (os.path.exists(cache_path) and os.path.samefile(latent_path, cache_path)):
+                    continue # Already the cached file
+                temp_path = f"{cache_path}.tmp"
+                shutil.copy(latent_path, temp_path) # Copy then rename, so a job reading the cache never sees a partial file
+                os.replace(temp_path, cache_path)
+                stored_latents += 1
+            print(f"DISTILLERYPRINT: Stored {stored_latents} new reg latents in {cache_folder}")
         except Exception as e:
             raise
 
@@ -113,23 +195,31 @@ class TrainingSetup:
 
     @classmethod
     def do_setup(cls, lora_name, original_image_file_name, force_category=None):
-        temp_folder, project_folder = cls.step1_create_project_folders(lora_name) # Create the project folder and subfolders
-        image_file_name, image_file_path = cls.step2_download_image_file(lora_name, temp_folder, original_image_file_name) # Download the image file from S3 to the project folder
-        image_caption, subject_category = cls.step3_caption_image(image_file_path, force_category=force_category) # Caption the image
-        cls.step4_setup_regularization_images(project_folder, subject_category) # Setup the regularization images folder
-        cls.step5_prepare_training_setup(lora_name, project_folder, image_file_name, image_file_path, image_caption, subject_category) # Create the required folder and copy the image to the new folder
-        return project_folder, image_caption, subject_category, image_file_path
+        with distillery_trace.span('folder_setup'):
+            temp_folder, project_folder = cls.step1_create_project_folders(lora_name) # Create the project folder and subfolders
+        with distillery_trace.span('download'):
+            image_file_name, image_file_path = cls.step2_download_image_file(lora_name, temp_folder, original_image_file_name) # Download the image file from S3 to the project folder
+        with distillery_trace.span('caption'):
+            image_caption, subject_category = cls.step3_caption_image(image_file_path, force_category=force_category) # Caption the image
+        with distillery_trace.span('reg_setup'):
+            reg_folder, cache_folder = cls.step4_setup_regularization_images(project_folder, subject_category) # Setup the regularization images folder
+            cls.step5_prepare_training_setup(lora_name, project_folder, image_file_name, image_file_path, image_caption, subject_category) # Create the required folder and copy the image to the new folder
+        return project_folder, image_caption, subject_category, image_file_path, reg_folder, cache_folder
 
 class TrainingExecution:
     @classmethod
     def run_training_algorithm(cls, lora_name, original_image_file_name, force_category=None):
         try:
-            project_folder, image_caption, subject_category, image_file_path = TrainingSetup.do_setup(lora_name, original_image_file_name, force_category=force_category)
+            project_folder, image_caption, subject_category, image_file_path, reg_folder, cache_folder = TrainingSetup.do_setup(lora_name, original_image_file_name, force_category=force_category)
             full_path_to_base_model = f"{MODELS_FOLDER}/checkpoints/{BASE_MODEL}"            
-            training_command = f'accelerate launch --num_cpu_threads_per_process=2 {WORKSPACE_FOLDER}/kohya_ss/train_network.py --enable_bucket --min_bucket_reso=256 --max_bucket_reso=2048 --pretrained_model_name_or_path="{full_path_to_base_model}" --train_data_dir="{project_folder}/img" --reg_data_dir="{project_folder}/reg" --resolution="768,768" --output_dir="{project_folder}/model" --logging_dir="{project_folder}/log" --network_alpha="1" --save_model_as=safetensors --network_module=lycoris.kohya --network_args "conv_dim=1" "conv_alpha=1" "use_cp=False" "algo=loha" --network_dropout="0" --text_encoder_lr=1.0 --unet_lr=1.0 --network_dim=128 --output_name="{lora_name}" --lr_scheduler_num_cycles="3" --scale_weight_norms="1" --no_half_vae --learning_rate="1.0" --lr_scheduler="cosine" --train_batch_size="8" --max_train_steps="100" --save_every_n_epochs="3" --mixed_precision="bf16" --save_precision="bf16" --seed="1991" --caption_extension=".txt" --cache_latents --cache_latents_to_disk --optimizer_type="DAdaptAdam" --optimizer_args decouple=True use_bias_correction=True weight_decay=0.20 --keep_tokens="2" --bucket_reso_steps=64 --min_snr_gamma=5 --flip_aug --shuffle_caption --gradient_checkpointing --xformers --bucket_no_upscale --noise_offset=0.0375'
+            training_command = f'accelerate launch --num_cpu_threads_per_process=2 {WORKSPACE_FOLDER}/kohya_ss/train_network.py --enable_bucket --min_bucket_reso={MIN_BUCKET_RESO} --max_bucket_reso={MAX_BUCKET_RESO} --pretrained_model_name_or_path="{full_path_to_base_model}" --train_data_dir="{project_folder}/img" --reg_data_dir="{project_folder}/reg" --resolution="{TRAINING_RESOLUTION}" --output_dir="{project_folder}/model" --logging_dir="{project_folder}/log" --network_alpha="1" --save_model_as=safetensors --network_module=lycoris.kohya --network_args "conv_dim=1" "conv_alpha=1" "use_cp=False" "algo=loha" --network_dropout="0" --text_encoder_lr=1.0 --unet_lr=1.0 --network_dim=128 --output_name="{lora_name}" --lr_scheduler_num_cycles="3" --scale_weight_norms="1" --no_half_vae --learning_rate="1.0" --lr_scheduler="cosine" --train_batch_size="8" --max_train_steps="100" --save_every_n_epochs="3" --mixed_precision="bf16" --save_precision="bf16" --seed="1991" --caption_extension=".txt" --cache_latents --cache_latents_to_disk --optimizer_type="DAdaptAdam" --optimizer_args decouple=True use_bias_correction=True weight_decay=0.20 --keep_tokens="2" --bucket_reso_steps={BUCKET_RESO_STEPS} --min_snr_gamma=5 --flip_aug --shuffle_caption --gradient_checkpointing --xformers --bucket_no_upscale --noise_offset=0.0375'
             print(f"DISTILLERYPRINT - TRAINING COMMAND: {training_command}")
             args = shlex.split(training_command) # Splitting the command into a list of arguments
-            subprocess.run(args) # Executing the command
+            with distillery_trace.span('training_run'):
+                training_process = subprocess.run(args) # Executing the command
+            if training_process.returncode == 0: # A failed run may have left a partially written .npz behind
+                with distillery_trace.span('latent_cache'):
+                    TrainingSetup.store_regularization_latents(reg_folder, cache_folder)
             return project_folder, image_caption, subject_category, image_file_path
         except Exception as e:
             raise
@@ -165,7 +255,8 @@ class TrainingExecution:
 def do_training(lora_name, original_image_file_name, force_category=None):
     try:
         project_folder, image_caption, subject_category, image_file_path = TrainingExecution.run_training_algorithm(lora_name, original_image_file_name, force_category=force_category)
-        model_file_name, base_image_file_name = TrainingExecution.save_and_upload_model(project_folder, lora_name, image_file_path)
+        with distillery_trace.span('upload'):
+            model_file_name, base_image_file_name = TrainingExecution.save_and_upload_model(project_folder, lora_name, image_file_path)
         # Prepare the output
         output = {}
         output['lora_name'] = lora_name
@@ -2,13 +2,20 @@ import time
 import runpod
 import uuid
 from distillery_aws import AWSConnector
-from distillery_comfy import ComfyConnector
+from distillery_comfy import ComfyConnector, ComfyWorkflowError, ComfyConnectionError
+from botocore.exceptions import BotoCoreError, ClientError
+from boto3.exceptions import Boto3Error
+from distillery_cache import ModelCache, InputCache, ModelIndex, ResultCache, ModelPopularity, INPUT_CACHE_SUBFOLDER
+from distillery_png import PngMetadata
+from distillery_provision import ModelProvisioner
+from distillery_lease import NetworkStorageLease
+from distillery_workflow import WorkflowTemplateCache, LATENT_BATCH_NODE_CLASSES
+import distillery_trace
 import os
 import io
 from urllib.parse import urlparse
-from PIL import PngImagePlugin
 import json
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, Future
 import copy
 import sys
 import subprocess
@@ -18,6 +25,10 @@ from distillery_train import do_training
 import shutil
 import random
 import string
+import hashlib
+import queue
+import asyncio
+import threading
 
 MAX_WORKER_ATTEMPTS = 2 # Maximum number of times the worker will attempt to run before giving up
 START_TIME = time.time() # Time at which the worker was initialized
@@ -31,6 +42,37 @@ CUSTOM_NODES_FOLDER = os.getenv("CUSTOM_NODES_FOLDER") # Path to custom nodes fo
 WORKER_TIMEOUT_FOR_INFERENCE = int(os.getenv("WORKER_TIMEOUT_FOR_INFERENCE")) # Timeout for the worker in seconds for inference
 WORKER_TIMEOUT_FOR_TRAINING = int(os.getenv("WORKER_TIMEOUT_FOR_TRAINING")) # Timeout for the worker in seconds for training
 MINIMUM_GB_FREE_DISK_SPACE = int(os.getenv("MINIMUM_GB_FREE_DISK_SPACE")) # Minimum GB of free disk space required for the worker to run
+DEFAULT_BATCH_STRATEGY = os.getenv("DEFAULT_BATCH_STRATEGY", "sequential") # Used when the payload has no batch_strategy: 'sequential' (one prompt at a time), 'queued' (every seed queued up front) or 'latent_batch' (one prompt, one sampler pass)
+BATCH_STRATEGIES = ['sequential', 'queued', 'latent_batch']
+PIPELINE_IMAGE_UPLOADS = os.getenv("PIPELINE_IMAGE_UPLOADS", "true").lower() == "true" # Encode and upload each image in the background while ComfyUI samples the next seed
+MAX_PARALLEL_MODEL_FETCHES = int(os.getenv("MAX_PARALLEL_MODEL_FETCHES", 4)) # Maximum number of models fetched at the same time from network storage or S3
+INPUT_IMAGE_TEMPLATE_INPUTS = ['IMG2IMG_IMAGE_FILENAME', 'INPAINT_IMAGE_FILENAME', 'INPAINT_MASK_IMAGE_FILENAME', 'CONTROLNET_IMAGE_FILENAME', 'ZOOM_OUT_IMAGE_FILENAME', 'IPADAPTER_1_IMAGE_FILENAME', 'IPADAPTER_2_IMAGE_FILENAME', 'IPADAPTER_3_IMAGE_FILENAME', 'IPADAPTER_4_IMAGE_FILENAME'] # template_inputs holding S3 keys of input images
+MODEL_TYPE_FOLDERS = { # model_type => (folder name in network storage, local folder used by ComfyUI)
+    "sd_model": ("checkpoints", f"{MODELS_FOLDER}/checkpoints/"),
+    "lora_model": ("loras", f"{MODELS_FOLDER}/loras/"),
+    "controlnet_model": ("controlnet", f"{MODELS_FOLDER}/controlnet/"),
+    "ipadapter_model": ("ipadapter", f"{CUSTOM_NODES_FOLDER}/ComfyUI_IPAdapter_plus/models/"),
+    "vae_model": ("vae", f"{MODELS_FOLDER}/vae/"),
+    "upscale_model": ("upscale_models", f"{MODELS_FOLDER}/upscale_models/"),
+    "clip_vision_model": ("clip_vision", f"{MODELS_FOLDER}/clip_vision/"),
+    "unet_model": ("unet", f"{MODELS_FOLDER}/unet/"),
+    "clip_model": ("clip", f"{MODELS_FOLDER}/clip/"),
+}
+UNAVAILABLE_MODELS = {} # (model type, filename) => when S3 answered "not found" for a model found in a workflow; ComfyUI may still have it elsewhere (e.g. extra_model_paths), so it is not looked up again until UNAVAILABLE_MODEL_TTL_SECONDS pass
+UNAVAILABLE_MODELS_LOCK = threading.Lock()
+UNAVAILABLE_MODEL_TTL_SECONDS = int(os.getenv("UNAVAILABLE_MODEL_TTL_SECONDS", 600)) # After this, a model that was missing from S3 is looked up again, in case it was uploaded since
+S3_NOT_FOUND_CODES = ('404', 'NoSuchKey', 'NotFound')
+STREAM_OUTPUT = os.getenv("STREAM_OUTPUT", "false").lower() == "true" # Register stream_handler with runpod: each image key is yielded as soon as it is uploaded, with sampling progress in between
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", 1)) # Requests runpod hands this worker at once; above 1 they share ComfyUI, so one request's S3 staging and uploads overlap another's sampling
+STREAM_FINISHED = object() # Put on the event queue of stream_handler once worker_routine returns
+NETWORK_STORAGE_WRITER = ThreadPoolExecutor(max_workers=1) # Writes models downloaded from S3 back to network storage off the request's critical path
+COMFY_BOOT_EXECUTOR = ThreadPoolExecutor(max_workers=1) # Starts ComfyUI at import, overlapping its boot with the runpod handshake and model prefetch
+MODEL_PREFETCH_TOP_K = int(os.getenv("MODEL_PREFETCH_TOP_K", 5)) # Most popular models (see ModelPopularity) copied from network storage at boot, before any request asks for them; 0 disables the prefetch
+MODEL_PREFETCH_MAX_GB = float(os.getenv("MODEL_PREFETCH_MAX_GB", 20)) # Byte budget (in GB) of the prefetch; also bounded by the model cache budget and MINIMUM_GB_FREE_DISK_SPACE
+MODEL_PREFETCH_TYPES = ['sd_model', 'lora_model'] # The models whose transfer the first requests wait on the most
+MODEL_PREFETCH_CHUNK_BYTES = 16 * 2**20 # The prefetch checks for requests between two chunks, so it gives way within one chunk
+MODEL_PREFETCH_PAUSE_SECONDS = 0.5 # How often a paused prefetch checks whether the worker is idle again
+MODEL_PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=1)
 
 def send_runpod_errorlog(preamble_text, request_id):
     def clean_repr(obj):
@@ -57,8 +99,10 @@ def confirm_disk_space():
         total, used, free = shutil.disk_usage(folder)
         return free // (2**30)
     # declare helper function to delete files from a folder
-    def delete_contents(folder): # Delete the contents of the specified folder
+    def delete_contents(folder, keep=()): # Delete the contents of the specified folder, except the entries named in keep
         for filename in os.listdir(folder):
+            if filename in keep:
+                continue
             file_path = os.path.join(folder, filename)
             try:
                 if os.path.isfile(file_path) or os.path.islink(file_path):
@@ -67,58 +111,183 @@ def confirm_disk_space():
                     shutil.rmtree(file_path)
             except Exception as e:
                 raise
-    if get_free_space_gb('/') < MINIMUM_GB_FREE_DISK_SPACE:  # Checking the root directory for overall disk space
+    if get_free_space_gb(INFERENCE_OUTPUT_FOLDER) < MINIMUM_GB_FREE_DISK_SPACE and RequestCounter().in_flight == 0: # Leftover outputs and staged inputs cost nothing to lose, so they go before any cached file; other requests may still be reading these folders
         delete_contents(INFERENCE_OUTPUT_FOLDER)
-        delete_contents(INFERENCE_INPUT_FOLDER)
-        delete_contents(f"{MODELS_FOLDER}/loras/")
+        delete_contents(INFERENCE_INPUT_FOLDER, keep=[INPUT_CACHE_SUBFOLDER]) # The input cache manages its own budget
+    evicted_inputs = InputCache().evict(minimum_free_bytes=MINIMUM_GB_FREE_DISK_SPACE * 2**30, disk_path=INFERENCE_INPUT_FOLDER) # Input images are the cheapest to fetch again, so they go first; free space is measured on the disk holding them
+    if evicted_inputs:
+        print(f"DISTILLERYPRINT: Evicted {len(evicted_inputs)} images from the input image cache.")
+    model_cache = ModelCache()
+    evicted_models = model_cache.evict(minimum_free_bytes=MINIMUM_GB_FREE_DISK_SPACE * 2**30, disk_path=MODELS_FOLDER) # Least recently used models go first; models pinned by in-flight requests are kept
+    if evicted_models:
+        print(f"DISTILLERYPRINT: Evicted {len(evicted_models)} models from the local model cache: {evicted_models}")
 
-def fetch_images(payload):
+def encode_and_upload_images(images, image_metadata, seed=None): # Writes the request metadata (one string for all images, or one per image) into each PNG and uploads it to S3; returns their keys
     try:
-        aws_connector = AWSConnector() 
-        comfy_connector = ComfyConnector()
+        aws_connector = AWSConnector()
         image_files = []
-        comfy_api = payload['comfy_api']
-        request_id = payload['request_id']
-        template_inputs = payload['template_inputs']
-        print(f"DISTILLERYPRINT: Request ID {request_id} being processed with template inputs {template_inputs} and workflow {payload['payload_template_key']}.")
-        images = comfy_connector.generate_images(comfy_api)
-        for image in images: 
+        image_metadata_list = image_metadata if isinstance(image_metadata, list) else [image_metadata] * len(images)
+        for batch_index, (image, image_metadata) in enumerate(zip(images, image_metadata_list)):
             # Create a unique filename
             filename = f'distillery_{str(uuid.uuid4())}.png'
 
-            # Add the metadata
-            image_metadata_dict = copy.deepcopy(payload)
-            #del image_metadata_dict['comfy_api'] # Remove the Comfy API from the metadata to keep the size small
-            image_metadata = json.dumps(image_metadata_dict)
-            pnginfo = PngImagePlugin.PngInfo()
-            pnginfo.add_text('prompt', image_metadata)
-
-            # Save the image to an in-memory file object
-            image_file = io.BytesIO()
-            image.save(image_file, format='PNG', pnginfo=pnginfo)
-            image_file.seek(0)
+            # Add the metadata; PNG bytes from ComfyUI get the text chunk spliced in, anything else is re-encoded by PIL
+            with distillery_trace.span('encode'):
+                image_file = io.BytesIO(PngMetadata.add_metadata(image, 'prompt', image_metadata))
 
             # Upload the in-memory file to S3
-            aws_connector.upload_fileobj([(image_file, filename)]) # Upload the in-memory file to S3
+            with distillery_trace.span('upload'):
+                aws_connector.upload_fileobj([(image_file, filename)]) # Upload the in-memory file to S3
             image_files.append(filename)
+            distillery_trace.emit({'type': 'image', 'key': filename, 'seed': seed, 'batch_index': batch_index}) # Streamed to the caller right away by stream_handler
 
         return image_files # Return the list of keys of the images in S3
     except Exception as e:
         raise
 
+def fetch_images(payload, upload_executor=None, output_node_id=None): # With an upload_executor, returns a Future so ComfyUI can start on the next seed while this one is encoded and uploaded
+    try:
+        comfy_connector = ComfyConnector()
+        comfy_api = payload['comfy_api']
+        request_id = payload['request_id']
+        template_inputs = payload['template_inputs']
+        print(f"DISTILLERYPRINT: Request ID {request_id} being processed with template inputs {template_inputs} and workflow {payload['payload_template_key']}.")
+        images = comfy_connector.generate_images(comfy_api, decode=False, output_node_id=output_node_id)
+        image_metadata = json.dumps(payload) # Serialized now: the caller bumps the seed in payload as soon as we return
+        #image_metadata = json.dumps({k: v for k, v in payload.items() if k != 'comfy_api'}) # Remove the Comfy API from the metadata to keep the size small
+        seed = template_inputs['NOISE_SEED']
+        if upload_executor is not None:
+            return upload_executor.submit(distillery_trace.in_current_context(encode_and_upload_images), images, image_metadata, seed)
+        return encode_and_upload_images(images, image_metadata, seed)
+    except Exception as e:
+        raise
+
+def collect_uploaded_files(files, wait=True): # Resolves the Futures returned by a pipelined fetch_images, in seed order; raises the first upload failure
+    try:
+        collected_files = []
+        for file in files:
+            if isinstance(file, Future):
+                if not wait and not file.done():
+                    continue
+                file = file.result()
+            collected_files.append(file)
+        return collected_files
+    except Exception as e:
+        raise
+
+def next_seed(seed): # NOISE_SEED arrives either as an int or as a numeric string; keep its type
+    return str(int(seed)+1) if isinstance(seed, str) else seed + 1
+
+def generate_sequential(payload, workflow, images_per_batch, upload_executor=None): # One prompt at a time: each seed is queued once the previous one finished
+    try:
+        files = []
+        template_inputs = payload['template_inputs']
+        for i in range(images_per_batch):
+            file = fetch_images(payload, upload_executor, workflow.output_node_id)
+            files.append(file)
+            collect_uploaded_files(files, wait=False) # Fail fast: an upload that already failed aborts the batch before more GPU time is spent
+            template_inputs['NOISE_SEED'] = next_seed(template_inputs['NOISE_SEED'])
+            payload['comfy_api'] = workflow.with_seed(payload['comfy_api'], template_inputs['NOISE_SEED'])
+            print(f"DISTILLERYPRINT: Image {i+1} - New Seed: {template_inputs['NOISE_SEED']}")
+        return files
+    except Exception as e:
+        raise
+
+def build_seed_variants(payload, workflow, images_per_batch): # One payload per image, with the same seeds generate_sequential would use; the variants share every node but the seeded ones
+    try:
+        variants = []
+        seed = payload['template_inputs']['NOISE_SEED']
+        comfy_api = payload['comfy_api']
+        for i in range(images_per_batch):
+            variant = dict(payload)
+            variant['template_inputs'] = dict(payload['template_inputs'], NOISE_SEED=seed)
+            variant['comfy_api'] = comfy_api
+            variants.append(variant)
+            seed = next_seed(seed)
+            comfy_api = workflow.with_seed(comfy_api, seed)
+        return variants
+    except Exception as e:
+        raise
+
+def generate_queued(payload, workflow, images_per_batch, upload_executor=None): # Every seed is queued at once and images are collected by prompt_id as ComfyUI finishes them
+    try:
+        comfy_connector = ComfyConnector()
+        variants = build_seed_variants(payload, workflow, images_per_batch)
+        print(f"DISTILLERYPRINT: Request ID {payload['request_id']} being processed with {images_per_batch} queued seeds starting at {payload['template_inputs']['NOISE_SEED']} and workflow {payload['payload_template_key']}.")
+        files = [None] * images_per_batch
+        for index, images in comfy_connector.generate_images_queued([variant['comfy_api'] for variant in variants], decode=False, output_node_id=workflow.output_node_id):
+            image_metadata = json.dumps(variants[index])
+            seed = variants[index]['template_inputs']['NOISE_SEED']
+            if upload_executor is not None:
+                files[index] = upload_executor.submit(distillery_trace.in_current_context(encode_and_upload_images), images, image_metadata, seed)
+                collect_uploaded_files([file for file in files if file is not None], wait=False) # Fail fast, as in generate_sequential
+            else:
+                files[index] = encode_and_upload_images(images, image_metadata, seed)
+        payload['template_inputs']['NOISE_SEED'] = next_seed(variants[-1]['template_inputs']['NOISE_SEED']) # Leave the payload as generate_sequential would
+        payload['comfy_api'] = variants[-1]['comfy_api']
+        return files
+    except Exception as e:
+        raise
+
+def generate_latent_batch(payload, workflow, images_per_batch, upload_executor=None): # A single prompt whose empty latent holds every image, rendered in one sampler pass
+    try:
+        comfy_connector = ComfyConnector()
+        latent_batch_nodes = workflow.latent_batch_nodes
+        if not latent_batch_nodes: # e.g. img2img workflows start from an encoded image, not an empty latent
+            print(f"DISTILLERYPRINT: Workflow {payload['payload_template_key']} has no {LATENT_BATCH_NODE_CLASSES} node. Falling back to queued generation.")
+            return generate_queued(payload, workflow, images_per_batch, upload_executor)
+        comfy_api = dict(payload['comfy_api']) # Only the latent nodes change, so they are the only ones copied
+        for node_id in latent_batch_nodes:
+            comfy_api[node_id] = dict(comfy_api[node_id], inputs=dict(comfy_api[node_id]['inputs'], batch_size=images_per_batch))
+        seed = payload['template_inputs']['NOISE_SEED']
+        print(f"DISTILLERYPRINT: Request ID {payload['request_id']} being processed as a latent batch of {images_per_batch} with seed {seed} and workflow {payload['payload_template_key']}.")
+        images = comfy_connector.generate_images(comfy_api, decode=False, output_node_id=workflow.output_node_id)
+        image_metadata = []
+        for batch_index in range(len(images)): # Every image shares the sampler seed; batch_index is what tells them apart when reproducing one
+            image_metadata_dict = dict(payload, comfy_api=comfy_api, batch_strategy='latent_batch', batch_index=batch_index, effective_seed=seed)
+            image_metadata.append(json.dumps(image_metadata_dict))
+        if upload_executor is not None:
+            return [upload_executor.submit(distillery_trace.in_current_context(encode_and_upload_images), images, image_metadata, seed)]
+        return [encode_and_upload_images(images, image_metadata, seed)]
+    except Exception as e:
+        raise
+
+def mark_model_unavailable(model_type, model_filename):
+    try:
+        with UNAVAILABLE_MODELS_LOCK:
+            UNAVAILABLE_MODELS[(model_type, model_filename)] = time.time()
+    except Exception as e:
+        raise
+
+def is_model_unavailable(model_type, model_filename): # True while S3's last "not found" for the model is younger than UNAVAILABLE_MODEL_TTL_SECONDS
+    try:
+        with UNAVAILABLE_MODELS_LOCK:
+            marked_at = UNAVAILABLE_MODELS.get((model_type, model_filename))
+            if marked_at is not None and time.time() - marked_at >= UNAVAILABLE_MODEL_TTL_SECONDS:
+                del UNAVAILABLE_MODELS[(model_type, model_filename)]
+                marked_at = None
+            return marked_at is not None
+    except Exception as e:
+        raise
+
 class InputPreprocessor:
     @staticmethod
-    def update_paths(json_obj, paths, input_value):
+    def point_inputs_to_files(comfy_api, image_names): # Rewrites node inputs naming a staged S3 image so they reference the file ComfyUI actually has (e.g. the input cache entry); every node is scanned, since any custom node may load an image by name
         try:
-            aws_connector = AWSConnector()
-            updated_json_obj = copy.deepcopy(json_obj)  # Create a deep copy of the original JSON object
-            for path in paths:
-                target = updated_json_obj
-                for key in path[:-1]:  # Traverse all but the last key in the path
-                    target = target.get(key, {})  # Use get to avoid KeyError
-                if path[-1] in target:  # Check if the key exists
-                    target[path[-1]] = input_value  # Update the value at the last key in the path
-            return updated_json_obj
+            renames = {}
+            for s3_key, image_name in image_names.items():
+                for original_name in (s3_key, os.path.basename(s3_key)):
+                    if original_name != image_name:
+                        renames[original_name] = image_name
+            if not renames:
+                return comfy_api
+            updated_comfy_api = dict(comfy_api) # Only the nodes that change are copied
+            for node_id, node in comfy_api.items():
+                inputs = node.get('inputs', {}) if isinstance(node, dict) else {}
+                changed_inputs = {key: renames[value] for key, value in inputs.items() if isinstance(value, str) and value in renames}
+                if changed_inputs:
+                    updated_comfy_api[node_id] = dict(node, inputs=dict(inputs, **changed_inputs))
+            return updated_comfy_api
         except Exception as e:
             raise
 
@@ -180,65 +349,244 @@ class InputPreprocessor:
             raise
 
     @staticmethod
-    def get_models_from_storage(models_list, request_id, save_to_network_storage = True):
+    def save_model_to_network_storage(local_file_path, model_type_path, file_name, request_id, lease=None): # Runs on NETWORK_STORAGE_WRITER, after the request already has its model; releases the lease once the file is in place
+        try:
+            if lease is not None:
+                lease.set_progress(stage='writing_to_network_storage')
+            rand = ''.join(random.choices(string.ascii_lowercase + string.digits, k=10)) # Generate a random string to append to the filename to avoid overwriting and allow concurrent workers to run
+            temporary_file_name = f"{rand}_{file_name}"
+            subprocess.run(["cp", local_file_path, f"{NETWORK_STORAGE}/{model_type_path}/{temporary_file_name}"], check=True)
+            os.rename(f"{NETWORK_STORAGE}/{model_type_path}/{temporary_file_name}", f"{NETWORK_STORAGE}/{model_type_path}/{file_name}")
+            ModelIndex().add(f"{NETWORK_STORAGE}/{model_type_path}", file_name)
+        except Exception as e:
+            complete_errorlog = send_runpod_errorlog(f"DISTILLERYPRINT: Warning - Failed to copy model to network storage: '{file_name}' from S3", request_id)
+        finally:
+            if lease is not None:
+                lease.release()
+            ModelCache().unpin([local_file_path]) # Pinned by fetch_model so the cache can't evict the file while it is being copied
+
+    @staticmethod
+    def provision_from_network_storage(model, request_id): # Returns the provisioning strategy used
+        try:
+            model_type_path, model_path = MODEL_TYPE_FOLDERS[model["model_type"]]
+            file_name = model["model_filename"]
+            try:
+                strategy = ModelProvisioner.provision(f"{NETWORK_STORAGE}/{model_type_path}/{file_name}", f"{model_path}{file_name}", ModelProvisioner.strategy_for(model["model_type"]))
+            except (subprocess.CalledProcessError, OSError) as e:
+                subprocess_error_message = f"ERROR: Failed to copy model['model_filename'] '{file_name}' from network storage"
+                complete_errorlog = send_runpod_errorlog(subprocess_error_message, request_id)
+                raise RuntimeError(subprocess_error_message)
+            ModelIndex().add(model_path, file_name)
+            return strategy
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def acquire_network_storage_lease(model): # Single flight across workers: returns (lease, None) when this worker should download the model, (None, 'ready') when another worker just put it on network storage, (None, 'timeout') when waiting took too long
+        try:
+            model_type_path, model_path = MODEL_TYPE_FOLDERS[model["model_type"]]
+            os.makedirs(f"{NETWORK_STORAGE}/{model_type_path}", exist_ok=True) # Folders of newer model types (vae, upscale_models...) may not exist on older volumes
+            lease = NetworkStorageLease(f"{NETWORK_STORAGE}/{model_type_path}/{model['model_filename']}")
+            while not lease.try_acquire():
+                outcome = lease.wait()
+                if outcome != 'released': # 'released' means the holder died or failed; compete for the lease again
+                    return None, outcome
+            if os.path.exists(lease.target_path): # Populated between our index lookup and the acquisition
+                lease.release()
+                return None, 'ready'
+            return lease, None
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def fetch_model(model, request_id, save_to_network_storage = True): # Brings one missing model into ComfyUI; returns where it came from
+        aws_connector = AWSConnector()
+        model_type_path, model_path = MODEL_TYPE_FOLDERS[model["model_type"]]
+        file_name = model["model_filename"]
+        local_file_path = f"{model_path}{file_name}"
+        model_index = ModelIndex()
+        if model_index.contains(f"{NETWORK_STORAGE}/{model_type_path}", file_name):
+            return f"network_storage ({InputPreprocessor.provision_from_network_storage(model, request_id)})"
+        lease = None
+        if save_to_network_storage:
+            lease, outcome = InputPreprocessor.acquire_network_storage_lease(model)
+            if outcome == 'ready':
+                model_index.add(f"{NETWORK_STORAGE}/{model_type_path}", file_name)
+                return f"network_storage after waiting for another worker ({InputPreprocessor.provision_from_network_storage(model, request_id)})"
+            if outcome == 'timeout':
+                print(f"DISTILLERYPRINT: Gave up waiting for another worker to fetch '{file_name}'. Downloading it from S3 without saving it to network storage.")
+                save_to_network_storage = False
+        try:
+            rand = ''.join(random.choices(string.ascii_lowercase + string.digits, k=10))
+            temporary_file_path = f"{model_path}/{rand}_{file_name}.part" # Download under a temporary name so ComfyUI never sees a half-written model
+            progress_callback = None
+            if lease is not None: # Publish our progress in the lease marker for the workers waiting on us
+                downloaded_bytes = [0]
+                def progress_callback(bytes_transferred):
+                    downloaded_bytes[0] += bytes_transferred
+                    lease.set_progress(stage='downloading_from_s3', bytes=downloaded_bytes[0])
+                lease.start_heartbeat()
+            aws_connector.download_files([(file_name, temporary_file_path)], callback=progress_callback) # Download the model from S3
+            os.rename(temporary_file_path, local_file_path)
+            model_index.add(model_path, file_name)
+        except Exception as e:
+            if lease is not None:
+                lease.release() # Let a waiting worker try instead
+            complete_errorlog = send_runpod_errorlog(f"DISTILLERYPRINT: Error downloading model '{file_name}' from S3", request_id)
+            raise
+        if save_to_network_storage: # Save the model to the Runpod database, once downloaded
+            ModelCache().pin([local_file_path])
+            if lease is not None:
+                lease.set_progress(stage='queued_for_network_storage') # The writer may be busy with other copies; waiters stop waiting after MODEL_LEASE_WRITE_BACK_WAIT_SECONDS
+            NETWORK_STORAGE_WRITER.submit(InputPreprocessor.save_model_to_network_storage, local_file_path, model_type_path, file_name, request_id, lease)
+        return "s3"
+
+    @staticmethod
+    def get_models_from_storage(models_list, request_id, save_to_network_storage = True): # Returns the local paths of the request's models, pinned in the model cache until the caller unpins them
+        def timed_fetch(model):
+            copy_start_time = time.time()
+            try:
+                source = InputPreprocessor.fetch_model(model, request_id, save_to_network_storage)
+            except Exception as e:
+                if not model.get('discovered'):
+                    raise
+                if isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in S3_NOT_FOUND_CODES:
+                    mark_model_unavailable(model['model_type'], model['model_filename']) # If ComfyUI can't find it either, the prompt fails validation, which doesn't cost a restart
+                    aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"Model '{model['model_filename']}' ({model['model_type']}) referenced by the workflow is neither on network storage nor in S3. Leaving it to ComfyUI for the next {UNAVAILABLE_MODEL_TTL_SECONDS} seconds.", level='WARNING')
+                    return model['model_filename'], 'unavailable', round(time.time() - copy_start_time, 2)
+                aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"Failed to fetch model '{model['model_filename']}' ({model['model_type']}) referenced by the workflow. Leaving it to ComfyUI for this request only. Exception: {e}", level='WARNING') # Throttling, timeouts or a full disk say nothing about whether the model exists
+                return model['model_filename'], 'failed', round(time.time() - copy_start_time, 2)
+            model_cache.record_miss(model["model_type"], f"{MODEL_TYPE_FOLDERS[model['model_type']][1]}{model['model_filename']}")
+            return model['model_filename'], source, round(time.time() - copy_start_time, 2)
+        pinned_models = []
         try:
             aws_connector = AWSConnector()
+            model_cache = ModelCache()
             start_time = time.time()
+            unique_models = {}
+            for item in models_list or []:  # will iterate across all items in the list
+                for model in item.values():  # will iterate across all models in the list
+                    unique_models.setdefault((model["model_type"], model["model_filename"]), model) # The same file may be requested by several inputs; fetch it only once
+            model_popularity = ModelPopularity()
+            if model_popularity.enabled():
+                model_popularity.record([(model_type, model_filename) for (model_type, model_filename), model in unique_models.items() if not model.get('discovered') or not is_model_unavailable(model_type, model_filename)])
+                NETWORK_STORAGE_WRITER.submit(model_popularity.flush) # Merges the counts into the shared table at most every MODEL_POPULARITY_FLUSH_SECONDS
+            missing_models = []
+            for (model_type, model_filename), model in unique_models.items():
+                if model.get('discovered') and model_type not in MODEL_TYPE_FOLDERS:
+                    print(f"DISTILLERYPRINT: No model folder for model type '{model_type}' of '{model_filename}'. Leaving it to ComfyUI.")
+                    continue
+                if model.get('discovered') and is_model_unavailable(model_type, model_filename):
+                    continue
+                model_type_path, model_path = MODEL_TYPE_FOLDERS[model_type]
+                local_file_path = f"{model_path}{model_filename}"
+                model_cache.pin([local_file_path]) # Pin before checking, so a concurrent eviction can't remove it between the check and the generation
+                pinned_models.append(local_file_path)
+                if ModelIndex().contains(model_path, model_filename) or (os.sep in model_filename and os.path.exists(local_file_path)): # The index only lists the top of each folder
+                    model_cache.record_hit(model_type, local_file_path)
+                else:
+                    missing_models.append(model)
             copied_models = []
-            copied_models_times = []
-            total_models_processed = 0
-            if models_list:
-                for item in models_list:  # will iterate across all items in the list
-                    for model in item.values():  # will iterate across all models in the list
-                        copy_start_time = time.time()
-                        if model["model_type"] == "sd_model":
-                            model_type_path ="checkpoints"
-                            model_path = f"{MODELS_FOLDER}/checkpoints/"
-                        elif model["model_type"] == "lora_model":
-                            model_type_path ="loras"
-                            model_path = f"{MODELS_FOLDER}/loras/"
-                        elif model["model_type"] == "controlnet_model":
-                            model_type_path ="controlnet"
-                            model_path = f"{MODELS_FOLDER}/controlnet/"
-                        elif model["model_type"] == "ipadapter_model":
-                            model_type_path ="ipadapter"
-                            model_path = f"{CUSTOM_NODES_FOLDER}/ComfyUI_IPAdapter_plus/models/"
-                        if model["model_filename"] not in os.listdir(model_path):
-                            if model["model_filename"] in os.listdir(f"{NETWORK_STORAGE}/{model_type_path}"):
-                                try:
-                                    subprocess.run(["cp", f"{NETWORK_STORAGE}/{model_type_path}/{model['model_filename']}", f"{model_path}"], check=True)
-                                except subprocess.CalledProcessError as e:
-                                    subprocess_error_message = f"ERROR: Failed to copy model['model_filename'] '{model['model_filename']}' from network storage"
-                                    complete_errorlog = send_runpod_errorlog(subprocess_error_message, request_id)
-                                    raise subprocess_error_message
-                            else:
-                                try:
-                                    aws_connector.download_files([(model["model_filename"], f"{model_path}/{model['model_filename']}")]) # Download the model from S3
-                                    if save_to_network_storage: # Save the model to the Runpod database, once downloaded
-                                        try:
-                                            rand = ''.join(random.choices(string.ascii_lowercase + string.digits, k=10)) # Generate a random string to append to the filename to avoid overwriting and allow concurrent workers to run
-                                            file_name = model['model_filename']
-                                            temporary_file_name = f"{rand}_{file_name}"
-                                            subprocess.run(["cp", f"{model_path}/{model['model_filename']}", f"{NETWORK_STORAGE}/{model_type_path}/{temporary_file_name}"], check=True)
-                                            os.rename(f"{NETWORK_STORAGE}/{model_type_path}/{temporary_file_name}", f"{NETWORK_STORAGE}/{model_type_path}/{file_name}")
-                                            print()
-                                        except Exception as e:
-                                            complete_errorlog = send_runpod_errorlog(f"DISTILLERYPRINT: Warning - Failed to copy model to network storage: '{model['model_filename']}' from S3", request_id)
-                                            pass
-                                except Exception as e:
-                                    complete_errorlog = send_runpod_errorlog(f"DISTILLERYPRINT: Error downloading model '{model['model_filename']}' from S3", request_id)
-                                    raise
-                            copy_end_time = time.time()
-                            copied_models.append(model['model_filename'])
-                            copied_models_times.append(copy_end_time - copy_start_time)
-                        total_models_processed += 1
-            end_time = time.time()
-            total_time_consumed = end_time - start_time
-            aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"DISTILLERYPRINT: #{request_id} - {len(copied_models)} models copied from network storage in {total_time_consumed} seconds. Models copied: {copied_models}", level='INFO')
+            if missing_models:
+                with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_MODEL_FETCHES, len(missing_models))) as executor:
+                    copied_models = list(executor.map(timed_fetch, missing_models))
+            total_time_consumed = time.time() - start_time
+            aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"DISTILLERYPRINT: #{request_id} - {len(copied_models)} of {len(unique_models)} unique models copied from network storage or S3 in {total_time_consumed:.2f} seconds (wall clock). Models copied (filename, source, seconds): {copied_models}. Cache hit rates: {model_cache.hit_rates()}", level='INFO')
+            return pinned_models
         except Exception as e:
+            ModelCache().unpin(pinned_models)
             complete_errorlog = send_runpod_errorlog("Error in get_models_from_storage", request_id)
             raise complete_errorlog
 
+def classify_failure(error, comfy_connector): # Returns (kind, whether ComfyUI must be restarted); only a ComfyUI that is gone is worth the restart
+    try:
+        if isinstance(error, ComfyWorkflowError):
+            kind = 'workflow'
+        elif isinstance(error, (BotoCoreError, ClientError, Boto3Error)):
+            kind = 's3'
+        elif isinstance(error, ComfyConnectionError):
+            kind = 'comfy_connection'
+        else:
+            kind = 'other'
+        if kind in ('workflow', 's3'): # ComfyUI answered or was never involved
+            return kind, False
+        healthy = comfy_connector is not None and comfy_connector.is_healthy()
+        return (kind if healthy else 'comfy_crashed'), not healthy
+    except Exception as e:
+        raise
+
+def model_file_size(model): # Identity of a model that is not in S3: its size on network storage or locally; None when no copy exists
+    try:
+        model_type_path, model_path = MODEL_TYPE_FOLDERS.get(model['model_type'], (None, None))
+        for file_path in (f"{NETWORK_STORAGE}/{model_type_path}/{model['model_filename']}", f"{model_path}{model['model_filename']}"):
+            if model_path is not None and os.path.exists(file_path):
+                return os.path.getsize(file_path)
+        return None
+    except Exception as e:
+        raise
+
+def result_cache_key(payload, models_to_fetch, input_image_keys): # Hash of everything that determines the images: the workflow and its seed, the batch settings, and the content of every model and input image (by S3 ETag); None when a file can't be identified
+    try:
+        aws_connector = AWSConnector()
+        models = {model['model_filename']: model for item in models_to_fetch for model in item.values()}
+        file_keys = sorted(set(models) | set(input_image_keys))
+        file_identities = dict(zip(file_keys, aws_connector.get_etags(file_keys, missing_ok=True)))
+        for file_key, identity in file_identities.items():
+            if identity is None and file_key in models:
+                file_identities[file_key] = model_file_size(models[file_key])
+            if file_identities[file_key] is None:
+                return None
+        return ResultCache.request_key({
+            'comfy_api': payload['comfy_api'],
+            'noise_seed_template_paths': payload['noise_seed_template_paths'],
+            'noise_seed': payload['template_inputs'].get('NOISE_SEED'),
+            'images_per_batch': payload['images_per_batch'],
+            'batch_strategy': payload.get('batch_strategy', DEFAULT_BATCH_STRATEGY),
+            'files': file_identities,
+        })
+    except Exception as e:
+        raise
+
+def look_up_result_cache(payload): # Returns (key to store the result under, cached S3 keys or None); a broken cache never fails the request, it only makes it regenerate
+    aws_connector = AWSConnector()
+    request_id = payload['request_id']
+    try:
+        result_cache = ResultCache()
+        if not result_cache.enabled():
+            distillery_trace.annotate('result_cache', 'disabled')
+            return None, None
+        with distillery_trace.span('result_cache_lookup'):
+            template_inputs = payload['template_inputs']
+            workflow = WorkflowTemplateCache().compile(payload['payload_template_key'], payload['comfy_api'], payload['noise_seed_template_paths'])
+            models_to_fetch = InputPreprocessor.tally_models_to_fetch(template_inputs) + workflow.models_to_fetch(payload['comfy_api'])
+            input_image_keys = [template_inputs[key] for key in INPUT_IMAGE_TEMPLATE_INPUTS if template_inputs.get(key)]
+            key = result_cache_key(payload, models_to_fetch, input_image_keys)
+            if key is None:
+                distillery_trace.annotate('result_cache', 'uncacheable')
+                return None, None
+            files = result_cache.get(key)
+            if files is not None and None in aws_connector.get_etags(files, missing_ok=True): # The images are gone from S3, e.g. expired by a lifecycle rule
+                result_cache.discard(key)
+                files = None
+        if files is None:
+            distillery_trace.annotate('result_cache', 'miss')
+            return key, None
+        distillery_trace.annotate('result_cache', 'hit')
+        aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"Result cache hit: returning {len(files)} images generated earlier for the same workflow, seed and files.", level='INFO', result_cache_key=key)
+        for batch_index, file in enumerate(files):
+            distillery_trace.emit({'type': 'image', 'key': file, 'seed': None, 'batch_index': batch_index, 'cached': True})
+        return key, files
+    except Exception as e:
+        distillery_trace.annotate('result_cache', 'error')
+        aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"Result cache lookup failed; generating the images. Exception: {e}", level='WARNING')
+        return None, None
+
+def store_result(key, files, request_id):
+    try:
+        ResultCache().put(key, files, request_id)
+    except Exception as e:
+        AWSConnector().print_log(request_id, INSTANCE_IDENTIFIER, f"Could not store the result in the result cache. Exception: {e}", level='WARNING')
+
 def flatten_list(nested_list):
     try:
         flat_list = []
@@ -254,7 +602,11 @@ def flatten_list(nested_list):
 def worker_routine(event):
     try:
         aws_connector = AWSConnector()
-        payload = copy.deepcopy(event['input'])
+        model_cache = ModelCache()
+        input_cache = InputCache()
+        payload = dict(event['input']) # The workflow itself is never modified in place: seeds and staged inputs are patched into copies of the affected nodes only
+        if isinstance(payload.get('template_inputs'), dict):
+            payload['template_inputs'] = dict(payload['template_inputs']) # NOISE_SEED is bumped in place
         request_id = payload['request_id']
     except Exception as e:
         raise
@@ -267,10 +619,19 @@ def worker_routine(event):
                 force_category = payload['parsed_output']['category'] if payload['parsed_output']['category'] != 'autodetect' else None
             return do_training(lora_name, original_image_file_name, force_category=force_category)
     attempt_number = 1
+    comfy_connector = None
+    pinned_models = []
+    pinned_inputs = []
+    cache_key = None
+    if payload.get('result_cache') and 'comfy_api' in payload: # Opt-in per request: the master knows whether a repeat may return the same images
+        cache_key, cached_files = look_up_result_cache(payload)
+        if cached_files is not None:
+            return cached_files
     try:
         while attempt_number <= MAX_WORKER_ATTEMPTS:
             try:
-                comfy_connector = ComfyConnector()
+                with distillery_trace.span('comfy_ready'): # Only takes time when ComfyUI is still booting or was restarted by a previous attempt
+                    comfy_connector = ComfyConnector()
                 if not 'input' in event:
                     aws_connector.print_log('N/A', INSTANCE_IDENTIFIER, f"Worker was passed a None payload from event.", level='ERROR')        
                     return None
@@ -279,58 +640,57 @@ def worker_routine(event):
                 comfy_api = payload['comfy_api']
                 noise_seed_template_paths = payload['noise_seed_template_paths']
                 payload_template_key = payload['payload_template_key']
-                # img2img
-                if 'IMG2IMG_IMAGE_FILENAME' in template_inputs:
-                    comfy_connector.upload_from_s3_to_input(aws_connector, [template_inputs['IMG2IMG_IMAGE_FILENAME']])
-                # inpaint
-                if 'INPAINT_IMAGE_FILENAME' in template_inputs:
-                    comfy_connector.upload_from_s3_to_input(aws_connector, [template_inputs['INPAINT_IMAGE_FILENAME']])
-                if 'INPAINT_MASK_IMAGE_FILENAME' in template_inputs:
-                    comfy_connector.upload_from_s3_to_input(aws_connector, [template_inputs['INPAINT_MASK_IMAGE_FILENAME']])
-                # controlnet
-                if 'CONTROLNET_IMAGE_FILENAME' in template_inputs:
-                    comfy_connector.upload_from_s3_to_input(aws_connector, [template_inputs['CONTROLNET_IMAGE_FILENAME']])
-                # zoomout
-                if 'ZOOM_OUT_IMAGE_FILENAME' in template_inputs:
-                    comfy_connector.upload_from_s3_to_input(aws_connector, [template_inputs['ZOOM_OUT_IMAGE_FILENAME']])
-                # IPAdapter
-                if 'IPADAPTER_1_IMAGE_FILENAME' in template_inputs:
-                    comfy_connector.upload_from_s3_to_input(aws_connector, [template_inputs['IPADAPTER_1_IMAGE_FILENAME']]) 
-                if 'IPADAPTER_2_IMAGE_FILENAME' in template_inputs:
-                    comfy_connector.upload_from_s3_to_input(aws_connector, [template_inputs['IPADAPTER_2_IMAGE_FILENAME']]) 
-                if 'IPADAPTER_3_IMAGE_FILENAME' in template_inputs:
-                    comfy_connector.upload_from_s3_to_input(aws_connector, [template_inputs['IPADAPTER_3_IMAGE_FILENAME']]) 
-                if 'IPADAPTER_4_IMAGE_FILENAME' in template_inputs:
-                    comfy_connector.upload_from_s3_to_input(aws_connector, [template_inputs['IPADAPTER_4_IMAGE_FILENAME']]) 
-                models_to_fetch = InputPreprocessor.tally_models_to_fetch(template_inputs)
-                if models_to_fetch:
-                    InputPreprocessor.get_models_from_storage(models_to_fetch, request_id) # Copy models from network storage to ComfyUI
-                files = []
-                for i in range(images_per_batch):
-                    file = fetch_images(payload)
-                    files.append(file)
-                    if isinstance(template_inputs['NOISE_SEED'], str):
-                        template_inputs['NOISE_SEED']=str(int(template_inputs['NOISE_SEED'])+1)
+                with distillery_trace.span('workflow_compile'):
+                    workflow = WorkflowTemplateCache().compile(payload_template_key, comfy_api, noise_seed_template_paths)
+                with distillery_trace.span('input_staging'):
+                    input_image_keys = [template_inputs[key] for key in INPUT_IMAGE_TEMPLATE_INPUTS if template_inputs.get(key)]
+                    image_names = comfy_connector.stage_inputs_from_s3(aws_connector, input_image_keys) # img2img, inpaint, controlnet, zoomout and IPAdapter images, fetched concurrently
+                    input_cache.unpin(pinned_inputs) # A retry pins the same images again
+                    pinned_inputs = [f"{INFERENCE_INPUT_FOLDER}/{image_name}" for image_name in image_names.values() if image_name.startswith(f"{INPUT_CACHE_SUBFOLDER}/")]
+                    payload['comfy_api'] = InputPreprocessor.point_inputs_to_files(payload['comfy_api'], image_names)
+                with distillery_trace.span('model_fetch'):
+                    models_to_fetch = InputPreprocessor.tally_models_to_fetch(template_inputs) + workflow.models_to_fetch(payload['comfy_api']) # template_inputs first: they are required, while models found in the workflow may live where only ComfyUI looks
+                    if models_to_fetch:
+                        model_cache.unpin(pinned_models) # A retry pins the same models again
+                        pinned_models = InputPreprocessor.get_models_from_storage(models_to_fetch, request_id) # Copy models from network storage to ComfyUI
+                batch_strategy = payload.get('batch_strategy', DEFAULT_BATCH_STRATEGY)
+                if batch_strategy not in BATCH_STRATEGIES:
+                    print(f"DISTILLERYPRINT: Unknown batch_strategy '{batch_strategy}'. Using 'sequential'.")
+                upload_executor = ThreadPoolExecutor(max_workers=2) if PIPELINE_IMAGE_UPLOADS and images_per_batch > 1 else None
+                try:
+                    if batch_strategy == 'queued' and images_per_batch > 1:
+                        files = generate_queued(payload, workflow, images_per_batch, upload_executor)
+                    elif batch_strategy == 'latent_batch' and images_per_batch > 1:
+                        files = generate_latent_batch(payload, workflow, images_per_batch, upload_executor)
                     else:
-                        template_inputs['NOISE_SEED'] += 1
-                    comfy_api = InputPreprocessor.update_paths(comfy_api, noise_seed_template_paths, template_inputs['NOISE_SEED'])
-                    payload['comfy_api'] = comfy_api
-                    print(f"DISTILLERYPRINT: Image {i+1} - New Seed: {template_inputs['NOISE_SEED']}")
+                        files = generate_sequential(payload, workflow, images_per_batch, upload_executor)
+                    with distillery_trace.span('upload_wait'): # Uploads still running after the last image was sampled
+                        files = collect_uploaded_files(files)
+                finally:
+                    if upload_executor is not None:
+                        upload_executor.shutdown(wait=True, cancel_futures=True) # Only cancels anything when the batch failed
                 corrected_files = flatten_list(files)
+                if cache_key is not None:
+                    store_result(cache_key, corrected_files, request_id)
                 aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"Files being sent to the handler: {corrected_files}", level='INFO')
                 return corrected_files
             except Exception as e:
+                failure_kind, restart_comfy = classify_failure(e, comfy_connector)
+                next_step = "Killing ComfyUI" if restart_comfy else "Keeping ComfyUI"
                 if attempt_number < MAX_WORKER_ATTEMPTS:
-                    aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"Worker failed on attempt #{attempt_number}/{MAX_WORKER_ATTEMPTS}. Killing ComfyUI and retrying. Workflow: {payload_template_key}. Exception: {e}", level='WARNING')
-                    message_to_log = f"DISTILLERYPRINT: WARNING: Worker failed on attempt #{attempt_number}/{MAX_WORKER_ATTEMPTS}. Killing ComfyUI and retrying. Workflow: {payload_template_key}. Template inputs: {template_inputs}. Exception: {e}"
+                    aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"Worker failed on attempt #{attempt_number}/{MAX_WORKER_ATTEMPTS} ({failure_kind} failure). {next_step} and retrying. Workflow: {payload_template_key}. Exception: {e}", level='WARNING', failure_kind=failure_kind)
+                    message_to_log = f"DISTILLERYPRINT: WARNING: Worker failed on attempt #{attempt_number}/{MAX_WORKER_ATTEMPTS} ({failure_kind} failure). {next_step} and retrying. Workflow: {payload_template_key}. Template inputs: {template_inputs}. Exception: {e}"
                     print(message_to_log)
                     time.sleep(0.25)
-                    comfy_connector.kill_api()
+                    if restart_comfy and comfy_connector is not None:
+                        with distillery_trace.span('comfy_restart'):
+                            comfy_connector.kill_api() # With COMFY_HOT_STANDBY, the next ComfyConnector() promotes the standby
                     attempt_number += 1
                 else:
-                    message_to_log = f"DISTILLERYPRINT: ERROR: Worker failed on attempt #{attempt_number}/{MAX_WORKER_ATTEMPTS}. Killing ComfyUI and returning None. Workflow: {payload_template_key}. Template inputs: {template_inputs}. Exception: {e}"
+                    message_to_log = f"DISTILLERYPRINT: ERROR: Worker failed on attempt #{attempt_number}/{MAX_WORKER_ATTEMPTS} ({failure_kind} failure). {next_step} and returning None. Workflow: {payload_template_key}. Template inputs: {template_inputs}. Exception: {e}"
                     complete_errorlog = send_runpod_errorlog(message_to_log, request_id)
-                    comfy_connector.kill_api()
+                    if restart_comfy and comfy_connector is not None:
+                        comfy_connector.kill_api()
                     return complete_errorlog
     except Exception as e:
         message_to_log = f"DISTILLERYPRINT: ERROR: Unhandled error on worker_routine. Workflow: {payload_template_key}. Exception: {e}"
@@ -338,30 +698,101 @@ def worker_routine(event):
         if payload['request_type'] != 'distill':
             comfy_connector.kill_api()
         return complete_errorlog
+    finally:
+        model_cache.unpin(pinned_models) # The models may be evicted again once no request is using them
+        input_cache.unpin(pinned_inputs)
+
+def summarize_event(event): # The workflow is by far the largest part of the event; log its size and hash instead of its content
+    try:
+        payload = dict(event.get('input') or {})
+        if isinstance(payload.get('comfy_api'), dict):
+            workflow_hash = hashlib.sha256(json.dumps(payload['comfy_api'], sort_keys=True).encode('utf-8')).hexdigest()[:16]
+            payload['comfy_api'] = f"<workflow with {len(payload['comfy_api'])} nodes, sha256 {workflow_hash}>"
+        return dict(event, input=payload)
+    except Exception as e:
+        raise
+
+class RequestCounter: # Requests being handled right now; logged with every request so MAX_CONCURRENT_REQUESTS can be tuned
+    _instance = None
+    _init_lock = threading.Lock()
+
+    def __new__(cls):
+        try:
+            if cls._instance is None:
+                with cls._init_lock:
+                    if cls._instance is None:
+                        instance = super().__new__(cls)
+                        instance.lock = threading.Lock()
+                        instance.in_flight = 0
+                        instance.peak = 0
+                        cls._instance = instance
+            return cls._instance
+        except Exception as e:
+            raise
+
+    def enter(self): # Returns the number of requests in flight, this one included
+        with self.lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            return self.in_flight
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+            return self.in_flight
+
+def describe_work(payload): # Returns (timeout, work assignment) for the request
+    if payload['request_type'] == 'distill':
+        return WORKER_TIMEOUT_FOR_TRAINING, 'TRAINING'
+    return WORKER_TIMEOUT_FOR_INFERENCE, 'INFERENCE'
+
+def log_request_received(event, request_id, work_assignment, in_flight):
+    try:
+        aws_connector = AWSConnector()
+        event_summary = summarize_event(event)
+        aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"DISTILLERYPRINT: Worker called by Master for {work_assignment} ({in_flight} of at most {MAX_CONCURRENT_REQUESTS} requests in flight). event = {event_summary}.", level='INFO', in_flight=in_flight)        
+        print(f"DISTILLERYPRINT: Worker called by Master. event = {event_summary}.")
+    except Exception as e:
+        raise
+
+def log_request_finished(request_id, work_assignment, result, timings):
+    try:
+        aws_connector = AWSConnector()
+        request_counter = RequestCounter()
+        aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"DISTILLERYPRINT: Worker finished! Throughput time: {timings['total_seconds']:.2f} seconds (worker up for {(time.time()-START_TIME):.2f} seconds). Work done: {work_assignment}, results: {result}. Stage timings: {timings['stages']}. Requests in flight: {request_counter.in_flight}, peak {request_counter.peak}.", level='INFO', timings=timings, in_flight=request_counter.in_flight, peak_in_flight=request_counter.peak)
+    except Exception as e:
+        raise
 
 def handler(event):
     request_id = 'N/A'
+    future = None
+    in_flight = 0
     try:
         payload = event['input']
         request_id = payload['request_id']
-        worker_timeout = WORKER_TIMEOUT_FOR_INFERENCE
-        work_assignment = 'INFERENCE'
-        if payload['request_type'] == 'distill':
-            worker_timeout = WORKER_TIMEOUT_FOR_TRAINING
-            work_assignment = 'TRAINING'
+        worker_timeout, work_assignment = describe_work(payload)
         aws_connector = AWSConnector()
-        aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"DISTILLERYPRINT: Worker called by Master for {work_assignment}. event = {event}.", level='INFO')        
-        print(f"DISTILLERYPRINT: Worker called by Master. event = {event}.")
+        in_flight = RequestCounter().enter()
+        log_request_received(event, request_id, work_assignment, in_flight)
+        trace = distillery_trace.RequestTrace(request_id, payload.get('payload_template_key', work_assignment))
         with ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(worker_routine, event)
+            future = executor.submit(trace.bind(worker_routine), event)
             try:
                 # Waiting for the result within WORKER_TIMEOUT seconds
                 result = future.result(timeout=worker_timeout)
             except TimeoutError:
                 # If the timeout occurs, log an error and return a timeout response
-                aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"DISTILLERYPRINT: Handler timed out after {worker_timeout} seconds doing {work_assignment}.", level='ERROR')
+                aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"DISTILLERYPRINT: Handler timed out after {worker_timeout} seconds doing {work_assignment}.", level='ERROR', timings=trace.summary())
                 return None
-            aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"DISTILLERYPRINT: Worker finished! Throughput time: {(time.time()-START_TIME):.2f} seconds. Work done: {work_assignment}, results: {result}.", level='INFO')
+            timings = trace.summary()
+            log_request_finished(request_id, work_assignment, result, timings)
+            if payload.get('return_timings') or payload.get('result_cache'): # Opt-in, so masters expecting the bare result keep working
+                response = {'output': result}
+                if payload.get('return_timings'):
+                    response['timings'] = timings
+                if payload.get('result_cache'):
+                    response['result_cache'] = timings.get('result_cache') # 'hit', 'miss', 'uncacheable', 'disabled' or 'error'
+                return response
             return result
     except Exception as e:
         complete_errorlog = send_runpod_errorlog("ERROR in Handler", request_id)
@@ -369,6 +800,131 @@ def handler(event):
     finally:
         if future:
             future.cancel()
+        if in_flight:
+            RequestCounter().leave()
         confirm_disk_space()
 
-runpod.serverless.start({"handler": handler})
\ No newline at end of file
+def stream_handler(event): # Generator version of handler: yields {'type': 'progress'} and {'type': 'image'} events while the request runs, then one {'type': 'result'} with what handler would return
+    request_id = 'N/A'
+    future = None
+    in_flight = 0
+    try:
+        payload = event['input']
+        request_id = payload['request_id']
+        worker_timeout, work_assignment = describe_work(payload)
+        aws_connector = AWSConnector()
+        in_flight = RequestCounter().enter()
+        log_request_received(event, request_id, work_assignment, in_flight)
+        events = queue.Queue() # Filled from the worker and upload threads, drained here
+        trace = distillery_trace.RequestTrace(request_id, payload.get('payload_template_key', work_assignment), listener=events.put)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(trace.bind(worker_routine), event)
+            future.add_done_callback(lambda _: events.put(STREAM_FINISHED)) # Queued after every event the request emitted, so the loop wakes up as soon as it finishes
+            deadline = time.time() + worker_timeout
+            while True:
+                try:
+                    stream_event = events.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    aws_connector.print_log(request_id, INSTANCE_IDENTIFIER, f"DISTILLERYPRINT: Handler timed out after {worker_timeout} seconds doing {work_assignment}.", level='ERROR', timings=trace.summary())
+                    yield {'type': 'result', 'output': None, 'timings': trace.summary()}
+                    return
+                if stream_event is STREAM_FINISHED:
+                    break
+                yield stream_event
+            result = future.result()
+            timings = trace.summary()
+            log_request_finished(request_id, work_assignment, result, timings)
+            yield {'type': 'result', 'output': result, 'timings': timings, **({'result_cache': timings.get('result_cache')} if payload.get('result_cache') else {})}
+    except Exception as e:
+        complete_errorlog = send_runpod_errorlog("ERROR in Handler", request_id)
+        yield {'type': 'result', 'output': complete_errorlog}
+    finally:
+        if future:
+            future.cancel()
+        if in_flight:
+            RequestCounter().leave()
+        confirm_disk_space()
+
+async def async_handler(event): # runpod only runs several jobs at once when the handler is a coroutine
+    return await asyncio.to_thread(handler, event)
+
+async def async_stream_handler(event):
+    events = stream_handler(event)
+    finished = object()
+    while (stream_event := await asyncio.to_thread(next, events, finished)) is not finished:
+        yield stream_event
+
+def concurrency_modifier(current_concurrency):
+    return MAX_CONCURRENT_REQUESTS
+
+def build_model_index():
+    try:
+        model_folders = []
+        for model_type_path, model_path in MODEL_TYPE_FOLDERS.values():
+            model_folders += [model_path, f"{NETWORK_STORAGE}/{model_type_path}"]
+        ModelIndex().build(model_folders)
+    except Exception as e:
+        send_runpod_errorlog("DISTILLERYPRINT: Warning - Could not build the model index at startup; folders will be indexed on first use", 'N/A')
+
+def copy_yielding_to_requests(source_path, destination_path): # Chunked copy that pauses while any request is in flight; returns False when a request provisioned the file meanwhile
+    temporary_path = os.path.join(os.path.dirname(destination_path), f".{uuid.uuid4().hex}.prefetch.part") # Hidden, so ComfyUI never lists a half-written model
+    try:
+        with open(source_path, 'rb') as source_file, open(temporary_path, 'wb') as destination_file:
+            while True:
+                while RequestCounter().in_flight > 0: # Requests get all of the network storage bandwidth
+                    time.sleep(MODEL_PREFETCH_PAUSE_SECONDS)
+                if os.path.exists(destination_path):
+                    return False
+                chunk = source_file.read(MODEL_PREFETCH_CHUNK_BYTES)
+                if not chunk:
+                    break
+                destination_file.write(chunk)
+        if os.path.exists(destination_path):
+            return False
+        os.rename(temporary_path, destination_path)
+        return True
+    finally:
+        if os.path.exists(temporary_path):
+            os.unlink(temporary_path)
+
+def prefetch_popular_models(): # Copies the most popular checkpoints and LoRAs from network storage into the local model folders, within the prefetch budget
+    try:
+        if MODEL_PREFETCH_TOP_K <= 0 or not NETWORK_STORAGE or not os.path.isdir(NETWORK_STORAGE):
+            return
+        start_time = time.time()
+        model_cache = ModelCache()
+        model_index = ModelIndex()
+        budget_bytes = min(MODEL_PREFETCH_MAX_GB * 2**30, model_cache.max_bytes - model_cache.cached_bytes(), shutil.disk_usage(MODELS_FOLDER).free - MINIMUM_GB_FREE_DISK_SPACE * 2**30)
+        prefetched_models = []
+        for model_type, model_filename, score in ModelPopularity().top(MODEL_PREFETCH_TYPES, MODEL_PREFETCH_TOP_K):
+            model_type_path, model_path = MODEL_TYPE_FOLDERS[model_type]
+            source_path = f"{NETWORK_STORAGE}/{model_type_path}/{model_filename}"
+            if ModelProvisioner.strategy_for(model_type) == 'symlink' or model_index.contains(model_path, model_filename) or not model_index.contains(f"{NETWORK_STORAGE}/{model_type_path}", model_filename):
+                continue # Symlinked models are read from network storage anyway; models only in S3 are left to the first request
+            size = os.path.getsize(source_path)
+            if size > budget_bytes:
+                continue
+            local_file_path = f"{model_path}{model_filename}"
+            if copy_yielding_to_requests(source_path, local_file_path):
+                model_index.add(model_path, model_filename)
+                model_cache.track(model_type, local_file_path)
+                budget_bytes -= size
+                prefetched_models.append((model_filename, score))
+        AWSConnector().print_log('N/A', INSTANCE_IDENTIFIER, f"Prefetched {len(prefetched_models)} popular models in {time.time() - start_time:.2f} seconds (filename, popularity): {prefetched_models}", level='INFO')
+    except Exception as e:
+        send_runpod_errorlog("DISTILLERYPRINT: Warning - Popular model prefetch failed; requests will fetch their models themselves", 'N/A')
+
+def boot_comfy_in_background():
+    try:
+        ComfyConnector()
+    except Exception as e:
+        send_runpod_errorlog("DISTILLERYPRINT: Warning - Background ComfyUI boot failed; the first request will retry it", 'N/A')
+
+COMFY_BOOT_EXECUTOR.submit(boot_comfy_in_background)
+NETWORK_STORAGE_WRITER.submit(build_model_index) # The writer is idle at startup, and queued write-backs then see a complete index
+MODEL_PREFETCH_EXECUTOR.submit(prefetch_popular_models) # In parallel with the ComfyUI boot
+if __name__ == '__main__': # Imported by the offline benchmark, which calls handler directly
+    if STREAM_OUTPUT: # /stream returns the events as they come; /run and /runsync return the list of every event
+        runpod.serverless.start({"handler": async_stream_handler, "return_aggregate_stream": True, "concurrency_modifier": concurrency_modifier})
+    else:
+        runpod.serverless.start({"handler": async_handler, "concurrency_modifier": concurrency_modifier})
\ No newline at end of file
@@ -0,0 +1,169 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+WORKFLOW_TEMPLATE_CACHE_SIZE = int(os.getenv("WORKFLOW_TEMPLATE_CACHE_SIZE", 64)) # Compiled workflow templates kept in memory, least recently used evicted first
+OUTPUT_NODE_CLASS = 'SaveImage'
+LATENT_BATCH_NODE_CLASSES = ('EmptyLatentImage',) # Nodes whose batch_size input sets how many images a single prompt renders
+WORKFLOW_MODEL_NODES = os.getenv("WORKFLOW_MODEL_NODES", "") # Extra entries for MODEL_NODE_REGISTRY, e.g. "MyLoraStack.lora_01=lora_model,MyUpscaler.model=upscale_model"
+MODEL_NODE_REGISTRY = { # class_type => {input name => model type}; the model type selects the model folder (MODEL_TYPE_FOLDERS in distillery_worker)
+    'CheckpointLoaderSimple': {'ckpt_name': 'sd_model'},
+    'CheckpointLoader': {'ckpt_name': 'sd_model'},
+    'ImageOnlyCheckpointLoader': {'ckpt_name': 'sd_model'},
+    'LoraLoader': {'lora_name': 'lora_model'},
+    'LoraLoaderModelOnly': {'lora_name': 'lora_model'},
+    'ControlNetLoader': {'control_net_name': 'controlnet_model'},
+    'DiffControlNetLoader': {'control_net_name': 'controlnet_model'},
+    'IPAdapterModelLoader': {'ipadapter_file': 'ipadapter_model'},
+    'VAELoader': {'vae_name': 'vae_model'},
+    'UpscaleModelLoader': {'model_name': 'upscale_model'},
+    'CLIPVisionLoader': {'clip_name': 'clip_vision_model'},
+    'UNETLoader': {'unet_name': 'unet_model'},
+    'CLIPLoader': {'clip_name': 'clip_model'},
+    'DualCLIPLoader': {'clip_name1': 'clip_model', 'clip_name2': 'clip_model'},
+}
+MODEL_INPUT_TYPES = { # Input names that mean the same model type on any node; used for classes missing from MODEL_NODE_REGISTRY (custom nodes)
+    'ckpt_name': 'sd_model',
+    'lora_name': 'lora_model',
+    'control_net_name': 'controlnet_model',
+    'ipadapter_file': 'ipadapter_model',
+    'vae_name': 'vae_model',
+    'unet_name': 'unet_model',
+}
+MODEL_FILE_EXTENSIONS = ('.safetensors', '.ckpt', '.pt', '.pth', '.bin', '.pkl', '.sft', '.gguf') # Values like 'None' or 'Baked VAE' are options, not files
+
+def load_model_node_registry(): # MODEL_NODE_REGISTRY extended with WORKFLOW_MODEL_NODES
+    try:
+        registry = {class_type: dict(inputs) for class_type, inputs in MODEL_NODE_REGISTRY.items()}
+        for item in WORKFLOW_MODEL_NODES.replace(' ', '').split(','):
+            if '=' not in item or '.' not in item.split('=', 1)[0]:
+                if item:
+                    print(f"DISTILLERYPRINT: Ignoring malformed WORKFLOW_MODEL_NODES entry '{item}'. Expected 'ClassType.input_name=model_type'.")
+                continue
+            node_input, model_type = item.split('=', 1)
+            class_type, input_name = node_input.rsplit('.', 1)
+            registry.setdefault(class_type, {})[input_name] = model_type
+        return registry
+    except Exception as e:
+        raise
+
+MODEL_NODES = load_model_node_registry()
+
+def workflow_signature(comfy_api, seed_paths): # Hash of the workflow's shape: node ids, classes and input names, not their values; prompts and seeds change per request, the shape only per template version
+    try:
+        shape = []
+        for node_id in sorted(comfy_api):
+            node = comfy_api[node_id]
+            if isinstance(node, dict):
+                inputs = node.get('inputs')
+                shape.append([node_id, node.get('class_type'), sorted(node), sorted(inputs) if isinstance(inputs, dict) else None])
+            else:
+                shape.append([node_id, None, None, None])
+        return hashlib.sha256(json.dumps([shape, seed_paths]).encode('utf-8')).hexdigest()[:16]
+    except Exception as e:
+        raise
+
+def patch_path(json_obj, path, value): # Returns json_obj with value at path, copying only the dicts along the path; everything else is shared with json_obj
+    try:
+        updated_json_obj = dict(json_obj)
+        if len(path) == 1:
+            updated_json_obj[path[0]] = value
+        else:
+            updated_json_obj[path[0]] = patch_path(json_obj[path[0]], path[1:], value)
+        return updated_json_obj
+    except Exception as e:
+        raise
+
+class CompiledWorkflow: # Everything the worker needs to know about a workflow template, found with one pass over its nodes
+    def __init__(self, comfy_api, seed_paths):
+        try:
+            self.seed_paths = [tuple(path) for path in seed_paths if self.resolves(comfy_api, path)] # Paths missing from the workflow are skipped, as update_paths did
+            self.output_node_id = None
+            self.latent_batch_nodes = []
+            self.model_inputs = [] # (node_id, input name, model type) triples
+            for node_id, node in comfy_api.items():
+                if not isinstance(node, dict):
+                    continue
+                class_type = node.get('class_type')
+                inputs = node.get('inputs', {}) if isinstance(node.get('inputs'), dict) else {}
+                if class_type == OUTPUT_NODE_CLASS and self.output_node_id is None:
+                    self.output_node_id = node_id
+                if class_type in LATENT_BATCH_NODE_CLASSES and 'batch_size' in inputs:
+                    self.latent_batch_nodes.append(node_id)
+                for input_name, value in inputs.items():
+                    if not isinstance(value, str):
+                        continue
+                    model_type = MODEL_NODES[class_type].get(input_name) if class_type in MODEL_NODES else MODEL_INPUT_TYPES.get(input_name)
+                    if model_type is not None:
+                        self.model_inputs.append((node_id, input_name, model_type))
+        except Exception as e:
+            raise
+
+    @staticmethod
+    def resolves(comfy_api, path):
+        try:
+            target = comfy_api
+            for key in path[:-1]:
+                target = target.get(key) if isinstance(target, dict) else None
+            return isinstance(target, dict) and path[-1] in target
+        except Exception as e:
+            raise
+
+    def models_to_fetch(self, comfy_api): # Every model file the workflow loads, in the format of InputPreprocessor.tally_models_to_fetch
+        try:
+            models = []
+            for node_id, input_name, model_type in self.model_inputs:
+                model_filename = comfy_api[node_id]['inputs'].get(input_name)
+                if isinstance(model_filename, str) and model_filename.lower().endswith(MODEL_FILE_EXTENSIONS):
+                    models.append({f"{node_id}.{input_name}": {'model_filename': model_filename, 'model_type': model_type, 'discovered': True}})
+            return models
+        except Exception as e:
+            raise
+
+    def with_seed(self, comfy_api, seed): # The seed variant of comfy_api; shares every node but the ones holding a seed
+        try:
+            for path in self.seed_paths:
+                comfy_api = patch_path(comfy_api, path, seed)
+            return comfy_api
+        except Exception as e:
+            raise
+
+class WorkflowTemplateCache: # LRU of CompiledWorkflow keyed by (payload_template_key, workflow signature); shared by every request the worker handles
+    _instance = None
+    _init_lock = threading.Lock()
+
+    def __new__(cls):
+        try:
+            if cls._instance is None:
+                with cls._init_lock:
+                    if cls._instance is None:
+                        instance = super(WorkflowTemplateCache, cls).__new__(cls)
+                        instance.lock = threading.Lock()
+                        instance.templates = OrderedDict()
+                        instance.hits = 0
+                        instance.misses = 0
+                        cls._instance = instance
+            return cls._instance
+        except Exception as e:
+            raise
+
+    def compile(self, payload_template_key, comfy_api, seed_paths): # Returns the compiled template, compiling it on the first request that uses this version of the workflow
+        try:
+            key = (payload_template_key, workflow_signature(comfy_api, seed_paths))
+            with self.lock:
+                compiled_workflow = self.templates.get(key)
+                if compiled_workflow is not None:
+                    self.templates.move_to_end(key)
+                    self.hits += 1
+                    return compiled_workflow
+                self.misses += 1
+            compiled_workflow = CompiledWorkflow(comfy_api, seed_paths) # Outside the lock; two requests compiling the same template at once both get a correct result
+            with self.lock:
+                self.templates[key] = compiled_workflow
+                while len(self.templates) > WORKFLOW_TEMPLATE_CACHE_SIZE:
+                    self.templates.popitem(last=False)
+            return compiled_workflow
+        except Exception as e:
+            raise
@@ -24,3 +24,43 @@ export OPENAI_API_KEY='xxxxxxxxxxxxxxxxxxxxxxxxxx'
 export INFERENCE_OUTPUT_FOLDER='/workspace/ComfyUI/output'
 export INFERENCE_INPUT_FOLDER='/workspace/ComfyUI/input'
 export MINIMUM_GB_FREE_DISK_SPACE=4
+export AWS_S3_MAX_POOL_CONNECTIONS=50
+export AWS_S3_MULTIPART_THRESHOLD_MB=64
+export AWS_S3_MULTIPART_CHUNKSIZE_MB=32
+export AWS_S3_MAX_CONCURRENCY=10
+export AWS_S3_MAX_PARALLEL_FILES=4
+export MAX_PARALLEL_MODEL_FETCHES=4
+export MODEL_CACHE_MAX_GB=60
+export MODEL_CACHE_MANIFEST='/workspace/ComfyUI/models/.distillery_model_cache.json'
+export PIPELINE_IMAGE_UPLOADS=true
+export DEFAULT_BATCH_STRATEGY='sequential'
+export STREAM_IMAGES_OVER_WEBSOCKET=false
+export COMFY_STARTUP_TIMEOUT=180
+export COMFY_WARMUP=true
+export COMFY_INPUT_STAGING='filesystem'
+export INPUT_CACHE_MAX_GB=5
+export NETWORK_INDEX_RESCAN_SECONDS=300
+export MODEL_PROVISIONING_DEFAULT='copy'
+export MODEL_PROVISIONING=''
+export MODEL_LEASE_HEARTBEAT_SECONDS=10
+export MODEL_LEASE_STALE_SECONDS=90
+export MODEL_LEASE_WAIT_TIMEOUT=120
+export MODEL_LEASE_WRITE_BACK_WAIT_SECONDS=30
+export LOG_SINK='cloudwatch'
+export LOG_QUEUE_MAX_RECORDS=10000
+export LOG_MAX_FIELD_BYTES=16384
+export STREAM_OUTPUT=false
+export MAX_CONCURRENT_REQUESTS=1
+export COMFY_HOT_STANDBY=false
+export COMFY_STANDBY_WARMUP=false
+export WORKFLOW_TEMPLATE_CACHE_SIZE=64
+export WORKFLOW_MODEL_NODES=''
+export RESULT_CACHE_TTL_SECONDS=86400
+export RESULT_CACHE_MAX_ENTRIES=100000
+export MODEL_POPULARITY_HALF_LIFE_HOURS=72
+export MODEL_POPULARITY_FLUSH_SECONDS=60
+export MODEL_PREFETCH_TOP_K=5
+export MODEL_PREFETCH_MAX_GB=20
+export LATENT_CACHE_FOLDER='/workspace/distill/latent_cache'
+export UNAVAILABLE_MODEL_TTL_SECONDS=600
+export CACHE_MANIFEST_SAVE_SECONDS=30